@@ -0,0 +1,17 @@
+"""
+Benchmarks of the throughput and latency of L{ampoule.pool.ProcessPool}
+and L{ampoule.service.AMPouleService}.
+
+Run the scenarios of L{ampoule.bench.scenarios} and write their results
+as JSON, then compare two runs, for instance before and after an
+upgrade::
+
+    python -m ampoule.bench run --output before.json
+    python -m ampoule.bench run --output after.json
+    python -m ampoule.bench compare before.json after.json
+
+Each scenario makes a fixed number of calls with a fixed number of them
+in flight, after warming the pool up, so that runs on the same machine
+can be compared. Latencies are measured by the caller, from the call to
+its answer.
+"""
@@ -0,0 +1,123 @@
+"""
+Run the benchmarks, or compare the results of two runs, see
+L{ampoule.bench}.
+"""
+import json
+import sys
+
+from twisted.python import usage
+
+from ampoule.bench import compare, runner, scenarios
+
+
+class RunOptions(usage.Options):
+    synopsis = "[options] [scenario ...]"
+    optParameters = [
+        ["output", "o", None, "Write the results to this file."],
+        ["scale", "s", 1.0, "Multiply the calls of every scenario by this.",
+         float],
+        ["warmup", "w", runner.WARMUP,
+         "Calls made before timing a scenario.", int],
+    ]
+    optFlags = [["list", "l", "List the scenarios and exit."]]
+
+    def parseArgs(self, *names):
+        self['names'] = names
+
+
+class CompareOptions(usage.Options):
+    synopsis = "[options] old.json new.json"
+    optParameters = [
+        ["threshold", "t", compare.THRESHOLD,
+         "Change for the worse that counts as a regression.", float],
+    ]
+
+    def parseArgs(self, old, new):
+        self['old'] = old
+        self['new'] = new
+
+
+class Options(usage.Options):
+    synopsis = "run|compare [options]"
+    subCommands = [
+        ["run", None, RunOptions, "Run the benchmarks."],
+        ["compare", None, CompareOptions,
+         "Compare the results of two runs, exit with 1 on regressions."],
+    ]
+
+    def postOptions(self):
+        if self.subCommand is None:
+            raise usage.UsageError("Tell me to run or to compare.")
+
+
+def _report(name, result):
+    latency = result['latency']
+    print("%-24s %10.1f calls/s  p50 %8s  p99 %8s  p999 %8s  errors %d" % (
+        name, result['throughput'] or 0, compare._number(latency['p50']),
+        compare._number(latency['p99']), compare._number(latency['p999']),
+        sum(result['errors'].values())))
+    sys.stdout.flush()
+
+
+def _run(options):
+    from twisted.internet import reactor
+
+    if options['list']:
+        for scenario in scenarios.SCENARIOS:
+            print(scenario.name)
+        return 0
+    if options['names']:
+        try:
+            chosen = scenarios.byName(options['names'])
+        except KeyError as e:
+            raise usage.UsageError("No scenario %s." % (e,))
+    else:
+        chosen = scenarios.SCENARIOS
+    outcome = []
+
+    def _done(results):
+        if options['output'] is not None:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        else:
+            print(json.dumps(results, indent=2, sort_keys=True))
+
+    def _failed(reason):
+        outcome.append(reason)
+        reason.printTraceback()
+
+    def _go():
+        runner.run(chosen, options['scale'], options['warmup'],
+                   report=_report if options['output'] else None
+            ).addCallbacks(_done, _failed
+            ).addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(_go)
+    reactor.run()
+    return 1 if outcome else 0
+
+
+def _compare(options):
+    with open(options['old']) as f:
+        old = json.load(f)
+    with open(options['new']) as f:
+        new = json.load(f)
+    rows = compare.compare(old, new, options['threshold'])
+    print(compare.format(rows))
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+def main(argv):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError as e:
+        print("%s\n%s" % (options, e))
+        return 2
+    if options.subCommand == 'run':
+        return _run(options.subOptions)
+    return _compare(options.subOptions)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,82 @@
+"""
+Compare the results of two runs of the benchmarks.
+"""
+
+# the figures compared, and whether more of them is better
+FIGURES = [
+    ('throughput', True),
+    ('p50', False),
+    ('p99', False),
+    ('p999', False),
+]
+
+# a change of a figure for the worse beyond this fraction is a regression
+THRESHOLD = 0.1
+
+
+
+def _figure(result, name):
+    if name == 'throughput':
+        return result.get('throughput')
+    return result.get('latency', {}).get(name)
+
+
+def change(old, new):
+    """
+    The relative change between two figures, L{None} if it can't be told.
+    """
+    if old is None or new is None or old == 0:
+        return None
+    return (new - old) / float(old)
+
+
+def compare(old, new, threshold=THRESHOLD):
+    """
+    Compare the scenarios two runs have in common.
+
+    @param old: the results of the run to compare against, as written
+                by L{ampoule.bench.runner.run}.
+    @param new: the results of the other run.
+    @param threshold: how much worse a figure can get before it counts
+                      as a regression.
+
+    @return: a list of C{(scenario, figure, old, new, change, regressed)}
+             tuples, C{change} being relative to C{old}.
+    """
+    rows = []
+    oldScenarios = old['scenarios']
+    newScenarios = new['scenarios']
+    for name in sorted(set(oldScenarios) & set(newScenarios)):
+        for figure, higherIsBetter in FIGURES:
+            before = _figure(oldScenarios[name], figure)
+            after = _figure(newScenarios[name], figure)
+            delta = change(before, after)
+            if delta is None:
+                regressed = False
+            elif higherIsBetter:
+                regressed = delta < -threshold
+            else:
+                regressed = delta > threshold
+            rows.append((name, figure, before, after, delta, regressed))
+    return rows
+
+
+def _number(value):
+    if value is None:
+        return '-'
+    return '%.3f' % (value,)
+
+
+def format(rows):
+    """
+    Format the rows of L{compare} as a table, regressions marked with a
+    C{!}.
+    """
+    lines = ['%-24s %-10s %14s %14s %9s' % (
+        'scenario', 'figure', 'old', 'new', 'change')]
+    for name, figure, before, after, delta, regressed in rows:
+        lines.append('%-24s %-10s %14s %14s %9s%s' % (
+            name, figure, _number(before), _number(after),
+            '-' if delta is None else '%+.1f%%' % (delta * 100,),
+            ' !' if regressed else ''))
+    return '\n'.join(lines)
@@ -0,0 +1,200 @@
+"""
+Run the scenarios of the benchmarks and collect their results.
+"""
+import math
+import os
+import platform
+import sys
+import time
+
+import twisted
+from twisted.internet import defer, endpoints
+from twisted.protocols import amp
+from twisted.python.failure import Failure
+
+import ampoule
+from ampoule import pool, service
+from ampoule.bench.scenarios import BenchChild
+
+
+# the quantiles of the latencies in the results, by their name
+QUANTILES = [('p50', 0.5), ('p99', 0.99), ('p999', 0.999)]
+
+# calls made before timing a scenario, to start and warm up the children
+WARMUP = 200
+
+clock = time.perf_counter
+
+
+
+def quantile(samples, q):
+    """
+    The nearest rank quantile of sorted samples, L{None} if there are
+    none.
+    """
+    if not samples:
+        return None
+    rank = int(math.ceil(q * len(samples))) - 1
+    return samples[max(0, min(rank, len(samples) - 1))]
+
+
+def summarize(scenario, calls, latencies, errors, seconds):
+    """
+    The results of a scenario.
+
+    @param calls: the number of calls made.
+    @param latencies: the latencies of the calls that succeeded, in
+                      seconds.
+    @param errors: the number of failed calls by the name of their error.
+    @param seconds: how long all of the calls took.
+
+    @return: a dictionary ready to be written as JSON, with times in
+             milliseconds.
+    """
+    latencies = sorted(latencies)
+    latency = {}
+    for name, q in QUANTILES:
+        value = quantile(latencies, q)
+        latency[name] = None if value is None else value * 1000
+    latency['mean'] = (sum(latencies) / len(latencies) * 1000
+                       if latencies else None)
+    latency['max'] = latencies[-1] * 1000 if latencies else None
+    return {
+        'command': scenario.command.__name__,
+        'via': scenario.via,
+        'calls': calls,
+        'concurrency': scenario.concurrency,
+        'pool': scenario.pool,
+        'errors': errors,
+        'seconds': seconds,
+        'throughput': len(latencies) / seconds if seconds else None,
+        'latency': latency,
+    }
+
+
+def _callMany(call, calls, concurrency, latencies=None, errors=None):
+    """
+    Make a number of calls with at most C{concurrency} of them in flight.
+
+    @param latencies: a list to append the latency of each call that
+                      succeeds to.
+    @param errors: a dictionary counting the failed calls by the name of
+                   their error.
+    """
+    remaining = [calls]
+
+    def _failed(reason):
+        if errors is not None:
+            name = reason.type.__name__
+            errors[name] = errors.get(name, 0) + 1
+
+    @defer.inlineCallbacks
+    def _caller():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            started = clock()
+            try:
+                yield call()
+            except Exception:
+                _failed(Failure())
+            else:
+                if latencies is not None:
+                    latencies.append(clock() - started)
+
+    return defer.gatherResults([_caller() for i in range(concurrency)])
+
+
+@defer.inlineCallbacks
+def _connect(scenario):
+    """
+    Start the pool of a scenario, and serve it over TCP if the scenario
+    goes through the service.
+
+    @return: a L{defer.Deferred} firing with the function making a call
+             and the one stopping it all.
+    """
+    from twisted.internet import reactor
+    pp = pool.ProcessPool(BenchChild, **scenario.pool)
+    if scenario.via == 'pool':
+        yield pp.start(waitReady=True)
+        defer.returnValue((
+            lambda: pp.doWork(scenario.command, **scenario.kwargs),
+            pp.stop))
+
+    svc = service.AMPouleService(pp, BenchChild, 0, '127.0.0.1')
+    svc.startService()
+    yield pp.whenReady()
+    endpoint = endpoints.TCP4ClientEndpoint(reactor, '127.0.0.1',
+                                            svc.server.getHost().port)
+    client = yield endpoints.connectProtocol(endpoint, amp.AMP())
+
+    def _stop():
+        client.transport.loseConnection()
+        return svc.stopService()
+    defer.returnValue((
+        lambda: client.callRemote(scenario.command, **scenario.kwargs),
+        _stop))
+
+
+@defer.inlineCallbacks
+def runScenario(scenario, scale=1.0, warmup=WARMUP):
+    """
+    Run a scenario.
+
+    @param scale: multiply the number of calls of the scenario by this.
+    @param warmup: the number of calls made before timing the scenario.
+
+    @return: a L{defer.Deferred} firing with the results, see
+             L{summarize}.
+    """
+    calls = max(1, int(scenario.calls * scale))
+    call, stop = yield _connect(scenario)
+    try:
+        yield _callMany(call, warmup, scenario.concurrency, errors={})
+        latencies = []
+        errors = {}
+        started = clock()
+        yield _callMany(call, calls, scenario.concurrency, latencies, errors)
+        seconds = clock() - started
+    finally:
+        yield stop()
+    defer.returnValue(summarize(scenario, calls, latencies, errors,
+                                seconds))
+
+
+def environment():
+    """
+    What the results depend on besides the code of the scenarios.
+    """
+    return {
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'twisted': twisted.__version__,
+        'ampoule': ampoule.__version__,
+    }
+
+
+@defer.inlineCallbacks
+def run(scenarios, scale=1.0, warmup=WARMUP, report=None):
+    """
+    Run scenarios one after the other.
+
+    @param report: called with the name and the results of each scenario
+                   once it's done.
+
+    @return: a L{defer.Deferred} firing with the results of the run, to
+             be written as JSON.
+    """
+    results = {}
+    for scenario in scenarios:
+        result = yield runScenario(scenario, scale, warmup)
+        results[scenario.name] = result
+        if report is not None:
+            report(scenario.name, result)
+    defer.returnValue({
+        'environment': environment(),
+        'scale': scale,
+        'scenarios': results,
+    })
@@ -0,0 +1,96 @@
+"""
+The scenarios of the benchmarks, and the child that runs them.
+"""
+import collections
+
+from twisted.protocols import amp
+
+from ampoule import child, commands
+
+
+class Spin(amp.Command):
+    """
+    Burn the CPU for C{n} iterations of a loop.
+    """
+    arguments = [(b'n', amp.Integer())]
+    response = [(b'total', amp.Integer())]
+
+
+
+class BenchChild(child.AMPChild):
+    """
+    The child of the benchmarks: L{commands.Ping} and L{commands.Echo}
+    measure the overhead of a call, L{Spin} a call that does some work.
+    """
+
+    @Spin.responder
+    def spin(self, n):
+        total = 0
+        for i in range(n):
+            total += i
+        return {'total': total}
+
+
+
+Scenario = collections.namedtuple('Scenario', [
+    'name', 'command', 'kwargs', 'calls', 'concurrency', 'via', 'pool'])
+Scenario.__doc__ = """
+A benchmark: a number of calls of the same command.
+
+@ivar name: The name of the scenario in the results.
+@ivar command: The L{amp.Command} to call.
+@ivar kwargs: The arguments of every call.
+@ivar calls: How many calls to time.
+@ivar concurrency: How many calls are in flight at any time.
+@ivar via: C{'pool'} to call L{ampoule.pool.ProcessPool.doWork}, or
+           C{'service'} to call an L{ampoule.service.AMPouleService}
+           over TCP.
+@ivar pool: The keyword arguments of the L{ampoule.pool.ProcessPool}.
+"""
+
+
+def _pool(**kwargs):
+    options = {'min': 4, 'max': 4, 'recycleAfter': 0,
+               'readyHandshake': True}
+    options.update(kwargs)
+    return options
+
+
+SCENARIOS = [
+    Scenario('ping', commands.Ping, {}, 5000, 16, 'pool', _pool()),
+    Scenario('echo-16B', commands.Echo, {'data': b'x' * 16}, 5000, 16,
+             'pool', _pool()),
+    Scenario('echo-4KiB', commands.Echo, {'data': b'x' * 4096}, 5000, 16,
+             'pool', _pool()),
+    Scenario('echo-60KiB', commands.Echo, {'data': b'x' * 60000}, 2000, 16,
+             'pool', _pool()),
+    Scenario('spin', Spin, {'n': 100000}, 1000, 16, 'pool', _pool()),
+    Scenario('ping-1-child', commands.Ping, {}, 5000, 16, 'pool',
+             _pool(min=1, max=1)),
+    Scenario('ping-16-children', commands.Ping, {}, 5000, 64, 'pool',
+             _pool(min=16, max=16)),
+    Scenario('ping-recycle-100', commands.Ping, {}, 5000, 16, 'pool',
+             _pool(recycleAfter=100)),
+    Scenario('ping-timeout', commands.Ping, {}, 5000, 16, 'pool',
+             _pool(timeout=60)),
+    # far more calls in flight than the queue takes: the ones over are
+    # shed and counted as errors
+    Scenario('ping-saturated', commands.Ping, {}, 5000, 256, 'pool',
+             _pool(maxQueue=64)),
+    Scenario('service-ping', commands.Ping, {}, 5000, 16, 'service',
+             _pool()),
+    Scenario('service-echo-4KiB', commands.Echo, {'data': b'x' * 4096},
+             5000, 16, 'service', _pool()),
+    Scenario('service-spin', Spin, {'n': 100000}, 1000, 16, 'service',
+             _pool()),
+]
+
+
+def byName(names):
+    """
+    Pick scenarios of L{SCENARIOS} by name.
+
+    @raise KeyError: if there's no scenario with one of the names.
+    """
+    scenarios = dict((scenario.name, scenario) for scenario in SCENARIOS)
+    return [scenarios[name] for name in names]
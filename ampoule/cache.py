@@ -0,0 +1,174 @@
+"""
+Parent side cache of the responses of commands that are pure functions
+of their arguments.
+"""
+import collections
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+
+
+class ResultCache(object):
+    """
+    A cache of the responses of the children of a
+    L{ampoule.pool.ProcessPool}, for the commands that opt in.
+
+    A command opts in with a C{cacheable} class attribute, and can
+    change how long its responses are kept with C{cacheTTL}::
+
+        class Render(amp.Command):
+            arguments = [(b'template', amp.String())]
+            response = [(b'html', amp.String())]
+            cacheable = True
+            cacheTTL = 300
+
+    Responses are keyed on the command and its serialized arguments,
+    the options of L{ampoule.pool.ProcessPool.doWork} like C{_timeout}
+    are not part of the key. Only successful responses are cached. The
+    least recently used responses are evicted to keep the serialized
+    size of the cache within C{maxBytes}, and a response is never used
+    after its TTL. Identical calls made while the first one is in
+    flight share its response instead of going to a child.
+
+    @ivar maxBytes: Maximum serialized size of the cached responses and
+                    their keys.
+
+    @ivar ttl: Seconds a response is kept, unless its command says
+               otherwise.
+
+    @ivar size: Current serialized size of the cache.
+
+    @ivar hits: Number of calls answered from the cache.
+
+    @ivar misses: Number of calls that went to a child.
+
+    @ivar coalesced: Number of calls that waited for an identical call
+                     in flight.
+
+    @ivar evictions: Number of responses dropped to make room for new
+                     ones.
+    """
+
+    size = 0
+    hits = 0
+    misses = 0
+    coalesced = 0
+    evictions = 0
+
+    def __init__(self, maxBytes=2 ** 26, ttl=60.0, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.clock = clock
+        # key -> (expires, size, response), least recently used first
+        self._entries = collections.OrderedDict()
+        # key -> deferreds waiting for the call in flight
+        self._pending = {}
+
+    def cacheable(self, command):
+        """
+        Check whether the responses of a command can be cached.
+        """
+        return getattr(command, 'cacheable', False)
+
+    def keyFor(self, command, kwargs):
+        """
+        Build the cache key of a call.
+
+        @param kwargs: The arguments of the call, the ones starting with
+                       an underscore are options of the pool and are
+                       left out.
+        """
+        arguments = dict((name, value) for name, value in kwargs.items()
+                         if not name.startswith('_'))
+        return (command, command.makeArguments(arguments, None).serialize())
+
+    def call(self, command, kwargs, fetch):
+        """
+        Get the response of a call from the cache, from the identical call
+        in flight or, if neither is there, by calling C{fetch}.
+
+        @param fetch: A callable returning a L{defer.Deferred} that fires
+                      with the response of the call.
+
+        @return: a L{defer.Deferred} firing with the response.
+        """
+        try:
+            key = self.keyFor(command, kwargs)
+        except Exception:
+            # let the call fail the way it would without the cache
+            return fetch()
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, size, response = entry
+            if expires > self.clock.seconds():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return defer.succeed(dict(response))
+            self._remove(key)
+
+        waiting = self._pending.get(key)
+        if waiting is not None:
+            self.coalesced += 1
+            d = defer.Deferred()
+            waiting.append(d)
+            return d
+
+        self.misses += 1
+        self._pending[key] = []
+
+        def _done(result):
+            waiting = self._pending.pop(key)
+            if isinstance(result, Failure):
+                for d in waiting:
+                    d.errback(result)
+            else:
+                self._store(key, command, result)
+                for d in waiting:
+                    d.callback(dict(result))
+            return result
+
+        return defer.maybeDeferred(fetch).addBoth(_done)
+
+    def _store(self, key, command, response):
+        """
+        Cache a response, evicting the least recently used ones if it
+        doesn't fit.
+        """
+        try:
+            size = len(key[1]) + len(
+                command.makeResponse(response, None).serialize())
+        except Exception:
+            # not something we can account for, don't keep it
+            return
+        if size > self.maxBytes:
+            return
+        ttl = getattr(command, 'cacheTTL', None)
+        if ttl is None:
+            ttl = self.ttl
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (self.clock.seconds() + ttl, size,
+                              dict(response))
+        self.size += size
+        while self.size > self.maxBytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+    def clear(self):
+        """
+        Drop every cached response.
+        """
+        self._entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
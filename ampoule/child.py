@@ -1,20 +1,107 @@
+import importlib
+import os
+import sys
+
 from twisted import logger
-from twisted.internet import error
+from twisted.internet import defer, error, threads
 from twisted.protocols import amp
-from ampoule.commands import Echo, Shutdown, Ping
+from twisted.python import threadpool
+from ampoule import codec, profiling, streaming, tracing
+from ampoule.commands import (Echo, Shutdown, Ping, Probe, Warmup,
+                              ResourceUsage, Batch, Profile, StackDump)
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
 
 
 
 log = logger.Logger()
 
 
-class AMPChild(amp.AMP):
+def _currentRSS():
+    """
+    Return the current resident set size of this process in bytes, or 0
+    if we can't tell.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return 0
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def resourceUsage():
+    """
+    Collect the resource usage of this process.
+
+    @return: a dictionary with the L{ResourceUsage} response.
+    """
+    usage = {'rss': _currentRSS(), 'maxrss': 0, 'utime': 0.0, 'stime': 0.0}
+    if resource is not None:
+        r = resource.getrusage(resource.RUSAGE_SELF)
+        # ru_maxrss is in kilobytes everywhere but on macOS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        usage['maxrss'] = r.ru_maxrss * scale
+        usage['utime'] = r.ru_utime
+        usage['stime'] = r.ru_stime
+    return usage
+
+
+def blocking(responder):
+    """
+    Mark a responder of an L{AMPChild} as blocking: it runs on the thread
+    pool of the child instead of its reactor, so that the child keeps
+    answering other calls while it runs. The arguments are parsed and the
+    response serialized on the reactor as usual::
+
+        class DBChild(AMPChild):
+            @Query.responder
+            @blocking
+            def query(self, sql):
+                return {'rows': self.connection.execute(sql).fetchall()}
+
+    The parent sends calls to a child one at a time unless the pool has
+    a C{maxConcurrentPerChild} above 1, match it with
+    L{AMPChild.maxThreads}.
+    """
+    responder.blocking = True
+    return responder
+
+
+class AMPChild(tracing.TracingAMP, codec.CodecAMP):
+    # set by the bootstrap code: when the process started and how long
+    # each step of its startup took, see ampoule.main.BOOTSTRAP
+    startupTimes = None
+
+    # modules imported when the pool warms the child up, before it gets
+    # any call
+    preload = ()
+
+    # the most threads running blocking responders at once, see blocking
+    maxThreads = 4
+
+    # the profile running, see profile
+    _profiler = None
+
+    # the pool running the blocking responders, started when one is called
+    _threadPool = None
+
     def __init__(self):
         super(AMPChild, self).__init__(self)
         self.shutdown = False
 
     def connectionLost(self, reason):
-        amp.AMP.connectionLost(self, reason)
+        codec.CodecAMP.connectionLost(self, reason)
+        streaming.connectionLost(self, reason)
+        if self._threadPool is not None and self.shutdown:
+            # let the blocking calls finish, a child going away on an
+            # error exits without waiting for them
+            self._threadPool.stop()
+            self._threadPool = None
         from twisted.internet import reactor
         try:
             reactor.stop()
@@ -30,24 +117,54 @@ class AMPChild(amp.AMP):
         if not self.shutdown:
             # if the shutdown wasn't explicit we presume that it's an
             # error condition and thus we return a -1 error returncode.
-            import os
             os._exit(-1)
 
+    def _wrapWithSerialization(self, aCallable, command):
+        if getattr(aCallable, 'blocking', False):
+            aCallable = self._inThread(aCallable)
+        return super(AMPChild, self)._wrapWithSerialization(aCallable,
+                                                            command)
+
+    def _inThread(self, aCallable):
+        """
+        Wrap a blocking responder to run it on the thread pool of the
+        child.
+        """
+        from twisted.internet import reactor
+        if self._threadPool is None:
+            self._threadPool = threadpool.ThreadPool(
+                0, self.maxThreads, 'ampoule-child-%d' % (os.getpid(),))
+            self._threadPool.start()
+
+        def inThread(**kw):
+            return threads.deferToThreadPool(reactor, self._threadPool,
+                                             aCallable, **kw)
+        return inThread
+
+    def dispatchCommand(self, box):
+        d = super(AMPChild, self).dispatchCommand(box)
+        if (self._profiler is not None and
+                not box[amp.COMMAND].startswith(b'ampoule.')):
+            # only the calls of the user count towards a profile
+            d.addBoth(self._profiler.called)
+        return d
+
     def shutdown(self):
         """
         This method is needed to shutdown the child gently without
-        generating an exception.
+        generating an exception. The answer, that closes the connection,
+        waits for the streams still going to the parent to be read.
         """
         log.info(u'Shutdown message received, goodbye.')
         self.shutdown = True
-        return {}
+        return streaming.drained(self).addCallback(lambda _: {})
     Shutdown.responder(shutdown)
 
     def ping(self):
         """
         Ping the child and return an answer
         """
-        return {'response': "pong"}
+        return {'response': b"pong"}
     Ping.responder(ping)
 
     def echo(self, data):
@@ -56,3 +173,101 @@ class AMPChild(amp.AMP):
         """
         return {'response': data}
     Echo.responder(echo)
+
+    def probe(self):
+        """
+        Let the pool know that we are up, and how long it took.
+        """
+        return dict(self.startupTimes or {})
+    Probe.responder(probe)
+
+    def warmup(self, modules):
+        """
+        Import the modules of L{preload} and the ones the pool asks for,
+        then warm the child up. Sent before the child gets any call.
+        """
+        for name in tuple(self.preload) + tuple(modules):
+            importlib.import_module(name)
+        return defer.maybeDeferred(self.warm).addCallback(lambda _: {})
+    Warmup.responder(warmup)
+
+    def warm(self):
+        """
+        Override this to build the caches or make the first calls that
+        would otherwise slow down the first calls sent to the child. It
+        can return a L{defer.Deferred}, and an error retires the child.
+        """
+
+    def resourceUsage(self):
+        """
+        Report the memory and CPU used by this child.
+        """
+        return resourceUsage()
+    ResourceUsage.responder(resourceUsage)
+
+    def profile(self, seconds=None, calls=None):
+        """
+        Profile the child for some seconds, or until it answered some
+        calls, and send back the stats.
+        """
+        if self._profiler is not None:
+            raise profiling.ProfilerBusy()
+        self._profiler = profiling.Profiler(seconds, calls)
+
+        def _done(stats):
+            self._profiler = None
+            return {'stats': stats}
+        return self._profiler.start().addCallback(_done)
+    Profile.responder(profile)
+
+    def stackDump(self):
+        """
+        Send back the current stack of every thread of the child.
+        """
+        return {'stacks': profiling.dumpStacks().encode('utf-8')}
+    StackDump.responder(stackDump)
+
+    def batch(self, command, items):
+        """
+        Run the responder of a command for every item of a batch. The
+        error of an item goes in its result and doesn't affect the
+        others.
+        """
+        responder = self.locateResponder(command)
+
+        def _error(reason):
+            box = amp.AmpBox()
+            if reason.check(amp.RemoteAmpError):
+                code = reason.value.errorCode
+                description = reason.value.description
+                if isinstance(description, str):
+                    description = description.encode("utf-8", "replace")
+            else:
+                log.failure(u'Unhandled error in batched {c}', reason,
+                            c=command)
+                code = amp.UNKNOWN_ERROR_CODE
+                description = b"Unknown Error"
+            box[amp.ERROR_CODE] = code
+            box[amp.ERROR_DESCRIPTION] = description
+            return box
+
+        l = []
+        for box in items:
+            if responder is None:
+                d = defer.fail(amp.RemoteAmpError(
+                    amp.UNHANDLED_ERROR_CODE, b"Unhandled Command: " + command))
+            else:
+                d = defer.maybeDeferred(responder, box)
+                if self._profiler is not None:
+                    d.addBoth(self._profiler.called)
+            l.append(d.addErrback(_error))
+        return defer.gatherResults(l).addCallback(
+            lambda results: {'results': results})
+    Batch.responder(batch)
+
+    def streamChunk(self, stream, data, end, error=None):
+        """
+        Receive a chunk of a L{streaming.Stream} sent by the parent.
+        """
+        return streaming.streamChunkReceived(self, stream, data, end, error)
+    streaming.StreamChunk.responder(streamChunk)
@@ -0,0 +1,373 @@
+"""
+Pluggable encodings of the boxes between a pool and its children.
+
+Commands are declared and called as usual, the codec only changes how
+their boxes are written on the pipes. The parent asks for a codec right
+after starting a child, with L{SelectCodec}, and both sides switch to
+it once the child accepted; children that don't know the codec keep
+speaking AMP::
+
+    starter = ProcessStarter(packages=("twisted",), codec=CompactCodec)
+    pp = ProcessPool(Child, starter=starter)
+
+A codec is any class providing L{ICodec}, with no arguments to its
+constructor, that can be imported by the children. Both sides of the
+connection must inherit from L{CodecAMP}: children based on
+L{ampoule.child.AMPChild} do, and so does
+L{ampoule.streaming.StreamingAMP}, the default parent protocol of a
+pool.
+
+L{CompactCodec} writes the values of a box positionally. The first box
+with a given command and set of keys, that is the first call of a
+command or the first answer to it, defines a shape with its keys; the
+following ones only carry the number of their shape and their values,
+each with a variable length prefix. Values keep the encoding of their
+L{amp.Argument}, so every argument type works with it.
+"""
+from zope.interface import implementer
+
+from twisted import logger
+from twisted.internet import defer
+from twisted.protocols import amp
+from twisted.python import reflect
+
+from ampoule.iampoule import ICodec
+
+
+
+log = logger.Logger()
+
+# shapes defined by each side of a connection, the boxes that don't fit
+# in them are sent with their keys
+MAX_SHAPES = 1024
+
+_COMMAND = amp.COMMAND
+
+
+class CodecError(Exception):
+    """
+    The bytes received can't be decoded.
+    """
+
+
+class SelectCodec(amp.Command):
+    """
+    Sent by the parent to a new child to switch their connection to
+    another codec, named by its fully qualified name. The child answers
+    in AMP, everything after the answer uses the codec if it's accepted.
+    """
+    commandName = b'ampoule.SelectCodec'
+    arguments = [(b'codec', amp.Unicode())]
+    response = [(b'accepted', amp.Boolean())]
+
+
+def _loadCodec(name):
+    """
+    Find the codec class with the given fully qualified name, or
+    L{None}.
+    """
+    try:
+        codec = reflect.namedAny(name)
+    except Exception:
+        return None
+    if not ICodec.implementedBy(codec):
+        return None
+    return codec
+
+
+_SMALL = [bytes((i,)) for i in range(0x80)]
+
+def _varint(n):
+    """
+    Encode a non negative integer 7 bits at a time, least significant
+    first, with the high bit set on all but the last byte.
+    """
+    if n < 0x80:
+        return _SMALL[n]
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _readVarint(data, offset, end):
+    """
+    Decode a L{_varint} from C{data} at C{offset}.
+
+    @return: the integer and the offset after it.
+
+    @raise IndexError: if it doesn't end before C{end}.
+    """
+    if offset >= end:
+        raise IndexError(offset)
+    b = data[offset]
+    offset += 1
+    if b < 0x80:
+        return b, offset
+    n = b & 0x7f
+    shift = 7
+    while True:
+        if offset >= end:
+            raise IndexError(offset)
+        b = data[offset]
+        offset += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, offset
+        shift += 7
+
+
+@implementer(ICodec)
+class CompactCodec(object):
+    """
+    Positional encoding of the values of a box, see the module
+    documentation.
+
+    Every box is a record prefixed by its length. A record starts with a
+    tag: 0 for a box sent with its keys, or 1 plus twice the number of
+    its shape, plus 1 if the record defines the shape. A definition has
+    the command and the keys of the shape. Then come the values, or the
+    keys and values of a box sent with its keys, each prefixed by its
+    length.
+    """
+
+    name = 'compact'
+
+    def __init__(self):
+        # (command, keys) -> shape number, for the boxes that we send
+        self._sendShapes = {}
+        # shape number -> (command, keys), for the boxes that we receive
+        self._receiveShapes = []
+        self._chunks = []
+        self._length = 0
+        self._needed = 0
+
+    def encode(self, box):
+        command = box.get(_COMMAND)
+        if command is None:
+            keys = tuple(box)
+        else:
+            keys = tuple(k for k in box if k != _COMMAND)
+        parts = []
+        shapeKey = (command, keys)
+        shape = self._sendShapes.get(shapeKey)
+        if shape is not None:
+            parts.append(_varint(shape * 2 + 1))
+        elif len(self._sendShapes) < MAX_SHAPES:
+            shape = self._sendShapes[shapeKey] = len(self._sendShapes)
+            parts.append(_varint(shape * 2 + 2))
+            command = command or b""
+            parts.append(_varint(len(command)))
+            parts.append(command)
+            parts.append(_varint(len(keys)))
+            for key in keys:
+                parts.append(_varint(len(key)))
+                parts.append(key)
+        else:
+            parts.append(_SMALL[0])
+            parts.append(_varint(len(box)))
+            for key, value in box.items():
+                parts.append(_varint(len(key)))
+                parts.append(key)
+                parts.append(_varint(len(value)))
+                parts.append(value)
+            keys = ()
+        for key in keys:
+            value = box[key]
+            parts.append(_varint(len(value)))
+            parts.append(value)
+        record = b"".join(parts)
+        return _varint(len(record)) + record
+
+    def decode(self, data):
+        self._chunks.append(data)
+        self._length += len(data)
+        if self._length < self._needed:
+            return []
+        data = b"".join(self._chunks)
+        end = len(data)
+        offset = 0
+        boxes = []
+        try:
+            while offset < end:
+                size, start = _readVarint(data, offset, end)
+                if start + size > end:
+                    self._needed = start + size - offset
+                    break
+                boxes.append(self._record(data, start, start + size))
+                offset = start + size
+            else:
+                self._needed = 0
+        except IndexError:
+            # the length prefix itself isn't all there
+            self._needed = end - offset + 1
+        rest = data[offset:]
+        self._chunks = [rest] if rest else []
+        self._length = len(rest)
+        return boxes
+
+    def _record(self, data, offset, end):
+        """
+        Decode the record of a box.
+        """
+        try:
+            tag, offset = _readVarint(data, offset, end)
+            if not tag:
+                count, offset = _readVarint(data, offset, end)
+                command = None
+                keys = []
+                values = []
+                for i in range(count):
+                    for l in keys, values:
+                        size, offset = _readVarint(data, offset, end)
+                        l.append(data[offset:offset + size])
+                        offset += size
+            else:
+                shape = (tag - 1) >> 1
+                if (tag - 1) & 1:
+                    if shape != len(self._receiveShapes):
+                        raise CodecError("unexpected shape %d" % (shape,))
+                    size, offset = _readVarint(data, offset, end)
+                    command = data[offset:offset + size] or None
+                    offset += size
+                    count, offset = _readVarint(data, offset, end)
+                    keys = []
+                    for i in range(count):
+                        size, offset = _readVarint(data, offset, end)
+                        keys.append(data[offset:offset + size])
+                        offset += size
+                    self._receiveShapes.append((command, keys))
+                elif shape < len(self._receiveShapes):
+                    command, keys = self._receiveShapes[shape]
+                else:
+                    raise CodecError("unknown shape %d" % (shape,))
+                values = []
+                for key in keys:
+                    size, offset = _readVarint(data, offset, end)
+                    values.append(data[offset:offset + size])
+                    offset += size
+        except IndexError:
+            raise CodecError("truncated record")
+        if offset != end:
+            raise CodecError("record longer than its content")
+        box = amp.AmpBox(zip(keys, values))
+        if command is not None:
+            box[_COMMAND] = command
+        return box
+
+
+class CodecAMP(amp.AMP):
+    """
+    An L{amp.AMP} protocol that can switch to another codec when asked
+    with L{SelectCodec}.
+
+    @ivar codec: The codec that encodes the boxes we send, L{None} while
+                 it's AMP.
+    """
+
+    codec = None
+    # the codec that decodes the boxes we receive
+    _decoder = None
+    # boxes sent while the parent waits for the answer to SelectCodec
+    _held = None
+    # the codec to send with after the next box, which is the answer to
+    # SelectCodec on the child side
+    _nextCodec = None
+    # the bytes received after the box that made us switch
+    _switchData = None
+
+    def sendBox(self, box):
+        if self._held is not None:
+            self._held.append(box)
+            return
+        if self.codec is None:
+            amp.AMP.sendBox(self, box)
+        elif self.transport is None:
+            raise amp.ConnectionLost()
+        else:
+            self.transport.write(self.codec.encode(box))
+        if self._nextCodec is not None:
+            self.codec, self._nextCodec = self._nextCodec, None
+
+    def dataReceived(self, data):
+        if self._decoder is None:
+            amp.AMP.dataReceived(self, data)
+            if not self._switchData:
+                self._switchData = None
+                return
+            data, self._switchData = self._switchData, None
+        try:
+            boxes = self._decoder.decode(data)
+        except Exception:
+            log.failure(u'Undecodable data from the other side')
+            self.transport.loseConnection()
+            return
+        for box in boxes:
+            self.boxReceiver.ampBoxReceived(box)
+
+    def _switchTo(self, codec):
+        """
+        Decode whatever follows the box being received with a codec.
+        """
+        self._decoder = codec
+        # like amp.BinaryBoxProtocol._switchTo, this stops the loop of
+        # Int16StringReceiver.dataReceived after the current box
+        self._switchData = self.recvd
+        self.recvd = b""
+
+    def selectCodec(self, codec):
+        """
+        Switch to the codec that the parent asks for, if we can import
+        it. The answer is the last box we send in AMP.
+        """
+        factory = _loadCodec(codec)
+        if factory is None or self._decoder is not None:
+            log.warn(u'Codec {c} refused', c=codec)
+            return {'accepted': False}
+        self._nextCodec = factory()
+        self._switchTo(self._nextCodec)
+        return {'accepted': True}
+    SelectCodec.responder(selectCodec)
+
+
+def negotiate(proto, factory):
+    """
+    Ask the other side of a connection to switch to a codec, and switch
+    too if it accepts. Nothing is sent until it answers.
+
+    @param proto: A connected L{CodecAMP}. Other protocols keep speaking
+                  AMP.
+
+    @param factory: A class providing L{ICodec}.
+
+    @return: a L{defer.Deferred} firing with whether the codec is in use.
+    """
+    if not isinstance(proto, CodecAMP):
+        log.warn(u'{p} can only speak AMP', p=proto)
+        return defer.succeed(False)
+    d = proto.callRemote(SelectCodec, codec=reflect.qual(factory))
+    proto._held = []
+
+    def _answered(result):
+        accepted = result['accepted']
+        if accepted:
+            proto.codec = factory()
+            proto._switchTo(proto.codec)
+        return accepted
+
+    def _refused(reason):
+        log.failure(u'Codec {c} not negotiated', reason, c=factory.name)
+        return False
+
+    def _release(accepted):
+        held, proto._held = proto._held, None
+        for box in held:
+            try:
+                proto.sendBox(box)
+            except amp.ConnectionLost:
+                break
+        return accepted
+
+    return d.addCallbacks(_answered, _refused).addCallback(_release)
@@ -1,4 +1,29 @@
 from twisted.protocols import amp
+from twisted.python.compat import nativeString
+
+from ampoule.profiling import ProfilerBusy
+from ampoule.streaming import Stream
+
+
+class BoxList(amp.Argument):
+    """
+    A list of L{amp.AmpBox}es. Every box goes in its own key, so the list
+    isn't bound by the size limit of a single value, only each box is.
+    """
+
+    def toBox(self, name, strings, objects, proto):
+        boxes = self.retrieve(objects, nativeString(name), proto)
+        strings[name] = b"%d" % (len(boxes),)
+        for i, box in enumerate(boxes):
+            strings[b"%s.%d" % (name, i)] = box.serialize()
+
+    def fromBox(self, name, strings, objects, proto):
+        count = int(self.retrieve(strings, name, proto))
+        boxes = []
+        for i in range(count):
+            boxes.extend(amp.parseString(strings.pop(b"%s.%d" % (name, i))))
+        objects[nativeString(name)] = boxes
+
 
 class Shutdown(amp.Command):
     responseType = amp.QuitBox
@@ -9,3 +34,72 @@ class Ping(amp.Command):
 class Echo(amp.Command):
     arguments = [(b'data', amp.String())]
     response = [(b'response', amp.String())]
+
+class Probe(amp.Command):
+    """
+    Sent by the pool to a new child, answered as soon as the child is up.
+    The name is namespaced so that it doesn't clash with user commands.
+    """
+    commandName = b'ampoule.Probe'
+    # when the child started and how long each step of its startup took,
+    # in seconds, see L{ampoule.main.BOOTSTRAP}
+    response = [(b'started', amp.Float(optional=True)),
+                (b'imports', amp.Float(optional=True)),
+                (b'reactor', amp.Float(optional=True)),
+                (b'resolve', amp.Float(optional=True)),
+                (b'enter', amp.Float(optional=True))]
+
+class Warmup(amp.Command):
+    """
+    Sent by the pool to a new child once it's up: the child imports the
+    given modules and warms up before it's given any call.
+    """
+    commandName = b'ampoule.Warmup'
+    arguments = [(b'modules', amp.ListOf(amp.Unicode()))]
+
+class ResourceUsage(amp.Command):
+    """
+    Sent by the pool to a child to know how much memory and CPU it uses.
+    Sizes are in bytes and times in seconds, the current resident set
+    size is 0 where the platform doesn't expose it.
+    """
+    commandName = b'ampoule.ResourceUsage'
+    response = [(b'rss', amp.Integer()),
+                (b'maxrss', amp.Integer()),
+                (b'utime', amp.Float()),
+                (b'stime', amp.Float())]
+
+class Batch(amp.Command):
+    """
+    Sent by the pool to a child to run a command once for every box of
+    arguments in C{items}, as if each was a call of its own. C{results}
+    has a box for every item, in the same order: either the response or
+    an error with the C{_error_code} and C{_error_description} keys of
+    AMP.
+    """
+    commandName = b'ampoule.Batch'
+    arguments = [(b'command', amp.String()),
+                 (b'items', BoxList())]
+    response = [(b'results', BoxList())]
+
+class Profile(amp.Command):
+    """
+    Sent by the pool to a child to profile it with C{cProfile} for
+    C{seconds}, or until it answered C{calls} other calls, whichever
+    comes first, see L{ampoule.profiling.Profiler} for how long it lasts
+    when they are left out. C{stats} are marshalled as by
+    L{pstats.Stats.dump_stats}.
+    """
+    commandName = b'ampoule.Profile'
+    arguments = [(b'seconds', amp.Float(optional=True)),
+                 (b'calls', amp.Integer(optional=True))]
+    response = [(b'stats', Stream())]
+    errors = {ProfilerBusy: b'PROFILER_BUSY'}
+
+class StackDump(amp.Command):
+    """
+    Sent by the pool to a child to get the current stack of each of its
+    threads, as UTF-8 text.
+    """
+    commandName = b'ampoule.StackDump'
+    response = [(b'stacks', Stream())]
@@ -1,6 +1,16 @@
-from zope.interface import Interface
+from zope.interface import Interface, Attribute
 
 class IStarter(Interface):
+    def start():
+        """
+        Get ready to start children ahead of the first of them. Children
+        can be started before it's done. L{ampoule.pool.ProcessPool}
+        calls it when it starts, if the starter has it.
+
+        @return: a L{twisted.internet.defer.Deferred} firing when the
+                 starter is ready.
+        """
+
     def startAMPProcess(ampChild, ampParent=None):
         """
         @param ampChild: The AMP protocol spoken by the created child.
@@ -22,3 +32,45 @@ class IStarter(Interface):
                  finished triggers when the subprocess dies for any reason.
         """
 
+
+class IScalingPolicy(Interface):
+    def targetSize(sample):
+        """
+        Decide how many workers the pool should have.
+
+        @param sample: The current load of the pool.
+        @type sample: L{ampoule.scaling.LoadSample}
+
+        @return: the number of workers the pool should have. The result
+                 is kept within the min and max of the pool by the
+                 caller.
+        @rtype: C{int}
+        """
+
+
+class ICodec(Interface):
+    """
+    The encoding of the boxes on a connection between a pool and one of
+    its children. A codec is created for every connection, so it can
+    keep state about what was already sent and received on it.
+    """
+
+    name = Attribute("The name of the codec, reported in logs.")
+
+    def encode(box):
+        """
+        @param box: A box to send.
+        @type box: L{twisted.protocols.amp.AmpBox}
+
+        @return: the bytes to write on the connection.
+        @rtype: C{bytes}
+        """
+
+    def decode(data):
+        """
+        @param data: Bytes received on the connection.
+        @type data: C{bytes}
+
+        @return: the boxes that were completed by C{data}, in order.
+        @rtype: C{list} of L{twisted.protocols.amp.AmpBox}
+        """
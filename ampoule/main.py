@@ -6,12 +6,11 @@ import itertools
 from zope.interface import implementer
 
 from twisted import logger
-from twisted.internet import reactor, protocol, defer, error
+from twisted.internet import protocol, defer, error
 from twisted.python import reflect
-from twisted.protocols import amp
 from twisted.python import runtime
 
-from ampoule import iampoule
+from ampoule import codec, iampoule, streaming
 
 
 
@@ -111,10 +110,22 @@ class AMPConnector(protocol.ProcessProtocol):
 
 BOOTSTRAP = """\
 import sys
+import time
+
+started = time.time()
 
 def main(reactor, ampChildPath):
+    # how long each step of the startup takes, reported to the parent
+    times = {'started': started}
+    last = [started]
+    def lap():
+        previous, last[0] = last[0], time.time()
+        return last[0] - previous
+
     from twisted.application import reactors
+    imports = lap()
     reactors.installReactor(reactor)
+    times['reactor'] = lap()
 
     from twisted import logger
     observer = logger.textFileLogObserver(sys.stderr)
@@ -128,8 +139,10 @@ def main(reactor, ampChildPath):
 
     from twisted.internet import reactor, stdio
     from twisted.python import reflect, runtime
+    times['imports'] = imports + lap()
 
     ampChild = reflect.namedAny(ampChildPath)
+    times['resolve'] = lap()
     ampChildInstance = ampChild(*sys.argv[1:-2])
     if runtime.platform.isWindows():
         stdio.StandardIO(ampChildInstance)
@@ -138,6 +151,8 @@ def main(reactor, ampChildPath):
     enter = getattr(ampChildInstance, '__enter__', None)
     if enter is not None:
         enter()
+    times['enter'] = lap()
+    ampChildInstance.startupTimes = times
     try:
         reactor.run()
     except:
@@ -160,7 +175,7 @@ class ProcessStarter(object):
     connectorFactory = AMPConnector
     def __init__(self, bootstrap=BOOTSTRAP, args=(), env={},
                  path=None, uid=None, gid=None, usePTY=0,
-                 packages=(), childReactor="select"):
+                 packages=(), childReactor="select", codec=None):
         """
         @param bootstrap: Startup code for the child process
         @type  bootstrap: C{str}
@@ -192,6 +207,10 @@ class ProcessStarter(object):
         @param childReactor: a string that sets the reactor for child
                              processes
         @type childReactor: C{str}
+
+        @param codec: if defined, the codec that the children are asked to
+                      switch to as soon as they start, see L{ampoule.codec}.
+        @type codec: a class providing L{iampoule.ICodec}
         """
         self.bootstrap = bootstrap
         self.args = args
@@ -202,6 +221,11 @@ class ProcessStarter(object):
         self.usePTY = usePTY
         self.packages = ("ampoule",) + packages
         self.childReactor = childReactor
+        self.codec = codec
+        # what every spawn needs, computed once
+        self._environmentKey = None
+        self._environment = None
+        self._childPaths = {}
 
     def __repr__(self):
         """
@@ -215,7 +239,8 @@ class ProcessStarter(object):
                                  gid=%r,
                                  usePTY=%r,
                                  packages=%r,
-                                 childReactor=%r)""" % (self.bootstrap,
+                                 childReactor=%r,
+                                 codec=%r)""" % (self.bootstrap,
                                                         self.args,
                                                         self.env,
                                                         self.path,
@@ -223,7 +248,8 @@ class ProcessStarter(object):
                                                         self.gid,
                                                         self.usePTY,
                                                         self.packages,
-                                                        self.childReactor)
+                                                        self.childReactor,
+                                                        self.codec)
 
     def _checkRoundTrip(self, obj):
         """
@@ -237,24 +263,52 @@ class ProcessStarter(object):
             raise RuntimeError("importing %r is not the same as %r" %
                                (reflect.qual(obj), obj))
 
+    def start(self):
+        """
+        Get ready to start children, there's nothing to do to run new
+        interpreters.
+
+        @return: a L{defer.Deferred} firing when children can be started.
+        """
+        return defer.succeed(None)
+
     def startAMPProcess(self, ampChild, ampParent=None, ampChildArgs=()):
         """
         @param ampChild: a L{ampoule.child.AMPChild} subclass.
         @type ampChild: L{ampoule.child.AMPChild}
 
         @param ampParent: an L{amp.AMP} subclass that implements the parent
-                          protocol for this process pool
+                          protocol for this process pool,
+                          L{streaming.StreamingAMP} by default.
         @type ampParent: L{amp.AMP}
         """
-        self._checkRoundTrip(ampChild)
-        fullPath = reflect.qual(ampChild)
+        fullPath = self._childPaths.get(ampChild)
+        if fullPath is None:
+            self._checkRoundTrip(ampChild)
+            fullPath = self._childPaths[ampChild] = reflect.qual(ampChild)
         if ampParent is None:
-            ampParent = amp.AMP
+            ampParent = streaming.StreamingAMP
         prot = self.connectorFactory(ampParent())
         args = ampChildArgs + (self.childReactor, fullPath)
-        return self.startPythonProcess(prot, *args)
+        result = self.startPythonProcess(prot, *args)
+        if self.codec is not None:
+            # the calls made meanwhile wait for the answer
+            codec.negotiate(prot.amp, self.codec)
+        return result
 
 
+    def environment(self):
+        """
+        The environment of the children: L{self.env} with a C{PYTHONPATH}
+        that makes L{self.packages} importable. It's computed again only
+        when either of them changes.
+        """
+        key = (sorted(self.env.items()), self.packages)
+        if key != self._environmentKey:
+            self._environment = spawnEnvironment(self.env, self.packages)
+            self._environmentKey = key
+        return self._environment
+
     def startPythonProcess(self, prot, *args):
         """
         @param prot: a L{protocol.ProcessProtocol} subclass
@@ -266,9 +320,8 @@ class ProcessStarter(object):
         @return: a tuple of the child process and the deferred finished.
                  finished triggers when the subprocess dies for any reason.
         """
-        spawnProcess(prot, self.bootstrap, self.args+args, env=self.env,
-                     path=self.path, uid=self.uid, gid=self.gid,
-                     usePTY=self.usePTY, packages=self.packages)
+        _spawn(prot, self.bootstrap, self.args+args, self.environment(),
+               self.path, self.uid, self.gid, self.usePTY)
 
         # XXX: we could wait for startup here, but ... is there really any
         # reason to?  the pipe should be ready for writing.  The subprocess
@@ -277,9 +330,11 @@ class ProcessStarter(object):
         # synchronous.
         return prot.amp, prot.finished
 
-def spawnProcess(processProtocol, bootstrap, args=(), env={},
-                 path=None, uid=None, gid=None, usePTY=0,
-                 packages=()):
+def spawnEnvironment(env, packages):
+    """
+    Compute the environment of a child: a copy of C{env} with a
+    C{PYTHONPATH} that makes C{packages} importable.
+    """
     env = env.copy()
 
     pythonpath = []
@@ -291,6 +346,18 @@ def spawnProcess(processProtocol, bootstrap, args=(), env={},
     pythonpath = list(set(pythonpath))
     pythonpath.extend(env.get('PYTHONPATH', '').split(os.pathsep))
     env['PYTHONPATH'] = os.pathsep.join(pythonpath)
+    return env
+
+def spawnProcess(processProtocol, bootstrap, args=(), env={},
+                 path=None, uid=None, gid=None, usePTY=0,
+                 packages=(), childFDs=None):
+    return _spawn(processProtocol, bootstrap, args,
+                  spawnEnvironment(env, packages), path, uid, gid, usePTY,
+                  childFDs)
+
+def _spawn(processProtocol, bootstrap, args, env, path, uid, gid, usePTY,
+           childFDs=None):
+    from twisted.internet import reactor
     args = (sys.executable, '-c', bootstrap) + args
     # childFDs variable is needed because sometimes child processes
     # misbehave and use stdout to output stuff that should really go
@@ -298,10 +365,12 @@ def spawnProcess(processProtocol, bootstrap, args=(), env={},
     # that I'm using here, 3 and 4, so we are going to fix all these
     # issues when I add support for the configuration object that can
     # fix this stuff in a more configurable way.
+    if childFDs is None:
+        childFDs = {0:"w", 1:"r", 2:"r", 3:"w", 4:"r"}
     if IS_WINDOWS:
         return reactor.spawnProcess(processProtocol, sys.executable, args,
                                     env, path, uid, gid, usePTY)
     else:
         return reactor.spawnProcess(processProtocol, sys.executable, args,
                                     env, path, uid, gid, usePTY,
-                                    childFDs={0:"w", 1:"r", 2:"r", 3:"w", 4:"r"})
+                                    childFDs=childFDs)
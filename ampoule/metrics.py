@@ -0,0 +1,159 @@
+"""
+Counters, gauges and latency histograms of a L{ampoule.pool.ProcessPool}.
+"""
+import bisect
+
+
+# upper bounds in seconds of the buckets of the latency histograms
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+INFINITY = float('inf')
+
+
+
+class Histogram(object):
+    """
+    The distribution of a latency, as the number of samples that fall
+    in each of a few fixed buckets. Recording a sample costs a binary
+    search, whatever the number of samples.
+
+    @ivar bounds: The upper bounds of the buckets, in increasing order.
+                  Samples above the last bound go in an extra bucket.
+
+    @ivar counts: The number of samples in each bucket, not cumulative.
+
+    @ivar count: The number of samples.
+
+    @ivar sum: The sum of the samples.
+
+    @ivar max: The largest sample.
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value, n=1):
+        """
+        Record C{n} samples of the given value.
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += n
+        self.count += n
+        self.sum += value * n
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Estimate a quantile of the samples, interpolating linearly within
+        the bucket it falls in.
+
+        @param q: The quantile, between 0 and 1.
+
+        @return: The estimate, 0 if there are no samples.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for i, n in enumerate(self.counts):
+            upper = self.bounds[i] if i < len(self.bounds) else self.max
+            upper = min(upper, self.max)
+            if n and seen + n >= rank:
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = upper
+        return self.max
+
+    def snapshot(self):
+        """
+        Copy the histogram.
+
+        @return: a dictionary with the C{count}, C{sum} and C{max} of the
+                 samples and the cumulative C{buckets}, as a list of
+                 C{(upperBound, samples)} ending with an infinite bound.
+        """
+        buckets = []
+        seen = 0
+        for bound, n in zip(self.bounds + (INFINITY,), self.counts):
+            seen += n
+            buckets.append((bound, seen))
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'buckets': buckets}
+
+
+
+class Metrics(object):
+    """
+    The metrics of a pool: counters that only go up, gauges read when
+    needed, and latency histograms for the whole pool and each command.
+
+    Counters and histograms are updated on the path of every call, so
+    they are plain numbers and lists. Gauges are callables read only by
+    L{snapshot}.
+
+    @ivar counters: A dictionary mapping the name of each counter to its
+                    value.
+
+    @ivar histograms: A dictionary mapping the name of each histogram to
+                      a dictionary mapping the name of a command to its
+                      L{Histogram}, L{None} for all of them.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._gauges = {}
+
+    def increment(self, name, n=1):
+        """
+        Add C{n} to a counter.
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value, command=None, n=1):
+        """
+        Record C{n} samples in a histogram, for the whole pool and for
+        the given command name if any.
+        """
+        byCommand = self.histograms.get(name)
+        if byCommand is None:
+            byCommand = self.histograms[name] = {None: Histogram()}
+        byCommand[None].observe(value, n)
+        if command is not None:
+            histogram = byCommand.get(command)
+            if histogram is None:
+                histogram = byCommand[command] = Histogram()
+            histogram.observe(value, n)
+
+    def gauge(self, name, read):
+        """
+        Add a gauge.
+
+        @param read: A callable without arguments returning the value of
+                     the gauge.
+        """
+        self._gauges[name] = read
+
+    def snapshot(self):
+        """
+        Copy the metrics, the copy doesn't change with them.
+
+        @return: a dictionary with the C{counters} and C{gauges} by name,
+                 and the C{histograms} by name and command as in
+                 L{histograms}, each one a L{Histogram.snapshot}.
+        """
+        return {
+            'counters': dict(self.counters),
+            'gauges': dict((name, read())
+                           for name, read in self._gauges.items()),
+            'histograms': dict(
+                (name, dict((command, histogram.snapshot())
+                            for command, histogram in byCommand.items()))
+                for name, byCommand in self.histograms.items()),
+        }
@@ -5,15 +5,18 @@ import itertools
 import functools
 import signal
 choice = random.choice
+uniform = random.uniform
 now = time.time
 count = functools.partial(next, itertools.count())
 pop = heapq.heappop
+push = heapq.heappush
 
 from twisted import logger
 from twisted.internet import defer, task, error
+from twisted.protocols import amp
 from twisted.python.failure import Failure
 
-from ampoule import commands, main
+from ampoule import commands, main, metrics, profiling, sharedmem, tracing
 
 
 
@@ -21,14 +24,382 @@ log = logger.Logger()
 
 
 STATS_TEMPLATE = u"""ProcessPool stats:
-    workers:       {w}
+    workers:       {w} ({ready} ready, {busy} busy, {starting} starting)
+    queued:        {queued}
+    calls:         {calls} ({failed} failed, {shed} shed, {expired} expired)
+    timeouts:      {timeouts}
+    crashes:       {crashes}
+    recycles:      {recycles}
+    spawns:        {spawns} (p50 {spawn50}, p99 {spawn99})
     timeout:       {t}
     parent:        {p}
     child:         {c}
     max idle:      {i}
     recycle after: {r}
+    jitter:        {j}
+    concurrency:   {m}
+    max queue:     {q}
+    max wait:      {W}
+    affinity wait: {A}
     ProcessStarter:
-                   {s}"""
+                   {s}
+    latencies:{l}"""
+
+# one line of latencies in STATS_TEMPLATE
+LATENCY_TEMPLATE = (u"\n        {command}: {count} calls, wait p50 {wait50} "
+                    u"p99 {wait99}, run p50 {run50} p99 {run99}")
+
+
+POOL_OVERLOADED = b"POOL_OVERLOADED"
+
+# the steps of the startup of a child, as answered to commands.Probe
+_STARTUP_STEPS = ('imports', 'reactor', 'resolve', 'enter')
+
+# seconds before replacing a child whose warm-up failed, doubled with
+# every failure in a row up to the maximum
+WARMUP_BACKOFF = 0.5
+MAX_WARMUP_BACKOFF = 30.0
+
+
+class PoolOverloaded(Exception):
+    """
+    The pool can't take this call: its queue is full or the call would
+    wait in it for longer than allowed.
+
+    Remote clients of L{ampoule.service.AMPouleService} get this error
+    back as an AMP error with code L{POOL_OVERLOADED}, they can map it
+    back to this exception by adding it to the C{errors} of their
+    commands::
+
+        class MyCommand(amp.Command):
+            errors = {PoolOverloaded: POOL_OVERLOADED}
+
+    @ivar retryAfter: Suggested number of seconds to wait before trying
+                      the call again.
+    """
+
+    def __init__(self, retryAfter):
+        # retryAfter can be the description of the error on the wire
+        retryAfter = float(retryAfter)
+        Exception.__init__(self, retryAfter)
+        self.retryAfter = retryAfter
+
+    def __str__(self):
+        return repr(self.retryAfter)
+
+
+class DeadlineExpired(Exception):
+    """
+    A call missed its deadline while waiting in the queue of a
+    L{ProcessPool}, so it was never sent to a child.
+    """
+
+
+class WarmupFailed(Exception):
+    """
+    The new children of a L{ProcessPool} failed their warm-up too many
+    times in a row, so the workers waited for aren't coming.
+    """
+
+
+class PriorityStats(object):
+    """
+    Queueing counters for one priority class of a L{ProcessPool}.
+
+    @ivar depth: Number of calls of this priority waiting in the queue.
+
+    @ivar queued: Number of calls of this priority that had to wait in
+                  the queue.
+
+    @ivar dispatched: Number of calls of this priority sent to a child,
+                      including the ones that didn't wait at all.
+
+    @ivar totalWait: Seconds spent in the queue by all the dispatched
+                     calls of this priority.
+
+    @ivar maxWait: Longest time in seconds a call of this priority spent
+                   in the queue.
+
+    @ivar shed: Number of calls of this priority refused or dropped from
+                the queue with L{PoolOverloaded}.
+
+    @ivar expired: Number of calls of this priority dropped from the
+                   queue with L{DeadlineExpired}.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.queued = 0
+        self.dispatched = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+        self.shed = 0
+        self.expired = 0
+
+    def averageWait(self):
+        """
+        Average time in seconds a dispatched call spent in the queue.
+        """
+        if not self.dispatched:
+            return 0.0
+        return self.totalWait / self.dispatched
+
+    def __repr__(self):
+        return ("PriorityStats(depth=%r, queued=%r, dispatched=%r, "
+                "totalWait=%r, maxWait=%r, shed=%r, expired=%r)" % (
+                    self.depth, self.queued, self.dispatched,
+                    self.totalWait, self.maxWait, self.shed, self.expired))
+
+
+class _QueuedCall(object):
+    """
+    A call waiting in the queue of a L{ProcessPool} for a child.
+    """
+
+    expiry = None
+
+    def __init__(self, d, command, kwargs, priority, enqueued,
+                 deadline=None, affinity=None):
+        self.d = d
+        self.command = command
+        self.kwargs = kwargs
+        self.priority = priority
+        self.enqueued = enqueued
+        self.deadline = deadline
+        self.affinity = affinity
+
+    def cancelExpiry(self):
+        if self.expiry is not None and self.expiry.active():
+            self.expiry.cancel()
+
+
+class _Chunk(object):
+    """
+    A run of calls of the same command that a L{ProcessPool} sends to a
+    single child in one go, as one entry of its queue.
+
+    @ivar died: L{True} if the child died while running the calls.
+    """
+
+    died = False
+
+    def __init__(self, command, items):
+        self.command = command
+        self.items = items
+
+    def __len__(self):
+        return len(self.items)
+
+    def sendTo(self, child):
+        """
+        Send all the calls to the child.
+
+        The boxes are written back to back in the same reactor iteration,
+        so they leave as a single write and the child reads them as one
+        sequence.
+
+        @return: a L{defer.Deferred} firing with a list of (success,
+                 result) tuples, one per call.
+        """
+        def _failed(reason):
+            if reason.check(error.ProcessTerminated):
+                self.died = True
+            return reason
+
+        return defer.DeferredList(
+            [defer.maybeDeferred(child.callRemote, self.command, **kwargs
+                ).addErrback(_failed)
+             for kwargs in self.items],
+            consumeErrors=True)
+
+
+class _Batch(_Chunk):
+    """
+    A run of calls of the same command that a L{ProcessPool} sends to a
+    single child as one L{commands.Batch} call.
+    """
+
+    def sendTo(self, child):
+        """
+        Send all the calls to the child in a single box.
+
+        @return: a L{defer.Deferred} firing with a list of (success,
+                 result) tuples, one per call, or failing if the batch
+                 as a whole failed.
+        """
+        command = self.command
+        results = [None] * len(self.items)
+        boxes = []
+        sent = []
+        for i, kwargs in enumerate(self.items):
+            try:
+                boxes.append(command.makeArguments(kwargs, child))
+            except:
+                results[i] = (False, Failure())
+            else:
+                sent.append(i)
+
+        def _parse(response):
+            for i, box in zip(sent, response['results']):
+                if amp.ERROR_CODE in box:
+                    errorType = command.reverseErrors.get(
+                        box[amp.ERROR_CODE], amp.UnknownRemoteError)
+                    results[i] = (False, Failure(
+                        errorType(box[amp.ERROR_DESCRIPTION])))
+                    continue
+                try:
+                    results[i] = (True, command.parseResponse(box, child))
+                except:
+                    results[i] = (False, Failure())
+            return results
+
+        if not boxes:
+            return defer.succeed(results)
+        return defer.maybeDeferred(child.callRemote, commands.Batch,
+                                   command=command.commandName, items=boxes
+            ).addCallback(_parse)
+
+
+def _callCount(command):
+    """
+    The number of calls that a command sent to a child stands for.
+    """
+    if isinstance(command, _Chunk):
+        return len(command)
+    return 1
+
+
+def _commandName(command):
+    """
+    The name of a command sent to a child, as shown in the metrics.
+    """
+    if isinstance(command, _Chunk):
+        command = command.command
+    return command.commandName.decode('ascii', 'replace')
+
+
+class _Mapper(object):
+    """
+    Run a command over the items of an iterable in a L{ProcessPool},
+    a chunk of items at a time, and deliver the responses to a callback.
+
+    Items are taken from the iterable only when there's room for a new
+    chunk in flight, and in ordered mode a chunk stays in flight until
+    its responses are delivered, so the memory used doesn't depend on
+    the number of items.
+    """
+
+    def __init__(self, pool, command, items, callback, chunkSize,
+                 maxChunks, ordered, options):
+        self.pool = pool
+        self.command = command
+        self.items = iter(items)
+        self.callback = callback
+        self.chunkSize = chunkSize
+        self.maxChunks = maxChunks
+        self.ordered = ordered
+        self.options = options
+        self.done = defer.Deferred()
+        self.delivering = defer.succeed(None)
+        self.failure = None
+        self.exhausted = False
+        # chunks sent and not delivered yet
+        self.inflight = 0
+        self.sent = 0
+        self.delivered = 0
+        self.count = 0
+        # responses of the chunks that came back before the previous
+        # ones, by chunk index
+        self.waiting = {}
+
+    def start(self):
+        self._fill()
+        return self.done
+
+    def _fill(self):
+        """
+        Send new chunks until the window is full or the items are over.
+        """
+        while (self.failure is None and not self.exhausted and
+               self.inflight < self.maxChunks):
+            try:
+                items = list(itertools.islice(self.items, self.chunkSize))
+            except:
+                self._fail(Failure())
+                return
+            if not items:
+                self.exhausted = True
+                break
+            index = self.sent
+            self.sent += 1
+            self.inflight += 1
+            self.pool.doWork(_Chunk(self.command, items), **self.options
+                ).addCallbacks(self._returned, self._fail,
+                               callbackArgs=(index,))
+        if (self.exhausted and not self.inflight and
+                self.failure is None and not self.done.called):
+            self.done.callback(self.count)
+
+    def _returned(self, results, index):
+        if self.failure is not None:
+            return
+        if not self.ordered:
+            self._deliver(results)
+            return
+        self.waiting[index] = results
+        while self.delivered in self.waiting:
+            self._deliver(self.waiting.pop(self.delivered))
+            self.delivered += 1
+
+    def _deliver(self, results):
+        """
+        Hand the responses of a chunk to the callback, once the previous
+        chunks are done with it.
+        """
+        def _each(_):
+            if self.failure is not None:
+                return
+            l = []
+            for success, result in results:
+                if not success:
+                    return result
+                l.append(defer.maybeDeferred(self.callback, result))
+            return defer.gatherResults(l, consumeErrors=True)
+
+        def _delivered(_):
+            self.count += len(results)
+            self.inflight -= 1
+            self._fill()
+
+        def _failed(reason):
+            if reason.check(defer.FirstError):
+                reason = reason.value.subFailure
+            self._fail(reason)
+
+        self.delivering.addCallback(_each
+            ).addCallbacks(_delivered, _failed)
+
+    def _fail(self, reason):
+        """
+        Stop sending chunks and fail with the first error we got.
+        """
+        if self.failure is None:
+            self.failure = reason
+            self.done.errback(reason)
+
+
+_MASK64 = 2 ** 64 - 1
+
+
+def _rendezvousWeight(keyHash, slot):
+    """
+    The weight of a slot for a key in rendezvous hashing: a 64 bits mix
+    of the two, so that every slot is equally likely to weigh the most.
+    """
+    x = (keyHash ^ (slot * 0x9E3779B97F4A7C15)) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
 
 
 try:
@@ -43,6 +414,19 @@ class ProcessPool(object):
     This class generalizes the functionality of a pool of
     processes to which work can be dispatched.
 
+    Commands can opt in to micro-batching with a C{batchWindow} class
+    attribute: their calls are then gathered for up to C{batchWindow}
+    seconds, or until there are C{batchSize} of them (100 by default),
+    and sent to a single child as one L{commands.Batch} call. The child
+    runs the usual responder for each call and every call gets its own
+    response or error::
+
+        class Lookup(amp.Command):
+            arguments = [(b'key', amp.String())]
+            response = [(b'value', amp.String())]
+            batchWindow = 0.002
+            batchSize = 200
+
     @ivar finished: Boolean flag, L{True} when the pool is finished.
 
     @ivar started: Boolean flag, L{True} when the pool is started.
@@ -61,6 +445,33 @@ class ProcessPool(object):
     @ivar recycleAfter: Maximum number of calls before restarting a
                         subprocess, 0 to not recycle.
 
+    @ivar recycleJitter: Fraction by which the recycleAfter threshold of
+                         each child is randomly moved up or down, so that
+                         children started together are not recycled all
+                         at the same time.
+
+    @ivar makeBeforeBreak: If L{True} a child that reaches its recycling
+                           threshold keeps serving calls until its
+                           replacement is up, and only then it is
+                           retired. The pool goes over C{max} by the
+                           number of replacements being started.
+
+    @ivar maxChildMemory: Maximum resident set size in bytes of a child.
+                          A child found over it is retired once its
+                          calls in flight are done, like when it
+                          reaches recycleAfter. L{None} to not check.
+
+    @ivar memoryCheckInterval: Seconds between two checks of the resource
+                               usage of the children.
+
+    @ivar childUsage: A dictionary mapping each child to the last
+                      L{commands.ResourceUsage} it reported.
+
+    @ivar maxConcurrentRecycles: Maximum number of children that can be
+                                 recycled at the same time, L{None} for
+                                 no limit. A child over its threshold
+                                 keeps serving calls until its turn comes.
+
     @ivar ampChild: The child AMP protocol subclass with the commands
                     that the child should implement.
 
@@ -69,15 +480,152 @@ class ProcessPool(object):
 
     @ivar timeout: The general timeout (in seconds) for every child
                     process call.
+
+    @ivar maxConcurrentPerChild: Maximum number of calls that can be in
+                                 flight on a single child at the same
+                                 time. AMP multiplexes calls on the
+                                 same connection so children whose
+                                 responders return Deferreds, or are
+                                 L{ampoule.child.blocking}, can serve
+                                 several calls at once.
+
+    @ivar priorityAging: Seconds of head start in the queue that each
+                         priority level gives to a call. A call with
+                         priority 2 is served before a call with
+                         priority 0 only if it was queued less than
+                         2 * priorityAging seconds after it, so low
+                         priority calls can't starve. Within a
+                         priority, a call with a deadline is served
+                         before the oldest call only if it was queued
+                         less than priorityAging seconds after it, see
+                         L{_enqueue}.
+
+    @ivar expired: Number of calls dropped from the queue because they
+                   missed their deadline.
+
+    @ivar priorityStats: A dictionary mapping each priority seen by the
+                         pool to its L{PriorityStats}.
+
+    @ivar maxQueue: Maximum number of calls waiting for a child, calls
+                    beyond it fail with L{PoolOverloaded}. L{None} for
+                    no limit.
+
+    @ivar maxQueueWait: Maximum number of seconds a call can wait for a
+                        child before failing with L{PoolOverloaded}.
+                        Calls that are expected to wait longer than
+                        this fail straight away. L{None} for no limit.
+
+    @ivar serviceTime: Exponentially weighted moving average of the
+                       time in seconds a call takes in a child, L{None}
+                       until a call completes.
+
+    @ivar scaler: Optional L{ampoule.scaling.ScalingController} that
+                  decides the size of the pool from its load. When set
+                  it replaces the idle pruning loop and the growth of
+                  the pool on the request path.
+
+    @ivar arrivals: Number of calls received by the pool so far.
+
+    @ivar spawnLatency: Exponentially weighted moving average of the
+                        time in seconds between starting a child and
+                        its first answer, L{None} until a child answers.
+
+    @ivar starting: The set of children that haven't answered yet.
+
+    @ivar readyHandshake: If L{True} a new child gets calls only once it
+                          answered the L{commands.Probe} sent to it when
+                          it was started. Children read their first call
+                          only after C{__enter__} and once their reactor
+                          runs, so the answer means that they are ready
+                          to serve calls.
+
+    @ivar readyTimes: A dictionary mapping each child that is up to the
+                      number of seconds it took between its spawn and
+                      its first answer, or the end of its warm-up if
+                      the pool warms its children up.
+
+    @ivar preload: Names of the modules that every new child imports
+                   before it gets any call, on top of the C{preload} of
+                   the child class.
+
+    @ivar warmup: A sequence of C{(command, kwargs)} called in order on
+                  every new child after C{preload} and the C{warm}
+                  method of the child class, before it gets any other
+                  call. A child whose warm-up fails is retired and
+                  replaced, it never serves calls. Setting C{preload} or
+                  C{warmup} turns on C{readyHandshake}.
+
+    @ivar maxWarmupFailures: Number of warm-ups in a row that can fail
+                             before the L{whenReady} waiters fail with
+                             L{WarmupFailed}. Children keep being
+                             replaced, after L{WARMUP_BACKOFF} seconds
+                             doubled with each failure in a row.
+
+    @ivar startupTimes: A dictionary mapping each child that is up to how
+                        long the steps of its startup took in seconds:
+                        C{exec} until the interpreter ran, then
+                        C{imports}, C{reactor}, C{resolve} for finding
+                        the child class and C{enter} for creating it and
+                        calling its C{__enter__}. Children that don't
+                        report them aren't in it.
+
+    @ivar affinityWait: Seconds a call with an C{_affinity} key waits
+                        for its preferred child before it's given to any
+                        child that can take it.
+
+    @ivar affinityHits: Number of calls with an C{_affinity} key sent to
+                        their preferred child.
+
+    @ivar affinityMisses: Number of calls with an C{_affinity} key sent
+                          to another child.
+
+    @ivar resultCache: Optional L{ampoule.cache.ResultCache} that
+                       answers the calls of cacheable commands without
+                       going to a child when it can.
+
+    @ivar metrics: The L{ampoule.metrics.Metrics} of the pool. Its
+                   counters are C{calls}, C{completed}, C{failed},
+                   C{shed}, C{expired}, C{timeouts}, C{crashes},
+                   C{recycles}, C{spawns} and C{warmupFailures}. Its
+                   histograms, by command, are C{queueWait},
+                   C{execution} and C{spawn}, in seconds. Its gauges
+                   are the number of C{workers} and of those C{ready},
+                   C{busy}, C{starting} and C{retiring}, the calls
+                   C{queued} and C{inflight}, and the averages
+                   C{serviceTime} and C{spawnLatency}.
+
+    @ivar tracer: Optional callable that gets a L{tracing.CallTrace} for
+                  every call sent to a child on its own, once it's
+                  done. Calls aren't stamped while it's L{None}.
+
+    @ivar ready: The set of children that can accept another call.
+
+    @ivar busy: The set of children with at least one call in flight.
     """
 
     finished = False
     started = False
     name = None
+    serviceTime = None
+    spawnLatency = None
+    expired = 0
+    arrivals = 0
+    affinityHits = 0
+    affinityMisses = 0
+
+    # weight of the latest sample in the serviceTime average
+    _serviceTimeWeight = 0.2
 
     def __init__(self, ampChild=None, ampParent=None, min=5, max=20,
                  name=None, maxIdle=20, recycleAfter=500, starter=None,
-                 timeout=None, timeout_signal=DIE, ampChildArgs=()):
+                 timeout=None, timeout_signal=DIE, ampChildArgs=(),
+                 maxConcurrentPerChild=1, priorityAging=1.0,
+                 maxQueue=None, maxQueueWait=None, scaler=None,
+                 readyHandshake=False, recycleJitter=0.0,
+                 makeBeforeBreak=False, maxConcurrentRecycles=None,
+                 maxChildMemory=None, memoryCheckInterval=5.0,
+                 affinityWait=0.1, resultCache=None, preload=(),
+                 warmup=(), tracer=None, maxWarmupFailures=3):
         self.starter = starter
         self.ampChildArgs = tuple(ampChildArgs)
         if starter is None:
@@ -92,9 +640,37 @@ class ProcessPool(object):
         self.name = name
         self.maxIdle = maxIdle
         self.recycleAfter = recycleAfter
+        self.recycleJitter = recycleJitter
+        self.makeBeforeBreak = makeBeforeBreak
+        self.maxConcurrentRecycles = maxConcurrentRecycles
+        self.maxChildMemory = maxChildMemory
+        self.memoryCheckInterval = memoryCheckInterval
+        self.childUsage = {}
+        # children that didn't answer the last check of their usage yet
+        self._usageChecks = set()
+        self.memoryLooping = task.LoopingCall(self._checkMemory)
         self.timeout = timeout
         self.timeout_signal = timeout_signal
+        assert maxConcurrentPerChild >= 1, 'maxConcurrentPerChild must be positive'
+        self.maxConcurrentPerChild = maxConcurrentPerChild
+        self.priorityAging = priorityAging
+        self.priorityStats = {}
+        self.maxQueue = maxQueue
+        self.maxQueueWait = maxQueueWait
         self._queue = []
+        # priority -> heap of the queued calls with a deadline
+        self._deadlines = {}
+        self._queueDepth = 0
+        self.affinityWait = affinityWait
+        self.resultCache = resultCache
+        self.tracer = tracer
+        self._batches = {}
+        self._batchTimers = {}
+        self._parked = {}
+        self._slots = {}
+        self._vacated = []
+        self._pids = {}
+        self._upAt = {}
 
         self.processes = set()
         self.ready = set()
@@ -102,21 +678,73 @@ class ProcessPool(object):
         self._finishCallbacks = {}
         self._lastUsage = {}
         self._calls = {}
+        self._inflight = {}
+        self._retiring = set()
+        self._recycleFactor = {}
+        self._recycling = set()
+        self._replacementOf = {}
+        self._superseded = set()
+        # children to stop without replacing them once their calls in
+        # flight are done, see stopAWorker
+        self._stopping = set()
+        self.starting = set()
+        self.preload = tuple(preload)
+        self.warmup = tuple(warmup)
+        self.maxWarmupFailures = maxWarmupFailures
+        # warm-ups failed in a row, and the replacements waiting for
+        # their backoff
+        self._warmupFailures = 0
+        self._respawns = set()
+        # a child that isn't warm yet mustn't get calls
+        self.readyHandshake = readyHandshake or bool(preload or warmup)
+        self.readyTimes = {}
+        self.startupTimes = {}
+        self._readyWaiters = []
+        self.metrics = metrics.Metrics()
+        for name, read in [
+                ('workers', lambda: len(self.processes)),
+                ('ready', lambda: len(self.ready)),
+                ('busy', lambda: len(self.busy)),
+                ('starting', lambda: len(self.starting)),
+                ('retiring', lambda: len(self._retiring)),
+                ('queued', lambda: self._queueDepth),
+                ('inflight', lambda: sum(self._inflight.values())),
+                ('serviceTime', lambda: self.serviceTime),
+                ('spawnLatency', lambda: self.spawnLatency)]:
+            self.metrics.gauge(name, read)
+        self.scaler = scaler
         self.looping = task.LoopingCall(self._pruneProcesses)
-        self.looping.start(maxIdle, now=False)
+        if scaler is None:
+            self.looping.start(maxIdle, now=False)
+        else:
+            scaler.attach(self)
 
-    def start(self, ampChild=None):
+    def start(self, ampChild=None, waitReady=False):
         """
         Starts the ProcessPool with a given child protocol.
 
         @param ampChild: a L{ampoule.child.AMPChild} subclass.
         @type ampChild: L{ampoule.child.AMPChild} subclass
+
+        @param waitReady: If L{True} the returned deferred fires only when
+                          at least C{min} workers are up, or fails with
+                          L{WarmupFailed}.
+        @type waitReady: C{bool}
         """
         if ampChild is not None and not self.started:
             self.ampChild = ampChild
         self.finished = False
         self.started = True
-        return self.adjustPoolSize()
+        if self.scaler is not None:
+            self.scaler.start()
+        if self.maxChildMemory is not None and not self.memoryLooping.running:
+            self.memoryLooping.start(self.memoryCheckInterval, now=False)
+        # the children started in the meantime wait for the starter
+        startStarter = getattr(self.starter, 'start', None)
+        if startStarter is not None:
+            startStarter().addErrback(
+                lambda f: log.failure(u'Starter failed to start', f))
+        return self.adjustPoolSize(waitReady=waitReady)
 
     def _pruneProcesses(self):
         """
@@ -124,17 +752,57 @@ class ProcessPool(object):
         """
         n = now()
         d = []
-        for child, lastUse in self._lastUsage.items():
+        for child, lastUse in list(self._lastUsage.items()):
             if len(self.processes) > self.min and (n - lastUse) > self.maxIdle:
                 # we are setting lastUse when processing finishes, it
-                # might be processing right now
-                if child not in self.busy:
-                    # we need to remove this child from the ready set
-                    # and the processes set because otherwise it might
-                    # get calls from doWork
-                    self.ready.discard(child)
-                    self.processes.discard(child)
-                    d.append(self.stopAWorker(child))
+                # might be processing right now or it might be already
+                # on its way out.
+                if self._isIdle(child):
+                    d.append(self._stopIdleWorker(child))
+        return defer.DeferredList(d)
+
+    def _isIdle(self, child):
+        """
+        Check whether a child is in rotation without any call in flight.
+        """
+        return self._inflight.get(child) == 0 and child not in self._retiring
+
+    def _stopIdleWorker(self, child):
+        """
+        Stop an idle child without replacing it.
+        """
+        # we need to remove this child from the ready set
+        # and the processes set because otherwise it might
+        # get calls from doWork
+        self.ready.discard(child)
+        self.processes.discard(child)
+        self._inflight.pop(child, None)
+        return self.stopAWorker(child)
+
+    def growTo(self, size):
+        """
+        Start workers until the pool has at least C{size} of them, but
+        never more than C{max}.
+        """
+        while len(self.processes) < min(size, self.max) and not self.finished:
+            self.startAWorker()
+
+    def shrinkTo(self, size):
+        """
+        Stop idle workers until the pool has no more than C{size} of them,
+        but never less than C{min}. Workers with calls in flight are left
+        alone.
+
+        @return: a L{defer.DeferredList} firing when the stopped workers
+                 are gone.
+        """
+        size = max(size, self.min)
+        d = []
+        for child in sorted(self.ready, key=self._lastUsage.get):
+            if len(self.processes) <= size:
+                break
+            if self._isIdle(child):
+                d.append(self._stopIdleWorker(child))
         return defer.DeferredList(d)
 
     def _pruneProcess(self, child):
@@ -144,15 +812,39 @@ class ProcessPool(object):
         self.processes.discard(child)
         self.ready.discard(child)
         self.busy.discard(child)
+        self._retiring.discard(child)
+        self.starting.discard(child)
+        self.readyTimes.pop(child, None)
+        self.startupTimes.pop(child, None)
+        self.childUsage.pop(child, None)
         self._lastUsage.pop(child, None)
         self._calls.pop(child, None)
+        self._inflight.pop(child, None)
         self._finishCallbacks.pop(child, None)
-
-    def _addProcess(self, child, finished):
+        self._recycleFactor.pop(child, None)
+        self._slots.pop(child, None)
+        self._upAt.pop(child, None)
+        pid = self._pids.pop(child, None)
+        if pid is not None:
+            # values on their way to or from the child won't be received
+            sharedmem.sweep(pid)
+        self._recycling.discard(child)
+        self._superseded.discard(child)
+        self._stopping.discard(child)
+        old = self._replacementOf.pop(child, None)
+        if old is not None:
+            # the replacement died before being up, let the old child
+            # try again with its next call.
+            self._recycling.discard(old)
+
+    def _addProcess(self, child, finished, spawned=None):
         """
         Adds the newly created child process to the pool.
+
+        @param spawned: When the child was spawned, now by default.
         """
         def fatal(reason, child):
+            self.metrics.increment('crashes')
             log.error(
                 u'FATAL: Process exited.\n\t{r}', r=reason.getErrorMessage()
             )
@@ -163,20 +855,634 @@ class ProcessPool(object):
             self._pruneProcess(child)
 
         self.processes.add(child)
-        self.ready.add(child)
+        if not self.readyHandshake:
+            self.ready.add(child)
+            self._upAt[child] = now()
         finished.addCallback(dieGently, child).addErrback(fatal, child)
         self._finishCallbacks[child] = finished
         self._lastUsage[child] = now()
         self._calls[child] = 0
+        self._inflight[child] = 0
+        self._recycleFactor[child] = 1 + uniform(-self.recycleJitter,
+                                                 self.recycleJitter)
+        self._slots[child] = self._freeSlot()
+        self._pids[child] = sharedmem.childPid(child)
+        self._probeSpawn(child, spawned)
         self._catchUp()
+        return child
+
+    def _probeSpawn(self, child, spawned=None):
+        """
+        Measure the time it takes to a new child to answer its first
+        call and warm up, that is how long it takes to spawn a worker, and
+        put the child in rotation then if the pool uses the ready
+        handshake.
+        """
+        def _answered(result, started):
+            if child not in self._inflight:
+                # it went away in the meantime
+                self.starting.discard(child)
+                return
+            if result and result.get('started') is not None:
+                times = dict((k, result[k]) for k in _STARTUP_STEPS)
+                times['exec'] = max(0.0, result['started'] - started)
+                self.startupTimes[child] = times
+                log.info(u'Child started in {elapsed:.3f}s: {times}',
+                         elapsed=now() - started, times=times)
+            self._warmUp(child).addCallbacks(_warm, _cold,
+                                             callbackArgs=(started,))
+
+        def _warm(_, started):
+            self.starting.discard(child)
+            if child not in self._inflight:
+                return
+            self._warmupFailures = 0
+            self._upAt[child] = now()
+            elapsed = self._upAt[child] - started
+            self.readyTimes[child] = elapsed
+            self.metrics.observe('spawn', elapsed)
+            if self.spawnLatency is None:
+                self.spawnLatency = elapsed
+            else:
+                w = self._serviceTimeWeight
+                self.spawnLatency = w * elapsed + (1 - w) * self.spawnLatency
+            if self.readyHandshake and child not in self._retiring:
+                self.ready.add(child)
+                self._catchUp()
+            old = self._replacementOf.pop(child, None)
+            if old is not None:
+                self._supersede(old)
+            self._checkReadyWaiters()
+
+        def _cold(reason):
+            self.starting.discard(child)
+            if (child not in self._inflight or
+                    reason.check(error.ConnectionLost, error.ConnectionDone)):
+                # it went away, the pool deals with that already
+                return
+            self.metrics.increment('warmupFailures')
+            self._warmupFailures += 1
+            delay = min(MAX_WARMUP_BACKOFF,
+                        WARMUP_BACKOFF * 2 ** (self._warmupFailures - 1))
+            log.error(u'Warm-up failed, retiring the child and starting '
+                      u'another in {d}s: {r}', d=delay,
+                      r=reason.getErrorMessage())
+            self._replaceWorker(child, delay)
+            if self._warmupFailures >= self.maxWarmupFailures:
+                waiters, self._readyWaiters = self._readyWaiters, []
+                for count, d in waiters:
+                    d.errback(WarmupFailed(reason.getErrorMessage()))
+            else:
+                self._checkReadyWaiters()
+
+        def _failed(reason, started):
+            if reason.check(amp.RemoteAmpError):
+                # the child is up, it just doesn't know about Probe
+                return _answered(None, started)
+            self.starting.discard(child)
+
+        if spawned is None:
+            spawned = now()
+        self.starting.add(child)
+        defer.maybeDeferred(child.callRemote, commands.Probe
+            ).addCallbacks(_answered, _failed,
+                           callbackArgs=(spawned,), errbackArgs=(spawned,))
+
+    def _warmUp(self, child):
+        """
+        Have a new child import the modules in L{preload}, then make the
+        calls in L{warmup}.
+
+        @return: a L{defer.Deferred} firing when the child is warm.
+        """
+        def _unhandled(reason):
+            reason.trap(amp.RemoteAmpError)
+            if (self.preload or
+                    reason.value.errorCode != amp.UNHANDLED_ERROR_CODE):
+                return reason
+            # the child doesn't know about Warmup, and that's fine as
+            # long as it doesn't have to import anything.
+
+        d = defer.maybeDeferred(child.callRemote, commands.Warmup,
+                                modules=list(self.preload))
+        d.addErrback(_unhandled)
+        for command, kwargs in self.warmup:
+            d.addCallback(lambda _, command=command, kwargs=kwargs:
+                          child.callRemote(command, **kwargs))
+        return d
+
+    def whenReady(self, count=None):
+        """
+        Wait for workers to be up.
+
+        @param count: The number of workers to wait for, C{min} by default.
+        @type count: C{int}
+
+        @return: a L{defer.Deferred} firing with the number of workers
+                 that are up once there are at least C{count} of them, or
+                 failing with L{WarmupFailed} if new children keep
+                 failing their warm-up.
+        """
+        if count is None:
+            count = self.min
+        d = defer.Deferred()
+        self._readyWaiters.append((count, d))
+        self._checkReadyWaiters()
+        return d
+
+    def _checkReadyWaiters(self):
+        """
+        Fire the deferreds of L{whenReady} that got enough workers.
+        """
+        up = len([child for child in self.processes
+                  if child in self._inflight and
+                  child not in self.starting and
+                  child not in self._retiring])
+        fired = [d for count, d in self._readyWaiters if up >= count]
+        self._readyWaiters = [(count, d) for count, d in self._readyWaiters
+                              if up < count]
+        for d in fired:
+            d.callback(up)
 
     def _catchUp(self):
         """
-        If there are queued items in the list then run them.
+        If there are queued items in the list and children that can
+        take more calls then run them.
+        """
+        if self._parked:
+            self._catchUpParked()
+        while self._queue and self.ready:
+            oldest = self._queue[0][2]
+            if oldest.d is None:
+                # this call was already dropped from the queue, or
+                # served ahead of its turn
+                pop(self._queue)
+                continue
+            call = self._earliestDeadline(oldest)
+            if call is oldest:
+                pop(self._queue)
+            self._dispatchQueued(call)
+
+    def _earliestDeadline(self, oldest):
+        """
+        Pick the call to serve when C{oldest} is next in the queue: the
+        call with the earliest deadline of its priority, if it has one
+        before the deadline of C{oldest} and it was queued less than
+        priorityAging seconds after it.
+        """
+        heap = self._deadlines.get(oldest.priority)
+        while heap and heap[0][2].d is None:
+            pop(heap)
+        if not heap:
+            self._deadlines.pop(oldest.priority, None)
+            return oldest
+        deadline, _, call = heap[0]
+        if oldest.deadline is not None and oldest.deadline <= deadline:
+            return oldest
+        if call.enqueued - oldest.enqueued > self.priorityAging:
+            return oldest
+        return call
+
+    def _catchUpParked(self):
+        """
+        Send the calls waiting for their preferred child to it, if it
+        can take more calls.
+        """
+        for child in list(self.ready):
+            slot = self._slots[child]
+            while child in self.ready and self._parked.get(slot):
+                parked = self._parked[slot]
+                call = parked.pop(0)
+                if not parked:
+                    del self._parked[slot]
+                self._dispatchQueued(call)
+
+    def _dispatchQueued(self, call):
+        """
+        Send a call that waited for a child to one, unless it missed its
+        deadline in the meantime.
         """
-        if self._queue:
-            _, (d, command, kwargs) = pop(self._queue)
-            self._cb_doWork(command, **kwargs).chainDeferred(d)
+        if call.deadline is not None:
+            from twisted.internet import reactor
+            if call.deadline <= reactor.seconds():
+                # there's no point in sending it to a child only to
+                # kill the child right away.
+                self._expire(call)
+                return
+        call.cancelExpiry()
+        self._queueDepth -= 1
+        stats = self._statsFor(call.priority)
+        stats.depth -= 1
+        self._recordDispatch(stats, now() - call.enqueued, call.command)
+        # its entries left in the queue are skipped when they come up
+        d, call.d = call.d, None
+        self._cb_doWork(call.command, _enqueued=call.enqueued, **call.kwargs
+            ).chainDeferred(d)
+
+    def _enqueue(self, call):
+        """
+        Put a call in the queue, for the first child that can take it.
+
+        Higher priorities get a head start proportional to their level,
+        this way they are served first but they can't starve the ones
+        that have been waiting for long enough. Within a priority, calls
+        with a deadline go earliest deadline first, but only ahead of
+        calls queued at most priorityAging seconds before them, so they
+        can't starve the others either. Those that are not served in
+        time are dropped so they can't hold the queue forever.
+        """
+        from twisted.internet import reactor
+        key = call.enqueued - call.priority * self.priorityAging
+        push(self._queue, (key, count(), call))
+        if call.deadline is not None:
+            push(self._deadlines.setdefault(call.priority, []),
+                 (call.deadline, count(), call))
+        call.expiry = None
+        if self.maxQueueWait is not None:
+            # the call might have waited for its preferred child already
+            wait = max(0, self.maxQueueWait - (now() - call.enqueued))
+        if call.deadline is not None:
+            left = call.deadline - reactor.seconds()
+            if self.maxQueueWait is None or left <= wait:
+                call.expiry = reactor.callLater(max(0, left),
+                                                self._expire, call)
+        if call.expiry is None and self.maxQueueWait is not None:
+            call.expiry = reactor.callLater(wait, self._shed, call)
+
+    def _park(self, call, slot):
+        """
+        Make a call wait for the child in the given slot, for at most
+        affinityWait seconds.
+        """
+        from twisted.internet import reactor
+        wait = self.affinityWait
+        if self.maxQueueWait is not None:
+            wait = min(wait, self.maxQueueWait)
+        if call.deadline is not None:
+            wait = max(0, min(wait, call.deadline - reactor.seconds()))
+        self._parked.setdefault(slot, []).append(call)
+        call.expiry = reactor.callLater(wait, self._unpark, call, slot)
+
+    def _unpark(self, call, slot):
+        """
+        The preferred child of a call didn't take it in time, give it to
+        any child.
+        """
+        parked = self._parked[slot]
+        parked.remove(call)
+        if not parked:
+            del self._parked[slot]
+        self._enqueue(call)
+        self._catchUp()
+
+    def _freeSlot(self):
+        """
+        Find a slot for a new child: the one of the last child that was
+        replaced, if it's still free, the lowest free one otherwise.
+        """
+        used = set(self._slots.values())
+        while self._vacated:
+            slot = self._vacated.pop(0)
+            if slot not in used:
+                return slot
+        slot = 0
+        while slot in used:
+            slot += 1
+        return slot
+
+    def _slotFor(self, key):
+        """
+        Find the slot of the preferred child for an affinity key through
+        rendezvous hashing.
+
+        Children keep their slot for their whole life and replacements
+        take the slot of the child they replace, so the preferred slot of
+        a key changes only when its slot is added or removed.
+        """
+        slots = set(self._slots.values())
+        if not slots:
+            return None
+        keyHash = hash(key)
+        return max(slots,
+                   key=lambda slot: _rendezvousWeight(keyHash, slot))
+
+    def affinityHitRate(self):
+        """
+        Fraction of the calls with an C{_affinity} key that were sent to
+        their preferred child.
+        """
+        total = self.affinityHits + self.affinityMisses
+        if not total:
+            return 0.0
+        return self.affinityHits / float(total)
+
+    def _dropQueued(self, call, reason):
+        """
+        Take a call out of the queue and fail it with the given reason.
+
+        The entry stays in the heap and is skipped when it comes up.
+        """
+        d, call.d = call.d, None
+        call.cancelExpiry()
+        self._queueDepth -= 1
+        self._statsFor(call.priority).depth -= 1
+        d.errback(reason)
+
+    def _shed(self, call):
+        """
+        Drop a call that waited in the queue for longer than
+        maxQueueWait.
+        """
+        self._statsFor(call.priority).shed += 1
+        self.metrics.increment('shed')
+        self._dropQueued(call, PoolOverloaded(self._retryAfter()))
+
+    def _expire(self, call):
+        """
+        Drop a call that missed its deadline while waiting in the queue.
+        """
+        self.expired += 1
+        self._statsFor(call.priority).expired += 1
+        self.metrics.increment('expired')
+        self._dropQueued(call, DeadlineExpired())
+
+    def _retryAfter(self):
+        """
+        Estimate in how many seconds the pool should be able to take a
+        new call, based on the current queue and the average service
+        time.
+        """
+        if self.serviceTime is None:
+            return self.maxQueueWait or 1.0
+        capacity = max(self.max, 1) * self.maxConcurrentPerChild
+        return (self._queueDepth + 1) * self.serviceTime / capacity
+
+    def _observeServiceTime(self, elapsed):
+        """
+        Update the average service time with a new sample.
+        """
+        if self.serviceTime is None:
+            self.serviceTime = elapsed
+        else:
+            w = self._serviceTimeWeight
+            self.serviceTime = w * elapsed + (1 - w) * self.serviceTime
+
+    def _statsFor(self, priority):
+        """
+        Get the L{PriorityStats} for the given priority, creating it if
+        this is the first time we see it.
+        """
+        stats = self.priorityStats.get(priority)
+        if stats is None:
+            stats = self.priorityStats[priority] = PriorityStats()
+        return stats
+
+    def _recordDispatch(self, stats, waited, command):
+        """
+        Account for a call that is leaving the queue for a child after
+        waiting for the given number of seconds.
+        """
+        self.metrics.observe('queueWait', waited, _commandName(command),
+                             _callCount(command))
+        stats.dispatched += 1
+        stats.totalWait += waited
+        if waited > stats.maxWait:
+            stats.maxWait = waited
+
+    def _replaceWorker(self, child, delay=0):
+        """
+        Take a child out of rotation, stop it and start a new worker to
+        take its place, unless one was already started for it.
+
+        @param delay: seconds to wait between the end of the child and
+                      the start of its replacement.
+
+        This is safe to call several times for the same child, as it
+        happens when a child with many calls in flight dies: only the
+        first call does anything.
+        """
+        if self._inflight.pop(child, None) is None:
+            return
+        self.ready.discard(child)
+        self.busy.discard(child)
+        self._retiring.discard(child)
+        if child in self._replacementOf:
+            # a replacement that failed: the child it was replacing keeps
+            # its slot and starts another one with its next call.
+            self.stopAWorker(child)
+            return
+        if child in self._slots:
+            # the replacement inherits the slot, and so the affinity keys
+            self._vacated.append(self._slots[child])
+        if (child in self._superseded or child in self._stopping or
+                child in self._replacementOf.values()):
+            self.stopAWorker(child)
+            return
+        # We should die and we do, then we start a new worker to pick up
+        # stuff from the queue otherwise we end up without workers and
+        # the queue will remain there.
+        if not delay:
+            self.stopAWorker(child).addCallback(lambda _: self.startAWorker())
+            return
+
+        def _respawn(_):
+            from twisted.internet import reactor
+            if self.finished:
+                return
+
+            def _start():
+                self._respawns.discard(call)
+                self.startAWorker()
+            call = reactor.callLater(delay, _start)
+            self._respawns.add(call)
+        self.stopAWorker(child).addCallback(_respawn)
+
+    def _recycleThreshold(self, child):
+        """
+        The number of calls after which this child should be recycled.
+        """
+        return max(1, int(round(self.recycleAfter * self._recycleFactor[child])))
+
+    def _shouldRecycle(self, child):
+        """
+        Check whether a child reached its recycling threshold and can be
+        recycled now.
+        """
+        if not self.recycleAfter or child in self._recycling:
+            return False
+        if self._calls[child] < self._recycleThreshold(child):
+            return False
+        return self._canRecycle()
+
+    def _canRecycle(self):
+        """
+        Check whether another child can be recycled without going over
+        C{maxConcurrentRecycles}.
+        """
+        return (self.maxConcurrentRecycles is None or
+                len(self._recycling) < self.maxConcurrentRecycles)
+
+    def _recycle(self, child):
+        """
+        Start recycling a child, either by starting its replacement right
+        away or by retiring it once the calls in flight on it are done.
+        """
+        self._recycling.add(child)
+        self.metrics.increment('recycles')
+        if self.makeBeforeBreak:
+            replacement = self.startAWorker()
+            if replacement is not None:
+                self._replacementOf[replacement] = child
+                self._slots[replacement] = self._slots[child]
+                return
+        # mark this child to be removed once the calls in flight on it
+        # are done.
+        self._retiring.add(child)
+        self.ready.discard(child)
+        if not self._inflight[child]:
+            self._replaceWorker(child)
+
+    def _checkMemory(self):
+        """
+        Ask every child that is up for its resource usage, and recycle
+        the ones that use too much memory. A child that didn't answer the
+        previous check isn't asked again, and the check doesn't wait for
+        it for longer than memoryCheckInterval.
+        """
+        from twisted.internet import reactor
+        def _reported(usage, child):
+            if child not in self._inflight:
+                # it went away in the meantime
+                return
+            self.childUsage[child] = usage
+            if (self.maxChildMemory is not None and
+                    usage['rss'] > self.maxChildMemory and
+                    child not in self._recycling and
+                    child not in self._retiring):
+                if not self._canRecycle():
+                    # its turn comes at a later check
+                    return
+                log.info(u'Child using {m} bytes of memory, recycling it.',
+                         m=usage['rss'])
+                self._recycle(child)
+
+        def _answered(result, child):
+            self._usageChecks.discard(child)
+            return result
+
+        d = []
+        for child in list(self._inflight):
+            if (child in self.starting or child in self._retiring or
+                    child in self._usageChecks):
+                continue
+            self._usageChecks.add(child)
+            poll = defer.Deferred()
+            child.callRemote(commands.ResourceUsage
+                ).addBoth(_answered, child
+                ).chainDeferred(poll)
+            # a child busy with a long call answers late, it's checked
+            # again once it did.
+            poll.addTimeout(self.memoryCheckInterval, reactor)
+            d.append(poll.addCallback(_reported, child
+                # the child might go away or not know about the command,
+                # we'll check again next time.
+                ).addErrback(lambda _: None))
+        return defer.DeferredList(d)
+
+    def _upChildren(self, child=None):
+        """
+        The children that can be asked about themselves: the given one,
+        or all of those that are up and not on their way out.
+        """
+        if child is not None:
+            return [child]
+        return [c for c in self._inflight
+                if c not in self.starting and c not in self._retiring]
+
+    def profile(self, seconds=None, calls=None, child=None):
+        """
+        Profile a child, or all of the children that are up, with
+        C{cProfile} while they keep working, see L{ampoule.profiling}.
+
+        @param seconds: how long to profile for, L{profiling.DEFAULT_SECONDS}
+                        by default or at most L{profiling.MAX_SECONDS}
+                        when C{calls} is given.
+
+        @param calls: stop once each child answered this many calls, or
+                      once C{seconds} passed if that comes first.
+
+        @param child: the child to profile, all of them if L{None}.
+
+        @return: a L{defer.Deferred} firing with the merged stats as a
+                 L{pstats.Stats}, or L{None} if there was no child up.
+                 Children that fail to send their stats are left out, it
+                 fails only if all of them do.
+        """
+        if seconds is not None:
+            seconds = float(seconds)
+        d = []
+        for c in self._upChildren(child):
+            d.append(c.callRemote(commands.Profile, seconds=seconds,
+                                  calls=calls
+                ).addCallback(lambda response: response['stats'].readAll()))
+        return self._gathered(d).addCallback(
+            lambda results: profiling.merge(results.values()))
+
+    def dumpStacks(self, child=None):
+        """
+        Get the current stack of every thread of a child, or of all of
+        the children that are up.
+
+        @return: a L{defer.Deferred} firing with a dictionary of the text
+                 of the stacks by the process id of the child. Children
+                 that fail to answer are left out, it fails only if all
+                 of them do.
+        """
+        d = []
+        for c in self._upChildren(child):
+            d.append(c.callRemote(commands.StackDump
+                ).addCallback(lambda response: response['stacks'].readAll()
+                ).addCallback(lambda text, c=c: (self._pids.get(c),
+                                                 text.decode('utf-8'))))
+        return self._gathered(d).addCallback(
+            lambda results: dict(results.values()))
+
+    def _gathered(self, deferreds):
+        """
+        Gather the results of the calls to several children.
+
+        @return: a L{defer.Deferred} firing with the results of the calls
+                 that succeeded, by their index, or with the first
+                 failure if none did.
+        """
+        def _results(outcomes):
+            results = {}
+            failures = []
+            for i, (success, result) in enumerate(outcomes):
+                if success:
+                    results[i] = result
+                else:
+                    log.failure(u'Child failed to answer', result)
+                    failures.append(result)
+            if failures and not results:
+                return failures[0]
+            return results
+        return defer.DeferredList(deferreds, consumeErrors=True
+            ).addCallback(_results)
+
+    def _supersede(self, child):
+        """
+        The replacement of this child is up: take the child out of
+        rotation and stop it once the calls in flight on it are done.
+        """
+        if child not in self._inflight:
+            # it went away in the meantime
+            return
+        self._superseded.add(child)
+        self._retiring.add(child)
+        self.ready.discard(child)
+        if not self._inflight[child]:
+            self._replaceWorker(child)
 
     def _handleTimeout(self, child):
         """
@@ -185,6 +1491,12 @@ class ProcessPool(object):
         @param child: The child process
         @type child: L{child.AMPChild}
         """
+        # The signal takes down every call in flight on this child, make
+        # sure no new ones are sent its way in the meantime.
+        self.metrics.increment('timeouts')
+        if child in self._inflight:
+            self._retiring.add(child)
+            self.ready.discard(child)
         try:
             child.transport.signalProcess(self.timeout_signal)
         except error.ProcessExitedAlready:
@@ -211,13 +1523,15 @@ class ProcessPool(object):
             # returning before the new process is created.
             return
         startAMPProcess = self.starter.startAMPProcess
+        spawned = now()
         child, finished = startAMPProcess(self.ampChild,
                                           ampParent=self.ampParent,
                                           ampChildArgs=self.ampChildArgs)
-        return self._addProcess(child, finished)
+        self.metrics.increment('spawns')
+        return self._addProcess(child, finished, spawned)
 
     def _cb_doWork(self, command, _timeout=None, _deadline=None,
-                   **kwargs):
+                   _affinity=None, _enqueued=None, **kwargs):
         """
         Go and call the command.
 
@@ -231,6 +1545,8 @@ class ProcessPool(object):
         @type _timeout: C{int}
         @param _deadline: The deadline for this call only
         @type _deadline: C{int}
+        @param _affinity: The affinity key of this call
+        @param _enqueued: When the call got to the pool, if it waited
         """
         timeoutCall = None
         deadlineCall = None
@@ -241,41 +1557,76 @@ class ProcessPool(object):
                     call.cancel()
             cancelCall(timeoutCall)
             cancelCall(deadlineCall)
-            self.busy.discard(child)
+
+            if child not in self._inflight:
+                # this child is already on its way out, another call
+                # took care of replacing it.
+                return result
+
+            self._inflight[child] -= 1
+            self._lastUsage[child] = now()
 
             alreadyDead = (
                 is_error and
                 result.check(error.ProcessTerminated)
             )
-
-            if not (die or alreadyDead):
+            if chunk and command.died:
+                alreadyDead = True
+            if is_error:
+                failed = calls
+            elif chunk:
+                # the calls of a chunk fail one by one
+                failed = len([success for success, _ in result
+                              if not success])
+            else:
+                failed = 0
+            if failed:
+                self.metrics.increment('failed', failed)
+            if calls - failed:
+                self.metrics.increment('completed', calls - failed)
+            if not alreadyDead and measured:
+                elapsed = self._lastUsage[child] - started
+                self._observeServiceTime(elapsed / calls)
+                self.metrics.observe('execution', elapsed / calls,
+                                     _commandName(command), calls)
+
+            if alreadyDead:
+                self._replaceWorker(child)
+            elif child in self._retiring:
+                # we are marked to be removed, wait for the other calls
+                # in flight on this child to come back before stopping it.
+                if not self._inflight[child]:
+                    self._replaceWorker(child)
+            else:
                 # we are not marked to be removed, so add us back to
                 # the ready set and let's see if there's some catching
                 # up to do
+                if not self._inflight[child]:
+                    self.busy.discard(child)
                 self.ready.add(child)
                 self._catchUp()
-            else:
-                # We should die and we do, then we start a new worker
-                # to pick up stuff from the queue otherwise we end up
-                # without workers and the queue will remain there.
-                self.stopAWorker(child).addCallback(lambda _: self.startAWorker())
-            self._lastUsage[child] = now()
             # we can't do recycling here because it's too late and
             # the process might have received tons of calls already
             # which would make it run more calls than what is
             # configured to do.
             return result
 
-        die = False
-        child = self.ready.pop()
+        started = now()
+        child = self._pickChild(_affinity)
+        # calls sent to a child that is still starting up would count
+        # its startup as service time.
+        measured = child not in self.starting
+        self._inflight[child] += 1
         self.busy.add(child)
-        self._calls[child] += 1
+        if self._inflight[child] >= self.maxConcurrentPerChild:
+            self.ready.discard(child)
+        calls = _callCount(command)
+        chunk = isinstance(command, _Chunk)
+        self._calls[child] += calls
 
         # Let's see if this call goes over the recycling barrier
-        if self.recycleAfter and self._calls[child] >= self.recycleAfter:
-            # it does so mark this child, using a closure, to be
-            # removed at the end of the call.
-            die = True
+        if self._shouldRecycle(child):
+            self._recycle(child)
 
         # If the command doesn't require a response then callRemote
         # returns nothing, so we prepare for that too.
@@ -296,44 +1647,310 @@ class ProcessPool(object):
             deadlineCall = reactor.callLater(delay, self._handleTimeout,
                                              child)
 
-        return defer.maybeDeferred(child.callRemote, command, **kwargs
-            ).addCallback(_returned, child
+        if chunk:
+            d = command.sendTo(child)
+        elif self.tracer is not None:
+            d = self._tracedCall(child, command, kwargs, started, _enqueued)
+        else:
+            d = defer.maybeDeferred(child.callRemote, command, **kwargs)
+        return d.addCallback(_returned, child
             ).addErrback(_returned, child, is_error=True)
 
+    def _tracedCall(self, child, command, kwargs, dispatched, enqueued):
+        """
+        Send a call to a child asking it to stamp it, and give the
+        timeline of the call to the tracer once it's done.
+        """
+        if enqueued is None:
+            enqueued = dispatched
+        cold = self._upAt.get(child, 0) > enqueued
+        pid = self._pids.get(child)
+        callRemoteTraced = getattr(child, 'callRemoteTraced', None)
+        if callRemoteTraced is None:
+            # a parent protocol that can't ask for stamps
+            d, stamps = defer.maybeDeferred(child.callRemote, command,
+                                            **kwargs), []
+        else:
+            try:
+                d, stamps = callRemoteTraced(command, **kwargs)
+            except Exception:
+                d, stamps = defer.fail(), []
+
+        def _report(result, failed):
+            if len(stamps) == 5:
+                received, started, finished, sent, returned = stamps
+            else:
+                received = started = finished = sent = None
+                returned = now()
+            try:
+                self.tracer(tracing.CallTrace(
+                    _commandName(command), pid, enqueued, dispatched,
+                    received, started, finished, sent, returned, cold,
+                    failed))
+            except Exception:
+                log.failure(u'Tracer failed')
+            return result
+
+        return d.addCallbacks(_report, _report,
+                              callbackArgs=(False,), errbackArgs=(True,))
+
+    def _pickChild(self, affinity=None):
+        """
+        Choose the child for a call among the ready ones: the preferred
+        child of the affinity key if it's one of them, the least loaded
+        otherwise.
+        """
+        if affinity is not None:
+            slot = self._slotFor(affinity)
+            for child in self.ready:
+                if self._slots[child] == slot:
+                    self.affinityHits += 1
+                    return child
+            self.affinityMisses += 1
+        return min(self.ready, key=self._inflight.__getitem__)
+
+    def _preferredReady(self, affinity):
+        """
+        Check whether the preferred child of an affinity key can take a
+        call right now.
+        """
+        slot = self._slotFor(affinity)
+        return any(self._slots[child] == slot for child in self.ready)
+
     def callRemote(self, *args, **kwargs):
         """
         Proxy call to keep the API homogeneous across twisted's RPCs
         """
         return self.doWork(*args, **kwargs)
 
-    def doWork(self, command, **kwargs):
+    def doWork(self, command, _priority=0, _affinity=None, **kwargs):
         """
         Sends the command to one child.
 
         @param command: an L{amp.Command} type object.
         @type command: L{amp.Command}
 
+        @param _priority: The priority of this call, when all children
+                          are busy higher priorities are served first.
+        @type _priority: C{int}
+
+        @param _affinity: An optional hashable key. Calls with the same
+                          key go to the same child whenever possible, so
+                          that the caches of the children are used. A
+                          call waits at most C{affinityWait} seconds for
+                          its preferred child before going to any child.
+
         @param kwargs: dictionary containing the arguments for the command.
+
+        @return: a L{defer.Deferred} firing with the response of the child.
+                 It fails with L{PoolOverloaded} if the call can't be
+                 queued or waits in the queue for longer than
+                 C{maxQueueWait}, and with L{DeadlineExpired} if the
+                 C{_deadline} of the call passes while it is queued.
+        """
+        if (self.resultCache is not None and
+                self.resultCache.cacheable(command)):
+            return self.resultCache.call(
+                command, kwargs,
+                functools.partial(self._submit, command, _priority,
+                                  _affinity, **kwargs))
+        return self._submit(command, _priority, _affinity, **kwargs)
+
+    def _submit(self, command, _priority=0, _affinity=None, **kwargs):
+        """
+        Add the call to the batch of its command if it has one, send it
+        to a child otherwise.
+
+        Calls with options, like a timeout or a priority, are never
+        batched.
         """
-        if self.ready: # there are unused processes, let's use them
+        if (getattr(command, 'batchWindow', None) is not None and
+                not _priority and _affinity is None and
+                not [name for name in kwargs if name.startswith('_')]):
+            return self._addToBatch(command, kwargs)
+        return self._doWork(command, _priority, _affinity, **kwargs)
+
+    def _doWork(self, command, _priority=0, _affinity=None, **kwargs):
+        """
+        Sends the command to one child, bypassing the result cache and
+        the batches.
+        """
+        self.arrivals += _callCount(command)
+        self.metrics.increment('calls', _callCount(command))
+        if self.scaler is not None:
+            # the scaler decides how many workers we need, we only
+            # make sure there's someone to pick up the work.
+            canGrow = not self.processes
+        else:
+            canGrow = len(self.processes) < self.max
+        if canGrow and self.readyHandshake:
+            # workers that are still starting will take care of as many
+            # queued calls as they can before we need more of them.
+            canGrow = self._queueDepth >= self.maxConcurrentPerChild * len(
+                [c for c in self.starting if c not in self._retiring])
+        if not self.ready and canGrow:
+            # no unused but we can start some new ones
+            # since startAWorker is synchronous we won't have a
+            # race condition here in case of multiple calls to
+            # doWork, so we will end up queueing in case of such calls:
+            # Process pool with min=1, max=1, recycle_after=1
+            # [call(Command) for x in xrange(BIG_NUMBER)]
+            # The new worker picks up queued calls first, if any.
+            self.startAWorker()
+        stats = self._statsFor(_priority)
+        slot = None
+        if _affinity is not None:
+            kwargs['_affinity'] = _affinity
+            if self.affinityWait and not self._preferredReady(_affinity):
+                # the preferred child is busy, wait for it a bit
+                slot = self._slotFor(_affinity)
+        if slot is not None and self.ready and self._overloaded():
+            # better a cold child than no child at all
+            slot = None
+        if self.ready and slot is None:
+            # there are processes with spare capacity, use them
+            self._recordDispatch(stats, 0.0, command)
             return self._cb_doWork(command, **kwargs)
         else:
-            if len(self.processes) < self.max:
-                # no unused but we can start some new ones
-                # since startAWorker is synchronous we won't have a
-                # race condition here in case of multiple calls to
-                # doWork, so we will end up in the else clause in case
-                # of such calls:
-                # Process pool with min=1, max=1, recycle_after=1
-                # [call(Command) for x in xrange(BIG_NUMBER)]
-                self.startAWorker()
-                return self._cb_doWork(command, **kwargs)
+            # No one is free... just queue up and wait for a process
+            # to start and pick up the first item in the queue.
+            if self._overloaded():
+                stats.shed += 1
+                self.metrics.increment('shed')
+                return defer.fail(PoolOverloaded(self._retryAfter()))
+            d = defer.Deferred()
+            call = _QueuedCall(d, command, kwargs, _priority, now(),
+                               kwargs.get('_deadline'), _affinity)
+            self._queueDepth += 1
+            stats.depth += 1
+            stats.queued += 1
+            if slot is not None:
+                self._park(call, slot)
             else:
-                # No one is free... just queue up and wait for a process
-                # to start and pick up the first item in the queue.
-                d = defer.Deferred()
-                self._queue.append((count(), (d, command, kwargs)))
-                return d
+                self._enqueue(call)
+            if self.scaler is not None:
+                self.scaler.poke()
+            return d
+
+    def _addToBatch(self, command, kwargs):
+        """
+        Add a call to the batch of its command, that is sent when it has
+        C{batchSize} calls or C{batchWindow} seconds after its first one.
+        """
+        d = defer.Deferred()
+        calls = self._batches.setdefault(command, [])
+        calls.append((kwargs, d))
+        if len(calls) >= getattr(command, 'batchSize', 100):
+            self._flushBatch(command)
+        elif len(calls) == 1:
+            from twisted.internet import reactor
+            self._batchTimers[command] = reactor.callLater(
+                command.batchWindow, self._flushBatch, command)
+        return d
+
+    def _flushBatch(self, command):
+        """
+        Send the calls in the batch of a command to a child.
+        """
+        calls = self._batches.pop(command, None)
+        timer = self._batchTimers.pop(command, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+        if not calls:
+            return
+        if len(calls) == 1:
+            # no need for a batch then
+            kwargs, d = calls[0]
+            self._doWork(command, **kwargs).chainDeferred(d)
+            return
+
+        def _fanOut(results):
+            for (success, result), (_, d) in zip(results, calls):
+                if success:
+                    d.callback(result)
+                else:
+                    d.errback(result)
+
+        def _failed(reason):
+            for _, d in calls:
+                d.errback(reason)
+
+        self._doWork(_Batch(command, [kwargs for kwargs, _ in calls])
+            ).addCallbacks(_fanOut, _failed)
+
+    def imap(self, command, iterable, callback, chunkSize=100,
+             maxChunks=None, ordered=True, **kwargs):
+        """
+        Run a command once for every set of arguments of an iterable and
+        hand every response to a callback.
+
+        The calls are sent to the children in chunks of C{chunkSize}: a
+        chunk takes a single place in the queue and in a child, and all
+        its calls are written to the child at once. At most C{maxChunks}
+        chunks are in flight at any time and the iterable is consumed
+        only as they complete, so it can be a generator of any length.
+
+        @param command: an L{amp.Command} type object.
+        @type command: L{amp.Command}
+
+        @param iterable: An iterable of dictionaries with the arguments of
+                         each call.
+
+        @param callback: A callable that gets each response. If it returns
+                         a L{defer.Deferred} the chunk of the response is
+                         done only when it fires.
+
+        @param chunkSize: The number of calls per chunk.
+        @type chunkSize: C{int}
+
+        @param maxChunks: The number of chunks in flight, twice the number
+                          of calls the pool can run at once by default.
+        @type maxChunks: C{int}
+
+        @param ordered: If L{True} the responses are delivered in the
+                        order of the iterable, otherwise in the order the
+                        chunks complete.
+        @type ordered: C{bool}
+
+        @param kwargs: Options for every chunk, as for L{doWork}, like
+                       C{_priority} or C{_timeout}. A timeout is for a
+                       whole chunk.
+
+        @return: a L{defer.Deferred} firing with the number of calls once
+                 all the responses are delivered, or failing with the
+                 first error of a call or of the callback. No new chunk
+                 is sent after an error.
+        """
+        assert chunkSize >= 1, 'chunkSize must be positive'
+        if maxChunks is None:
+            maxChunks = 2 * self.max * self.maxConcurrentPerChild
+        assert maxChunks >= 1, 'maxChunks must be positive'
+        return _Mapper(self, command, iterable, callback, chunkSize,
+                       maxChunks, ordered, kwargs).start()
+
+    def map(self, command, iterable, ordered=True, **kwargs):
+        """
+        Run a command once for every set of arguments of an iterable.
+
+        This takes the same arguments as L{imap}, but for the callback.
+
+        @return: a L{defer.Deferred} firing with the list of responses.
+        """
+        results = []
+        return self.imap(command, iterable, results.append,
+                         ordered=ordered, **kwargs
+            ).addCallback(lambda _: results)
+
+    def _overloaded(self):
+        """
+        Check whether a new call should be refused instead of queued.
+        """
+        if self.maxQueue is not None and self._queueDepth >= self.maxQueue:
+            return True
+        if self.maxQueueWait is not None and self.serviceTime is not None:
+            # don't queue calls that we already know will be shed
+            return self._retryAfter() > self.maxQueueWait
+        return False
 
     def stopAWorker(self, child=None):
         """
@@ -344,10 +1961,18 @@ class ProcessPool(object):
 
         """
         if child is None:
-            if self.ready:
-                child = self.ready.pop()
-            else:
-                child = choice(list(self.processes))
+            candidates = (self.ready or (self.processes - self._retiring)
+                          or self.processes)
+            # prefer a child that isn't serving any call right now
+            child = min(candidates, key=lambda c: self._inflight.get(c, 0))
+            if self._inflight.get(child):
+                # take it out of rotation and let the calls in flight
+                # come back before stopping it, it's not replaced.
+                self._stopping.add(child)
+                self._retiring.add(child)
+                self.ready.discard(child)
+                return self._finishCallbacks[child]
+            return self._stopIdleWorker(child)
         child.callRemote(commands.Shutdown
             # This is needed for timeout handling, the reason is pretty hard
             # to explain but I'll try to:
@@ -359,14 +1984,21 @@ class ProcessPool(object):
             # errback that we got originally, for this reason we need to
             # trap it now so that it doesn't raise by not being handled.
             # Does this even make sense to you?
-            ).addErrback(lambda reason: reason.trap(error.ProcessTerminated))
+            # The same goes for a child that is already quitting because
+            # it was told to shutdown a moment ago, e.g. while recycling.
+            ).addErrback(lambda reason: reason.trap(error.ProcessTerminated,
+                                                    error.ProcessDone))
         return self._finishCallbacks[child]
 
-    def adjustPoolSize(self, min=None, max=None):
+    def adjustPoolSize(self, min=None, max=None, waitReady=False):
         """
         Change the pool size to be at least min and less than max,
         useful when you change the values of max and min in the instance
         and you want the pool to adapt to them.
+
+        @param waitReady: If L{True} the returned deferred fires only when
+                          at least C{min} workers are up.
+        @type waitReady: C{bool}
         """
         if min is None:
             min = self.min
@@ -380,20 +2012,39 @@ class ProcessPool(object):
         self.max = max
 
         l = []
+        ready = None
         if self.started:
 
             for i in range(len(self.processes)-self.max):
                 l.append(self.stopAWorker())
             while len(self.processes) < self.min:
                 self.startAWorker()
+            if waitReady:
+                ready = self.whenReady(self.min)
 
-        return defer.DeferredList(l).addCallback(lambda _: self.dumpStats())
+        d = defer.DeferredList(l)
+        if ready is not None:
+            # the workers might never come, see WarmupFailed
+            d.addCallback(lambda _: ready)
+        return d.addCallback(lambda _: self.dumpStats())
 
     def stop(self):
         """
         Stops the process protocol.
         """
+        for command in list(self._batches):
+            self._flushBatch(command)
         self.finished = True
+        if self.scaler is not None:
+            self.scaler.stop()
+        if self.memoryLooping.running:
+            self.memoryLooping.stop()
+        for call in self._respawns:
+            call.cancel()
+        self._respawns.clear()
+        waiters, self._readyWaiters = self._readyWaiters, []
+        for count, d in waiters:
+            d.errback(defer.CancelledError())
         l = [self.stopAWorker(process) for process in self.processes]
         def _cb(_):
             if self.looping.running:
@@ -402,15 +2053,60 @@ class ProcessPool(object):
         return defer.DeferredList(l).addCallback(_cb)
 
     def dumpStats(self):
+        """
+        Log the configuration and the metrics of the pool.
+        """
+        snapshot = self.metrics.snapshot()
+        counters = snapshot['counters']
+        gauges = snapshot['gauges']
+        histograms = self.metrics.histograms
+
+        def _quantile(name, command, q):
+            histogram = histograms.get(name, {}).get(command)
+            if histogram is None:
+                return u"-"
+            return u"%.1fms" % (histogram.quantile(q) * 1000,)
+
+        latencies = []
+        executions = histograms.get('execution', {})
+        for command in sorted(c for c in executions if c is not None):
+            latencies.append(LATENCY_TEMPLATE.format(
+                command=command,
+                count=executions[command].count,
+                wait50=_quantile('queueWait', command, 0.5),
+                wait99=_quantile('queueWait', command, 0.99),
+                run50=_quantile('execution', command, 0.5),
+                run99=_quantile('execution', command, 0.99)))
+
         log.info(
             STATS_TEMPLATE,
-            w=len(self.processes),
+            w=gauges['workers'],
+            ready=gauges['ready'],
+            busy=gauges['busy'],
+            starting=gauges['starting'],
+            queued=gauges['queued'],
+            calls=counters.get('calls', 0),
+            failed=counters.get('failed', 0),
+            shed=counters.get('shed', 0),
+            expired=counters.get('expired', 0),
+            timeouts=counters.get('timeouts', 0),
+            crashes=counters.get('crashes', 0),
+            recycles=counters.get('recycles', 0),
+            spawns=counters.get('spawns', 0),
+            spawn50=_quantile('spawn', None, 0.5),
+            spawn99=_quantile('spawn', None, 0.99),
             t=self.timeout,
             p=self.ampParent,
             c=self.ampChild,
             i=self.maxIdle,
             r=self.recycleAfter,
-            s=self.starter
+            j=self.recycleJitter,
+            m=self.maxConcurrentPerChild,
+            q=self.maxQueue,
+            W=self.maxQueueWait,
+            A=self.affinityWait,
+            s=self.starter,
+            l=u"".join(latencies) or u" -"
         )
 
 pp = None
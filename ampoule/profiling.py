@@ -0,0 +1,155 @@
+"""
+Look inside the children of a L{ampoule.pool.ProcessPool} while they
+run: profile them with C{cProfile}, or dump the stacks of their threads::
+
+    stats = yield pool.profile(seconds=10)
+    stats.sort_stats('cumulative').print_stats(20)
+
+    for pid, text in (yield pool.dumpStacks()).items():
+        print(pid, text)
+
+A child profiles itself in its own process, and sends back its stats in
+the C{marshal} format of L{pstats.Stats.dump_stats}; the pool merges the
+stats of all of the children it asked.
+"""
+import cProfile
+import marshal
+import pstats
+import sys
+import threading
+import traceback
+
+from twisted.internet import defer
+
+
+# how long a profile lasts when neither its time nor its calls are given
+DEFAULT_SECONDS = 1.0
+
+# how long a profile waits for its calls at most when its time isn't given
+MAX_SECONDS = 60.0
+
+
+
+class ProfilerBusy(Exception):
+    """
+    The child is being profiled already.
+    """
+
+
+
+class Profiler(object):
+    """
+    A C{cProfile} profile of the process that ends after a number of
+    seconds, or once the process answered a number of calls, whichever
+    comes first. It lasts L{DEFAULT_SECONDS} when neither is given, and
+    at most L{MAX_SECONDS} when only the calls are, so a child that gets
+    no calls isn't profiled forever.
+
+    @ivar done: a L{defer.Deferred} firing with the marshalled stats when
+                the profile ends.
+    """
+
+    def __init__(self, seconds=None, calls=None, clock=None):
+        if seconds is None:
+            seconds = DEFAULT_SECONDS if calls is None else MAX_SECONDS
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.seconds = seconds
+        self.calls = calls
+        self.clock = clock
+        self.done = defer.Deferred()
+        self._profile = cProfile.Profile()
+        self._timer = None
+
+    def start(self):
+        """
+        Start profiling.
+
+        @return: L{done}.
+        """
+        if self.seconds is not None:
+            self._timer = self.clock.callLater(self.seconds, self.stop)
+        if self.calls is not None and self.calls <= 0:
+            self.stop()
+            return self.done
+        self._profile.enable()
+        return self.done
+
+    def called(self, result=None):
+        """
+        Count a call answered by the process, and stop once there were
+        enough of them. Returns C{result} to be usable as a callback.
+        """
+        if self.calls is not None and not self.done.called:
+            self.calls -= 1
+            if self.calls <= 0:
+                self.stop()
+        return result
+
+    def stop(self):
+        """
+        Stop profiling and fire L{done}.
+        """
+        if self.done.called:
+            return
+        self._profile.disable()
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        self._profile.create_stats()
+        self.done.callback(marshal.dumps(self._profile.stats))
+
+
+
+class _Loaded(object):
+    """
+    The stats of a profile as L{pstats.Stats} expects to find them.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+
+def statsFromBytes(data):
+    """
+    Load the marshalled stats of a profile.
+
+    @return: a L{pstats.Stats}.
+    """
+    return pstats.Stats(_Loaded(marshal.loads(data)))
+
+
+def merge(datas):
+    """
+    Merge the marshalled stats of several profiles.
+
+    @return: a L{pstats.Stats}, or L{None} if there are no stats.
+    """
+    stats = None
+    for data in datas:
+        if stats is None:
+            stats = statsFromBytes(data)
+        else:
+            stats.add(statsFromBytes(data))
+    return stats
+
+
+def dumpStacks():
+    """
+    Format the current stack of every thread of the process, innermost
+    call last, as L{traceback} does.
+
+    @return: the text of the stacks.
+    """
+    names = dict((thread.ident, thread.name)
+                 for thread in threading.enumerate())
+    dumps = []
+    for ident, frame in sorted(sys._current_frames().items()):
+        dumps.append('Thread %s (%d):\n%s' % (
+            names.get(ident, '?'), ident,
+            ''.join(traceback.format_stack(frame))))
+    return '\n'.join(dumps)
@@ -0,0 +1,165 @@
+"""
+The metrics of a L{ampoule.pool.ProcessPool} in the text exposition
+format of Prometheus, and a web resource that serves them.
+"""
+import re
+
+from twisted.web import resource, server
+
+
+CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+
+# gauges of ampoule.pool.ProcessPool.metrics with their name and help
+GAUGES = [
+    ('workers', 'ampoule_workers', "Worker processes in the pool."),
+    ('queued', 'ampoule_queued_calls', "Calls waiting for a worker."),
+    ('inflight', 'ampoule_inflight_calls', "Calls sent to workers."),
+    ('serviceTime', 'ampoule_service_time_seconds',
+     "Moving average of the time a call takes in a worker."),
+    ('spawnLatency', 'ampoule_spawn_latency_seconds',
+     "Moving average of the time a worker takes to be ready."),
+]
+
+# the gauges counting the workers in each state
+STATES = ('ready', 'busy', 'starting', 'retiring')
+
+# histograms of ampoule.pool.ProcessPool.metrics with their help
+HISTOGRAMS = {
+    'queueWait': "Time calls waited for a worker.",
+    'execution': "Time calls took in a worker.",
+    'spawn': "Time between spawning a worker and its being ready.",
+}
+
+
+
+def _snake(name):
+    """
+    Turn a camel case name into a snake case one.
+    """
+    return re.sub(r'([A-Z])', lambda m: '_' + m.group(1).lower(), name)
+
+
+def _labels(labels):
+    """
+    Format the labels of a sample.
+
+    @param labels: a list of C{(name, value)}, L{None} values are left
+                   out.
+    """
+    labels = [(name, value) for name, value in labels if value is not None]
+    if not labels:
+        return ''
+    return '{%s}' % (','.join(
+        '%s="%s"' % (name, value.replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in labels),)
+
+
+def _number(value):
+    """
+    Format the value of a sample.
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+def exposition(snapshot, pool=None):
+    """
+    Format a snapshot of the metrics of a pool.
+
+    @param snapshot: a L{ampoule.metrics.Metrics.snapshot}.
+
+    @param pool: the name of the pool, added to every sample as the
+                 C{pool} label.
+
+    @return: the text of the metrics.
+    """
+    if isinstance(pool, bytes):
+        pool = pool.decode('utf-8', 'replace')
+    lines = []
+
+    def _family(name, kind, help):
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+
+    def _sample(name, labels, value):
+        lines.append('%s%s %s' % (name, _labels([('pool', pool)] + labels),
+                                  _number(value)))
+
+    gauges = snapshot['gauges']
+    for key, name, help in GAUGES:
+        if gauges.get(key) is not None:
+            _family(name, 'gauge', help)
+            _sample(name, [], gauges[key])
+    _family('ampoule_workers_by_state', 'gauge',
+            "Worker processes in the pool by state.")
+    for state in STATES:
+        _sample('ampoule_workers_by_state', [('state', state)],
+                gauges.get(state, 0))
+
+    for key, value in sorted(snapshot['counters'].items()):
+        name = 'ampoule_%s_total' % (_snake(key),)
+        _family(name, 'counter', "Number of %s." % (
+            _snake(key).replace('_', ' '),))
+        _sample(name, [], value)
+
+    for key, byCommand in sorted(snapshot['histograms'].items()):
+        name = 'ampoule_%s_seconds' % (_snake(key),)
+        _family(name, 'histogram', HISTOGRAMS.get(key, key))
+        commands = sorted(c for c in byCommand if c is not None)
+        if not commands:
+            # the samples aren't about any command in particular
+            commands = [None]
+        for command in commands:
+            histogram = byCommand[command]
+            labels = [('command', command)]
+            for bound, count in histogram['buckets']:
+                _sample(name + '_bucket', labels + [('le', _number(bound))],
+                        count)
+            _sample(name + '_sum', labels, histogram['sum'])
+            _sample(name + '_count', labels, histogram['count'])
+
+    lines.append('')
+    return '\n'.join(lines)
+
+
+
+class MetricsResource(resource.Resource):
+    """
+    Serve the metrics of a pool to Prometheus.
+
+    Scrapes share the reactor with the calls to the pool, so the text is
+    formatted again only once every C{interval} seconds however often
+    it's requested.
+    """
+    isLeaf = True
+
+    def __init__(self, pool, interval=1.0, clock=None):
+        resource.Resource.__init__(self)
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.pool = pool
+        self.interval = interval
+        self.clock = clock
+        self._text = None
+        self._formatted = None
+
+    def render_GET(self, request):
+        now = self.clock.seconds()
+        if self._text is None or now - self._formatted >= self.interval:
+            self._text = exposition(self.pool.metrics.snapshot(),
+                                    self.pool.name).encode('utf-8')
+            self._formatted = now
+        request.setHeader(b'content-type', CONTENT_TYPE)
+        return self._text
+
+
+
+class MetricsSite(server.Site):
+    """
+    A site that doesn't log every scrape.
+    """
+
+    def log(self, request):
+        pass
@@ -0,0 +1,118 @@
+"""
+Regions of files, mapped in the children.
+
+A L{MappedRegion} argument names a range of bytes of a file. Only the
+path and the range go through AMP, the child maps the range and gets a
+read only C{memoryview} of it, so a big file can be worked on by many
+children at once without being read by the parent or copied through the
+pipes::
+
+    class CountLines(amp.Command):
+        arguments = [(b'region', MappedRegion())]
+        response = [(b'lines', amp.Integer())]
+
+    class Child(AMPChild):
+        @CountLines.responder
+        def countLines(self, region):
+            return {'lines': region.tobytes().count(b'\\n')}
+
+    def _sum(results):
+        return sum(result['lines'] for result in results)
+
+    regions = splitLines(path, parts=8)
+    pp.map(CountLines, [{'region': r} for r in regions], chunkSize=1
+        ).addCallback(_sum)
+
+The file must not be truncated while the children use it, reading a
+mapped page past its end kills the process.
+"""
+import collections
+import mmap
+import os
+
+from twisted.protocols import amp
+
+
+
+class FileRegion(collections.namedtuple('FileRegion',
+                                        ['path', 'offset', 'length'])):
+    """
+    The C{length} bytes of the file at C{path} starting at C{offset}.
+    """
+
+
+def _mapRegion(path, offset, length):
+    """
+    Map a region of a file read only.
+
+    @return: a C{memoryview} of the region.
+    """
+    if not length:
+        return memoryview(b"")
+    # the offset of a mapping has to be a multiple of the granularity
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with open(path, 'rb') as f:
+        m = mmap.mmap(f.fileno(), length + offset - start,
+                      offset=start, access=mmap.ACCESS_READ)
+    return memoryview(m)[offset - start:]
+
+
+def splitLines(path, parts=None, size=None):
+    """
+    Split a file in regions that start and end at line boundaries.
+
+    Give either the number of C{parts} that you want or their C{size} in
+    bytes. A region is as long as it takes to reach the end of the line
+    at its size, so regions can be longer than C{size} and fewer than
+    C{parts} when the lines are long.
+
+    @param path: The path of the file.
+    @type path: C{str}
+
+    @return: a C{list} of L{FileRegion} covering the whole file.
+    """
+    if (parts is None) == (size is None):
+        raise ValueError("give either parts or size")
+    path = os.path.abspath(path)
+    with open(path, 'rb') as f:
+        total = os.fstat(f.fileno()).st_size
+        if not total:
+            return []
+        if size is None:
+            size = -(-total // parts)
+        size = max(1, size)
+        m = mmap.mmap(f.fileno(), total, access=mmap.ACCESS_READ)
+    regions = []
+    try:
+        start = 0
+        while start < total:
+            end = start + size
+            if end < total:
+                newline = m.find(b"\n", end - 1)
+                end = total if newline == -1 else newline + 1
+            else:
+                end = total
+            regions.append(FileRegion(path, start, end - start))
+            start = end
+    finally:
+        m.close()
+    return regions
+
+
+class MappedRegion(amp.Argument):
+    """
+    A L{FileRegion}, received as a read only C{memoryview} of its bytes.
+    See the module documentation.
+
+    The path is made absolute before it's sent, as the children may run
+    in another directory.
+    """
+
+    def toString(self, inObject):
+        path, offset, length = inObject
+        path = os.path.abspath(path).encode('utf-8')
+        return b"%d:%d:%s" % (offset, length, path)
+
+    def fromString(self, inString):
+        offset, length, path = inString.split(b":", 2)
+        return _mapRegion(path.decode('utf-8'), int(offset), int(length))
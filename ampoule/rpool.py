@@ -1,8 +1,22 @@
 """
 This module implements a remote pool to use with AMP.
 """
+from twisted.internet import defer
 from twisted.protocols import amp
 
+from ampoule.pool import PoolOverloaded, POOL_OVERLOADED
+
+
+def _overloadedToAmpError(reason):
+    """
+    Turn a L{PoolOverloaded} failure into an AMP error that remote
+    clients can recognize by its L{POOL_OVERLOADED} code. The
+    description of the error is the retry after hint in seconds.
+    """
+    reason.trap(PoolOverloaded)
+    raise amp.RemoteAmpError(POOL_OVERLOADED, str(reason.value),
+                             local=reason)
+
 class AMPProxy(amp.AMP):
     """
     A Proxy AMP protocol that forwards calls to a wrapped
@@ -53,7 +67,11 @@ class AMPProxy(amp.AMP):
             # call doesn't pass the command as first argument since it
             # thinks that we are the actual receivers and callable is
             # already the responder while it isn't.
-            doWork = lambda **kw: self.wrapped(commandClass, **kw)
+            # PoolOverloaded is not one of the errors declared by the
+            # command so we translate it to an error clients can catch.
+            doWork = lambda **kw: defer.maybeDeferred(
+                self.wrapped, commandClass, **kw
+            ).addErrback(_overloadedToAmpError)
             # Now let's call the right function and wrap the result
             # dictionary.
             return self._wrapWithSerialization(doWork, commandClass)
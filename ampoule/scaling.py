@@ -0,0 +1,273 @@
+"""
+Load driven sizing of a L{ampoule.pool.ProcessPool}.
+"""
+import math
+
+from zope.interface import implementer
+
+from twisted import logger
+from twisted.internet import task
+
+from ampoule import iampoule
+
+
+
+log = logger.Logger()
+
+
+class LoadSample(object):
+    """
+    A snapshot of the load of a pool, as seen by a scaling policy.
+
+    @ivar processes: Number of workers in the pool.
+
+    @ivar starting: Number of workers in the pool that are not up yet.
+
+    @ivar inflight: Number of calls currently running in the workers that
+                    are up.
+
+    @ivar queueDepth: Number of calls waiting for a worker, including
+                      the ones sent to workers that are not up yet.
+
+    @ivar arrivalRate: Average number of calls per second received by
+                       the pool.
+
+    @ivar serviceTime: Average time in seconds a call takes in a worker,
+                       L{None} if unknown.
+
+    @ivar spawnLatency: Average time in seconds it takes to start a
+                        worker, L{None} if unknown.
+
+    @ivar perChild: Number of calls a single worker can run at once.
+
+    @ivar interval: Number of seconds between two regular evaluations of
+                    the load.
+    """
+
+    def __init__(self, processes, starting, inflight, queueDepth,
+                 arrivalRate, serviceTime, spawnLatency, perChild, interval):
+        self.processes = processes
+        self.starting = starting
+        self.inflight = inflight
+        self.queueDepth = queueDepth
+        self.arrivalRate = arrivalRate
+        self.serviceTime = serviceTime
+        self.spawnLatency = spawnLatency
+        self.perChild = perChild
+        self.interval = interval
+
+    def __repr__(self):
+        return ("LoadSample(processes=%r, starting=%r, inflight=%r, "
+                "queueDepth=%r, arrivalRate=%r, serviceTime=%r, "
+                "spawnLatency=%r, perChild=%r, interval=%r)" % (
+                    self.processes, self.starting, self.inflight,
+                    self.queueDepth, self.arrivalRate, self.serviceTime,
+                    self.spawnLatency, self.perChild, self.interval))
+
+
+@implementer(iampoule.IScalingPolicy)
+class QueueTheoryPolicy(object):
+    """
+    Size the pool from the offered load, following Little's law.
+
+    The offered load is the number of calls that are running on average,
+    the arrival rate times the service time. On top of it the policy
+    asks for enough workers to drain the current queue by the time new
+    workers would be up.
+
+    Until the service time is known the policy makes room for the calls
+    in flight and in the queue, but never more than doubles the pool.
+
+    The pool grows when the workers needed to run the load at
+    C{highUtilization} are more than the current ones, and shrinks only
+    when the workers needed at C{lowUtilization} are fewer. Loads in
+    between leave the pool alone, so it doesn't oscillate.
+
+    @ivar highUtilization: Fraction of the capacity of the pool we aim
+                           for when growing.
+
+    @ivar lowUtilization: Fraction of the capacity of the pool under
+                          which we shrink.
+    """
+
+    def __init__(self, highUtilization=0.8, lowUtilization=0.5):
+        assert 0 < lowUtilization < highUtilization <= 1, \
+            'utilizations must be 0 < low < high <= 1'
+        self.highUtilization = highUtilization
+        self.lowUtilization = lowUtilization
+
+    def targetSize(self, sample):
+        limit = None
+        if sample.serviceTime is None:
+            # nothing to reason with yet, just make room for what we see
+            needed = sample.inflight + sample.queueDepth
+            limit = 2 * max(sample.processes, 1)
+        else:
+            # while there's a queue every worker is busy, so the calls in
+            # flight don't tell much about the load: Little's law does.
+            load = sample.arrivalRate * sample.serviceTime
+            horizon = max(sample.spawnLatency or 0.0, sample.interval)
+            backlog = sample.queueDepth * sample.serviceTime / horizon
+            needed = load + backlog
+
+        grow = int(math.ceil(
+            needed / (self.highUtilization * sample.perChild)))
+        if limit is not None:
+            grow = min(grow, limit)
+        if grow > sample.processes:
+            return grow
+        shrink = int(math.ceil(
+            needed / (self.lowUtilization * sample.perChild)))
+        if shrink < sample.processes:
+            return shrink
+        return sample.processes
+
+
+class ScalingController(object):
+    """
+    Periodically look at the load of a pool and resize it according to
+    a scaling policy.
+
+    The load is evaluated every C{interval} seconds and every time a
+    call has to wait in the queue of the pool while no worker is on its
+    way up. Resizing is rate limited by two cooldowns: after a change
+    the pool doesn't grow again for C{upCooldown} seconds and doesn't
+    shrink for C{downCooldown} seconds.
+
+    Use it by passing it to the pool::
+
+        pp = ProcessPool(MyChild, min=1, max=32,
+                         scaler=ScalingController(downCooldown=60))
+
+    @ivar policy: A provider of L{iampoule.IScalingPolicy}.
+
+    @ivar interval: Seconds between two regular evaluations.
+
+    @ivar upCooldown: Seconds to wait after a change before growing.
+
+    @ivar downCooldown: Seconds to wait after a change before shrinking.
+
+    @ivar arrivalRate: Exponentially weighted moving average of the
+                       number of calls per second received by the pool.
+
+    @ivar pool: The L{ampoule.pool.ProcessPool} being sized.
+    """
+
+    pool = None
+    arrivalRate = 0.0
+    lastChange = None
+
+    # weight of the latest sample in the arrival rate average
+    _arrivalRateWeight = 0.3
+
+    def __init__(self, policy=None, interval=1.0, upCooldown=0.0,
+                 downCooldown=30.0, clock=None):
+        if policy is None:
+            policy = QueueTheoryPolicy()
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.policy = policy
+        self.interval = interval
+        self.upCooldown = upCooldown
+        self.downCooldown = downCooldown
+        self.clock = clock
+        self._lastTick = None
+        self._lastArrivals = 0
+        self.looping = task.LoopingCall(self.tick)
+        self.looping.clock = clock
+
+    def attach(self, pool):
+        """
+        Set the pool to be sized, called by the pool itself.
+        """
+        self.pool = pool
+
+    def start(self):
+        """
+        Start the periodic evaluation of the load.
+        """
+        if not self.looping.running:
+            self._lastTick = self.clock.seconds()
+            self._lastArrivals = self.pool.arrivals
+            self.looping.start(self.interval, now=False)
+
+    def stop(self):
+        """
+        Stop the periodic evaluation of the load.
+        """
+        if self.looping.running:
+            self.looping.stop()
+
+    def tick(self):
+        """
+        Update the arrival rate and resize the pool if needed.
+        """
+        n = self.clock.seconds()
+        elapsed = n - self._lastTick
+        if elapsed > 0:
+            rate = (self.pool.arrivals - self._lastArrivals) / elapsed
+            w = self._arrivalRateWeight
+            self.arrivalRate = w * rate + (1 - w) * self.arrivalRate
+        self._lastTick = n
+        self._lastArrivals = self.pool.arrivals
+        return self.evaluate()
+
+    def poke(self):
+        """
+        Notify the controller that a call had to wait for a worker.
+        """
+        pool = self.pool
+        # workers that are starting will take care of the queue, their
+        # effect will be seen at the next tick.
+        if pool.started and not pool.finished and not pool.starting:
+            self.evaluate()
+
+    def sample(self):
+        """
+        Take a snapshot of the load of the pool.
+
+        @rtype: L{LoadSample}
+        """
+        pool = self.pool
+        waiting = sum(pool._inflight.get(child, 0) for child in pool.starting)
+        return LoadSample(
+            processes=len(pool.processes),
+            starting=len(pool.starting),
+            inflight=sum(pool._inflight.values()) - waiting,
+            queueDepth=pool._queueDepth + waiting,
+            arrivalRate=self.arrivalRate,
+            serviceTime=pool.serviceTime,
+            spawnLatency=pool.spawnLatency,
+            perChild=pool.maxConcurrentPerChild,
+            interval=self.interval,
+        )
+
+    def evaluate(self):
+        """
+        Ask the policy for the size of the pool and apply it, if the
+        cooldowns allow it.
+
+        @return: a L{defer.Deferred} if workers are being stopped,
+                 L{None} otherwise.
+        """
+        pool = self.pool
+        sample = self.sample()
+        target = max(pool.min, min(pool.max,
+                                   self.policy.targetSize(sample)))
+        n = self.clock.seconds()
+        if self.lastChange is None:
+            sinceChange = None
+        else:
+            sinceChange = n - self.lastChange
+        if target > sample.processes:
+            if sinceChange is not None and sinceChange < self.upCooldown:
+                return
+            log.debug(u'Growing pool to {t}: {s!r}', t=target, s=sample)
+            self.lastChange = n
+            pool.growTo(target)
+        elif target < sample.processes:
+            if sinceChange is not None and sinceChange < self.downCooldown:
+                return
+            log.debug(u'Shrinking pool to {t}: {s!r}', t=target, s=sample)
+            self.lastChange = n
+            return pool.shrinkTo(target)
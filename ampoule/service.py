@@ -21,15 +21,33 @@ def makeService(options):
     recycle = options['recycle']
     childReactor = options['reactor']
     timeout = options['timeout']
+    maxQueue = options.get('max_queue')
+    maxQueueWait = options.get('max_queue_wait')
+    metricsPort = options['metrics_port']
+    metricsInterface = options['metrics_interface'] or ampinterface
 
     starter = ProcessStarter(packages=("twisted", "ampoule"), childReactor=childReactor)
-    pp = ProcessPool(child, parent, min, max, name, maxIdle, recycle, starter, timeout)
+    pp = ProcessPool(child, parent, min, max, name, maxIdle, recycle, starter, timeout,
+                     maxQueue=maxQueue, maxQueueWait=maxQueueWait)
     svc = AMPouleService(pp, child, ampport, ampinterface)
     svc.setServiceParent(ms)
 
+    if metricsPort is not None:
+        from twisted.application import internet
+        from ampoule import prometheus
+        site = prometheus.MetricsSite(prometheus.MetricsResource(pp))
+        internet.TCPServer(metricsPort, site, interface=metricsInterface
+                           ).setServiceParent(ms)
+
     return ms
 
 class AMPouleService(service.Service):
+    """
+    Serve the commands of the pool children over AMP.
+
+    Calls refused by an overloaded pool are sent back to the clients
+    as AMP errors with the L{ampoule.pool.POOL_OVERLOADED} code.
+    """
     def __init__(self, pool, child, port, interface):
         self.pool = pool
         self.port = port
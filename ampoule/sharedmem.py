@@ -0,0 +1,211 @@
+"""
+Shared memory lane for big byte values.
+
+A L{SharedBytes} argument or response value bigger than its threshold
+is written once to a file in a memory backed file system, C{/dev/shm}
+where there is one, and only the name of the file goes through AMP. The
+receiving side maps the file and gets a read only C{memoryview} of it,
+without copying it and without the value ever going through the pipes
+between the parent and its children::
+
+    class Checksum(amp.Command):
+        arguments = [(b'data', SharedBytes())]
+        response = [(b'crc', amp.Integer())]
+
+    class Child(AMPChild):
+        @Checksum.responder
+        def checksum(self, data):
+            return {'crc': zlib.crc32(data)}
+
+Values below the threshold are sent inline, they are received as a
+C{memoryview} too.
+
+The receiver removes the file as soon as it has mapped it, the mapping
+lives on until the C{memoryview} is released. Files that are never
+received, because a child died or was recycled with calls in flight, are
+named after the pid of the child and removed by the pool when the child
+goes away. Files left behind by processes that died altogether are
+removed the first time a process uses this module.
+"""
+import itertools
+import mmap
+import os
+import tempfile
+
+from twisted.protocols import amp
+from twisted.python import runtime
+
+from ampoule import main
+
+
+
+PREFIX = 'ampoule-shm-'
+
+# values smaller than this are sent inline
+THRESHOLD = 64 * 1024
+
+# the largest value we can send inline, with its marker
+_MAX_INLINE = amp.MAX_VALUE_LENGTH - 1
+
+_counter = itertools.count()
+_directory = None
+
+
+def segmentDirectory():
+    """
+    Find where to put the shared files, and clean up the ones left there
+    by dead processes the first time.
+    """
+    global _directory
+    if _directory is None:
+        if os.path.isdir('/dev/shm'):
+            _directory = '/dev/shm'
+        else:
+            _directory = tempfile.gettempdir()
+        if not runtime.platform.isWindows():
+            # os.kill would terminate the processes there
+            _sweepDead(_directory)
+    return _directory
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # it's there, it just isn't ours
+        return True
+    return True
+
+
+def _sweepDead(directory):
+    """
+    Remove the files of the processes that are gone.
+    """
+    for name in _segments(directory):
+        try:
+            owner, creator = [int(pid) for pid in
+                              name[len(PREFIX):].split('-')[:2]]
+        except ValueError:
+            continue
+        if not _alive(owner) and not _alive(creator):
+            _unlink(os.path.join(directory, name))
+
+
+def _segments(directory):
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return [name for name in names if name.startswith(PREFIX)]
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        # already gone, or still mapped on Windows
+        pass
+
+
+def sweep(pid):
+    """
+    Remove the files of the values going to or coming from the child
+    with the given pid, because it's gone.
+    """
+    directory = segmentDirectory()
+    prefix = '%s%d-' % (PREFIX, pid)
+    for name in _segments(directory):
+        if name.startswith(prefix):
+            _unlink(os.path.join(directory, name))
+
+
+def childPid(proto):
+    """
+    Get the pid of the child at the other end of a connection of the
+    parent, or L{None} if it isn't one.
+    """
+    connector = getattr(proto, 'transport', None)
+    if isinstance(connector, main.AMPConnector):
+        return getattr(connector.transport, 'pid', None)
+    return None
+
+
+def _write(data, owner):
+    """
+    Write a value to a new shared file.
+
+    @param owner: The pid of the child that this value is going to or
+                  coming from.
+
+    @return: the path of the file.
+    """
+    path = os.path.join(segmentDirectory(), '%s%d-%d-%d' % (
+        PREFIX, owner, os.getpid(), next(_counter)))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                 getattr(os, 'O_BINARY', 0), 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def _segmentPath(name):
+    """
+    Get the path of a shared file from its name, as received from the
+    other side.
+
+    @raise ValueError: if it's not the name of a shared file: the other
+                       side doesn't get to read or remove anything else.
+    """
+    separators = [sep for sep in (os.sep, os.altsep) if sep]
+    if (not name.startswith(PREFIX) or
+            any(sep in name for sep in separators) or
+            name in (os.curdir, os.pardir)):
+        raise ValueError("not a shared file: %r" % (name,))
+    return os.path.join(segmentDirectory(), name)
+
+
+def _map(path, size):
+    """
+    Map a shared file, and remove it.
+    """
+    with open(path, 'rb') as f:
+        m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    _unlink(path)
+    return memoryview(m)
+
+
+class SharedBytes(amp.Argument):
+    """
+    A byte value of any size, sent through shared memory when it's at
+    least C{threshold} bytes. See the module documentation.
+
+    The value sent can be anything that supports the buffer protocol, it
+    is received as a C{memoryview}. Values serialized without a connection,
+    like the keys of L{ampoule.cache.ResultCache}, are always inline: no
+    one would receive the file and remove it.
+    """
+
+    def __init__(self, threshold=THRESHOLD, optional=False):
+        amp.Argument.__init__(self, optional)
+        self.threshold = min(threshold, _MAX_INLINE + 1)
+
+    def toStringProto(self, value, proto):
+        value = memoryview(value)
+        if (value.nbytes < self.threshold or not value.nbytes or
+                proto is None):
+            return b"i" + value.tobytes()
+        owner = childPid(proto)
+        if owner is None:
+            owner = os.getpid()
+        # only the name goes through, the receiver looks for it in its
+        # own segmentDirectory
+        name = os.path.basename(_write(value, owner))
+        return b"s%d:%s" % (value.nbytes, name.encode('utf-8'))
+
+    def fromStringProto(self, inString, proto):
+        if inString[:1] == b"i":
+            return memoryview(inString)[1:]
+        size, name = inString[1:].split(b":", 1)
+        return _map(_segmentPath(name.decode('utf-8')), int(size))
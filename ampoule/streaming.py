@@ -0,0 +1,395 @@
+"""
+Streaming of values bigger than the 64 KiB limit of an AMP value.
+
+A L{Stream} argument or response value is sent as a sequence of
+L{StreamChunk} calls on the same connection as the command, and is
+read on the other side through a L{StreamReader}, chunk by chunk, as it
+arrives::
+
+    class Digest(amp.Command):
+        arguments = [(b'data', Stream())]
+        response = [(b'digest', amp.String())]
+
+    class Child(AMPChild):
+        @Digest.responder
+        def digest(self, data):
+            h = hashlib.sha256()
+            def _read(chunk):
+                if not chunk:
+                    return {'digest': h.hexdigest().encode()}
+                h.update(chunk)
+                return data.read().addCallback(_read)
+            return data.read().addCallback(_read)
+
+    pp.doWork(Digest, data=open('big.bin', 'rb'))
+
+The value sent can be C{bytes}, a file-like object, that is read in
+chunks, or any iterable of C{bytes}, like a generator. An iterable can
+also yield L{defer.Deferred}s firing with C{bytes}, to produce the
+stream asynchronously.
+
+The sender has at most L{WINDOW} chunks in flight and the receiver
+answers each of them only once it's read, so neither side buffers more
+than L{WINDOW} chunks however big the stream is. A stream must be read
+till its end, or its sender waits forever: a child that is told to shut
+down, because it's recycled or the pool shrinks, goes only once the
+streams it answered with were read.
+
+Both sides of the connection need to answer L{StreamChunk}: children
+based on L{ampoule.child.AMPChild} do, and so does L{StreamingAMP}, the
+default parent protocol of a pool. Custom parent protocols must inherit
+from L{StreamingAMP} to get streams from their children.
+"""
+from twisted.internet import defer
+from twisted.protocols import amp
+from twisted.python.compat import nativeString
+from twisted.python.failure import Failure
+
+from ampoule import codec, tracing
+
+
+
+# just below the 64 KiB limit of an AMP value
+CHUNK_SIZE = 60 * 1024
+
+# chunks of a stream in flight at any time
+WINDOW = 8
+
+
+class StreamError(Exception):
+    """
+    The sender of a stream failed to produce it.
+    """
+
+
+class StreamChunk(amp.Command):
+    """
+    A chunk of a stream. The last chunk of a stream has C{end} set, and
+    C{error} if the stream failed. The answer means that the chunk was
+    read.
+    """
+    commandName = b'ampoule.StreamChunk'
+    arguments = [(b'stream', amp.Integer()),
+                 (b'data', amp.String()),
+                 (b'end', amp.Boolean()),
+                 (b'error', amp.Unicode(optional=True))]
+
+
+class _Streams(object):
+    """
+    The streams going in and out of a connection.
+    """
+
+    def __init__(self):
+        self.lastId = 0
+        self.readers = {}
+        self.senders = set()
+        self._drainWaiters = []
+
+    def newId(self):
+        self.lastId += 1
+        return self.lastId
+
+    def reader(self, stream):
+        """
+        Get the reader of an incoming stream, creating it if this is the
+        first time we hear about it. Chunks can arrive before the box
+        with the stream itself.
+        """
+        reader = self.readers.get(stream)
+        if reader is None:
+            reader = self.readers[stream] = StreamReader()
+        return reader
+
+    def release(self, stream):
+        """
+        Forget about a stream once it's over and its box arrived.
+        """
+        reader = self.readers[stream]
+        if reader._claimed and reader._over:
+            del self.readers[stream]
+
+    def sent(self, sender):
+        """
+        An outgoing stream is over, all of its chunks were answered.
+        """
+        self.senders.discard(sender)
+        if not self.senders:
+            waiters, self._drainWaiters = self._drainWaiters, []
+            for d in waiters:
+                d.callback(None)
+
+    def drained(self):
+        """
+        @return: a L{defer.Deferred} firing once no stream is going out.
+        """
+        if not self.senders:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._drainWaiters.append(d)
+        return d
+
+    def connectionLost(self, reason):
+        readers, self.readers = self.readers, {}
+        for reader in readers.values():
+            reader._lost(reason)
+
+
+def _streamsOf(proto):
+    """
+    Get the streams of a connection.
+    """
+    if proto is None:
+        raise TypeError("streams need a connection")
+    streams = getattr(proto, '_ampouleStreams', None)
+    if streams is None:
+        streams = proto._ampouleStreams = _Streams()
+    return streams
+
+
+def streamChunkReceived(proto, stream, data, end, error=None):
+    """
+    Hand a chunk to the reader of its stream.
+
+    @return: a L{defer.Deferred} firing once the chunk is read.
+    """
+    streams = _streamsOf(proto)
+    result = streams.reader(stream)._received(data, end, error)
+    streams.release(stream)
+    return result
+
+
+def drained(proto):
+    """
+    Wait for the streams going out of a connection to be over, before
+    closing it.
+
+    @return: a L{defer.Deferred} firing once all of them were read.
+    """
+    streams = getattr(proto, '_ampouleStreams', None)
+    if streams is None:
+        return defer.succeed(None)
+    return streams.drained()
+
+
+def connectionLost(proto, reason):
+    """
+    Fail the streams that were coming through a connection.
+    """
+    streams = getattr(proto, '_ampouleStreams', None)
+    if streams is not None:
+        streams.connectionLost(reason)
+
+
+class StreamReader(object):
+    """
+    The receiving end of a L{Stream}.
+    """
+
+    _claimed = False
+    _over = False
+
+    def __init__(self):
+        # (data, deferred of the answer to its chunk)
+        self._chunks = []
+        self._reads = []
+        self._ended = False
+        self._failure = None
+
+    def read(self):
+        """
+        Read the next chunk of the stream.
+
+        @return: a L{defer.Deferred} firing with the C{bytes} of the next
+                 chunk, or C{b""} at the end of the stream. It fails with
+                 L{StreamError} if the sender failed to produce the
+                 stream.
+        """
+        if self._chunks:
+            data, answer = self._chunks.pop(0)
+            answer.callback({})
+            return defer.succeed(data)
+        if self._failure is not None:
+            return defer.fail(self._failure)
+        if self._ended:
+            return defer.succeed(b"")
+        d = defer.Deferred()
+        self._reads.append(d)
+        return d
+
+    def readAll(self):
+        """
+        Read the whole stream.
+
+        @return: a L{defer.Deferred} firing with all its C{bytes}.
+        """
+        chunks = []
+
+        def _read(data):
+            if not data:
+                return b"".join(chunks)
+            chunks.append(data)
+            return self.read().addCallback(_read)
+
+        return self.read().addCallback(_read)
+
+    def _received(self, data, end, error):
+        if end:
+            self._over = True
+        if error is not None:
+            self._fail(Failure(StreamError(error)))
+        elif end:
+            self._ended = True
+            reads, self._reads = self._reads, []
+            for d in reads:
+                d.callback(b"")
+        elif data:
+            if self._reads:
+                self._reads.pop(0).callback(data)
+            else:
+                answer = defer.Deferred()
+                self._chunks.append((data, answer))
+                return answer
+        return {}
+
+    def _lost(self, reason):
+        if not self._ended:
+            self._fail(reason)
+
+    def _fail(self, reason):
+        self._failure = reason
+        reads, self._reads = self._reads, []
+        for d in reads:
+            d.errback(reason)
+
+
+def _pieces(source):
+    """
+    Turn what is being streamed into an iterator of C{bytes} and
+    L{defer.Deferred}s.
+    """
+    if isinstance(source, bytes):
+        return (source[i:i + CHUNK_SIZE]
+                for i in range(0, len(source), CHUNK_SIZE))
+    if hasattr(source, 'read'):
+        return iter(lambda: source.read(CHUNK_SIZE), b"")
+    return iter(source)
+
+
+class _StreamSender(object):
+    """
+    Send a stream as a sequence of L{StreamChunk} calls, with at most
+    L{WINDOW} of them in flight.
+    """
+
+    def __init__(self, proto, stream, source):
+        self.proto = proto
+        self.stream = stream
+        self.source = source
+        self.pieces = _pieces(source)
+        self.pending = b""
+        self.inflight = 0
+        self.waiting = False
+        self.done = False
+
+    def start(self):
+        _streamsOf(self.proto).senders.add(self)
+        self._send()
+
+    def _send(self):
+        while (not self.done and not self.waiting and
+               self.inflight < WINDOW):
+            if not self.pending:
+                try:
+                    piece = next(self.pieces)
+                except StopIteration:
+                    self._finish()
+                    return
+                except:
+                    self._finish(Failure())
+                    return
+                if isinstance(piece, defer.Deferred):
+                    self.waiting = True
+                    piece.addCallbacks(self._produced, self._finish)
+                    return
+                self.pending = piece
+                continue
+            data = self.pending[:CHUNK_SIZE]
+            self.pending = self.pending[CHUNK_SIZE:]
+            self._write(data, False)
+
+    def _produced(self, piece):
+        self.waiting = False
+        self.pending += piece
+        self._send()
+
+    def _write(self, data, end, error=None):
+        self.inflight += 1
+        self.proto.callRemote(StreamChunk, stream=self.stream, data=data,
+                              end=end, error=error
+            ).addCallbacks(self._answered, self._lost)
+
+    def _answered(self, _):
+        self.inflight -= 1
+        if self.done and not self.inflight:
+            _streamsOf(self.proto).sent(self)
+            return
+        self._send()
+
+    def _finish(self, reason=None):
+        self.done = True
+        error = None
+        if reason is not None:
+            error = u"%s: %s" % (reason.type.__name__,
+                                 reason.getErrorMessage())
+        self._write(b"", True, error)
+        self._close()
+
+    def _lost(self, reason):
+        # the connection is gone, nobody is going to read the rest
+        if not self.done:
+            self._close()
+        self.done = True
+        _streamsOf(self.proto).sent(self)
+
+    def _close(self):
+        close = getattr(self.source, 'close', None)
+        if close is not None:
+            close()
+
+
+class Stream(amp.Argument):
+    """
+    A value of any size, sent as a stream. See the module documentation.
+
+    On the receiving side the value is a L{StreamReader}.
+    """
+
+    def toBox(self, name, strings, objects, proto):
+        source = self.retrieve(objects, nativeString(name), proto)
+        stream = _streamsOf(proto).newId()
+        strings[name] = b"%d" % (stream,)
+        _StreamSender(proto, stream, source).start()
+
+    def fromBox(self, name, strings, objects, proto):
+        stream = int(self.retrieve(strings, name, proto))
+        streams = _streamsOf(proto)
+        reader = streams.reader(stream)
+        reader._claimed = True
+        streams.release(stream)
+        objects[nativeString(name)] = reader
+
+
+class StreamingAMP(tracing.TracingAMP, codec.CodecAMP):
+    """
+    An L{amp.AMP} protocol that can receive streams, switch to another
+    L{codec} and have its calls stamped by the other side.
+    """
+
+    def streamChunk(self, stream, data, end, error=None):
+        return streamChunkReceived(self, stream, data, end, error)
+    StreamChunk.responder(streamChunk)
+
+    def connectionLost(self, reason):
+        codec.CodecAMP.connectionLost(self, reason)
+        connectionLost(self, reason)
@@ -0,0 +1,135 @@
+import json
+
+from twisted.trial import unittest
+
+from ampoule import commands
+from ampoule.bench import compare, runner, scenarios
+from ampoule.bench.__main__ import main
+
+
+class TestRunner(unittest.TestCase):
+
+    def test_quantile(self):
+        """
+        Test that quantiles are the nearest rank of the samples.
+        """
+        samples = list(range(1, 1001))
+        self.assertEquals(runner.quantile(samples, 0.5), 500)
+        self.assertEquals(runner.quantile(samples, 0.99), 990)
+        self.assertEquals(runner.quantile(samples, 0.999), 999)
+        self.assertEquals(runner.quantile(samples[:10], 0.999), 10)
+        self.assertEquals(runner.quantile([3], 0), 3)
+        self.assertIdentical(runner.quantile([], 0.5), None)
+
+    def test_summarize(self):
+        """
+        Test that the results have the throughput of the calls that
+        succeeded and their latencies in milliseconds.
+        """
+        scenario = scenarios.byName(['ping'])[0]
+        result = runner.summarize(scenario, 5, [0.004, 0.001, 0.002, 0.003],
+                                  {'PoolOverloaded': 1}, 2.0)
+        self.assertEquals(result['throughput'], 2.0)
+        self.assertEquals(result['command'], 'Ping')
+        self.assertEquals(result['latency']['p50'], 2.0)
+        self.assertEquals(result['latency']['p999'], 4.0)
+        self.assertEquals(result['latency']['max'], 4.0)
+        self.assertEquals(result['errors'], {'PoolOverloaded': 1})
+        json.dumps(result)
+
+    def _check(self, result, calls):
+        self.assertEquals(result['calls'], calls)
+        self.assertEquals(result['errors'], {})
+        self.assertTrue(result['throughput'] > 0)
+        latency = result['latency']
+        self.assertTrue(0 < latency['p50'] <= latency['p99'] <=
+                        latency['p999'] <= latency['max'])
+
+    def test_pool(self):
+        """
+        Test that a scenario runs through a pool.
+        """
+        scenario = scenarios.Scenario(
+            'test', scenarios.Spin, {'n': 10}, 20, 4, 'pool',
+            {'min': 2, 'max': 2, 'readyHandshake': True})
+        return runner.runScenario(scenario, warmup=4).addCallback(
+            self._check, 20)
+
+    def test_service(self):
+        """
+        Test that a scenario runs through the service, scaled.
+        """
+        scenario = scenarios.Scenario(
+            'test', commands.Echo, {'data': b'x'}, 40, 4, 'service',
+            {'min': 2, 'max': 2, 'readyHandshake': True})
+        return runner.runScenario(scenario, scale=0.5, warmup=4).addCallback(
+            self._check, 20)
+
+    def test_run(self):
+        """
+        Test that a run has the results of every scenario and the
+        environment they ran in.
+        """
+        scenario = scenarios.Scenario('test', commands.Ping, {}, 10, 2,
+                                      'pool', {'min': 1, 'max': 1})
+        reports = []
+
+        def _check(results):
+            self.assertEquals(list(results['scenarios']), ['test'])
+            self.assertEquals(reports,
+                              [('test', results['scenarios']['test'])])
+            self.assertIn('python', results['environment'])
+            json.dumps(results)
+        return runner.run([scenario], warmup=0,
+                          report=lambda *args: reports.append(args)
+            ).addCallback(_check)
+
+    def test_scenarios(self):
+        """
+        Test that scenario names are unique, and that unknown ones can't
+        be picked.
+        """
+        names = [scenario.name for scenario in scenarios.SCENARIOS]
+        self.assertEquals(len(names), len(set(names)))
+        self.assertRaises(KeyError, scenarios.byName, ['nope'])
+
+
+class TestCompare(unittest.TestCase):
+
+    def _results(self, **scenarios):
+        return {'scenarios': dict(
+            (name, {'throughput': throughput,
+                    'latency': {'p50': p50, 'p99': p99, 'p999': p999}})
+            for name, (throughput, p50, p99, p999) in scenarios.items())}
+
+    def test_compare(self):
+        """
+        Test that figures of the scenarios in both runs are compared, and
+        that a change for the worse beyond the threshold is a regression.
+        """
+        old = self._results(ping=(1000, 1.0, 2.0, 4.0), gone=(1, 1, 1, 1))
+        new = self._results(ping=(800, 1.0625, 1.0, None), added=(1, 1, 1, 1))
+        rows = compare.compare(old, new, threshold=0.1)
+        self.assertEquals(rows, [
+            ('ping', 'throughput', 1000, 800, -0.2, True),
+            ('ping', 'p50', 1.0, 1.0625, 0.0625, False),
+            ('ping', 'p99', 2.0, 1.0, -0.5, False),
+            ('ping', 'p999', 4.0, None, None, False)])
+        table = compare.format(rows)
+        self.assertIn('-20.0% !', table)
+        self.assertNotIn('gone', table)
+
+    def test_main(self):
+        """
+        Test that the comparison exits with 1 when there are regressions.
+        """
+        paths = []
+        for throughput in 1000, 1000, 500:
+            paths.append(self.mktemp())
+            with open(paths[-1], 'w') as f:
+                json.dump(self._results(ping=(throughput, 1, 1, 1)), f)
+        self.assertEquals(main(['compare', paths[0], paths[1]]), 0)
+        self.assertEquals(main(['compare', paths[0], paths[2]]), 1)
+        self.assertEquals(main(['compare', '-t', '0.6', paths[0], paths[2]]),
+                          0)
+        self.assertEquals(main(['compare', paths[0]]), 2)
@@ -0,0 +1,182 @@
+from twisted.internet import defer, task
+from twisted.protocols import amp
+from twisted.trial import unittest
+
+from ampoule import cache, commands, pool
+
+
+class Square(amp.Command):
+    arguments = [(b'n', amp.Integer())]
+    response = [(b'square', amp.Integer())]
+    cacheable = True
+
+
+class ShortLived(Square):
+    cacheTTL = 1
+
+
+class CachedEcho(commands.Echo):
+    commandName = b'Echo'
+    cacheable = True
+
+
+class Backend(object):
+    """
+    Answer L{Square} calls when told to, keeping track of them.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def fetch(self, n):
+        d = defer.Deferred()
+        self.calls.append((n, d))
+        return d
+
+    def answer(self):
+        for n, d in self.calls:
+            if not d.called:
+                d.callback({'square': n * n})
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = cache.ResultCache(ttl=10, clock=self.clock)
+        self.backend = Backend()
+
+    def call(self, n, command=Square, **kwargs):
+        kwargs['n'] = n
+        return self.cache.call(command, kwargs,
+                               lambda: self.backend.fetch(n))
+
+    def test_hit(self):
+        """
+        Test that a response is served from the cache the second time.
+        """
+        first = self.call(3)
+        self.backend.answer()
+        second = self.call(3)
+        self.assertEquals(self.successResultOf(first), {'square': 9})
+        self.assertEquals(self.successResultOf(second), {'square': 9})
+        self.assertEquals(len(self.backend.calls), 1)
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_optionsNotInKey(self):
+        """
+        Test that the options of the pool don't change the cache key.
+        """
+        self.call(3)
+        self.backend.answer()
+        self.successResultOf(self.call(3, _timeout=5, _priority=1))
+        self.assertEquals(self.cache.hits, 1)
+
+    def test_coalesce(self):
+        """
+        Test that identical calls made while one is in flight share its
+        response.
+        """
+        l = [self.call(4) for i in range(3)]
+        self.assertEquals(len(self.backend.calls), 1)
+        self.assertEquals(self.cache.coalesced, 2)
+        self.backend.answer()
+        for d in l:
+            self.assertEquals(self.successResultOf(d), {'square': 16})
+
+    def test_failureNotCached(self):
+        """
+        Test that a failure goes to every waiting call and isn't cached.
+        """
+        first = self.call(5)
+        second = self.call(5)
+        self.backend.calls[0][1].errback(ValueError())
+        self.failureResultOf(first, ValueError)
+        self.failureResultOf(second, ValueError)
+        self.call(5)
+        self.assertEquals(len(self.backend.calls), 2)
+        self.assertEquals(len(self.cache), 0)
+
+    def test_ttl(self):
+        """
+        Test that a response is not used after its TTL, and that commands
+        can set their own.
+        """
+        self.call(2)
+        self.call(2, ShortLived)
+        self.backend.answer()
+        self.clock.advance(5)
+        self.call(2)
+        self.call(2, ShortLived)
+        self.assertEquals(len(self.backend.calls), 3)
+        self.clock.advance(6)
+        self.call(2)
+        self.assertEquals(len(self.backend.calls), 4)
+
+    def test_byteBudget(self):
+        """
+        Test that the least recently used responses are evicted to keep
+        the cache within its byte budget.
+        """
+        self.call(1)
+        self.backend.answer()
+        size = self.cache.size
+        # room for 3 of them, the square of 4 takes one more byte
+        self.cache.maxBytes = 3 * size + 1
+        self.call(2)
+        self.call(3)
+        self.backend.answer()
+        # 1 becomes the most recently used
+        self.call(1)
+        self.call(4)
+        self.backend.answer()
+        self.assertEquals(self.cache.evictions, 1)
+        self.assertTrue(self.cache.size <= self.cache.maxBytes)
+        self.call(2)
+        self.assertEquals(self.cache.misses, 5)
+        self.call(1)
+        self.assertEquals(self.cache.misses, 5)
+
+    def test_responseCopied(self):
+        """
+        Test that changing a response doesn't change the cached one.
+        """
+        first = self.call(6)
+        self.backend.answer()
+        self.successResultOf(first)['square'] = 0
+        self.assertEquals(self.successResultOf(self.call(6)),
+                          {'square': 36})
+
+
+class TestPoolCache(unittest.TestCase):
+
+    def test_poolCache(self):
+        """
+        Test that a pool with a result cache answers repeated calls of
+        cacheable commands without going to a child.
+        """
+        pp = pool.ProcessPool(min=1, max=1, resultCache=cache.ResultCache())
+        self.addCleanup(pp.stop)
+
+        def _checks(results):
+            self.assertEquals([result['response'] for result in results],
+                              [b"hi"] * 3)
+            self.assertEquals(pp.arrivals, 2)
+            self.assertEquals(pp.resultCache.coalesced, 1)
+            self.assertEquals(pp.resultCache.hits, 0)
+            return pp.doWork(CachedEcho, data=b"hi")
+
+        def _cached(result):
+            self.assertEquals(result['response'], b"hi")
+            self.assertEquals(pp.arrivals, 2)
+            self.assertEquals(pp.resultCache.hits, 1)
+            # commands that didn't opt in always go to a child
+            return pp.doWork(commands.Echo, data=b"hi")
+
+        return pp.start(
+            ).addCallback(lambda _: defer.gatherResults([
+                pp.doWork(CachedEcho, data=b"hi"),
+                pp.doWork(CachedEcho, data=b"hi"),
+                pp.doWork(commands.Echo, data=b"hi")])
+            ).addCallback(_checks
+            ).addCallback(_cached
+            ).addCallback(lambda _: self.assertEquals(pp.arrivals, 3))
@@ -0,0 +1,191 @@
+from twisted.protocols import amp
+from twisted.test import iosim
+from twisted.trial import unittest
+
+from ampoule import codec, main, pool
+from ampoule.codec import CompactCodec
+from ampoule.commands import Echo
+from ampoule.test.test_streaming import StreamingChild, Upload, Download
+
+
+class Sum(amp.Command):
+    arguments = [(b'a', amp.Integer()),
+                 (b'b', amp.Integer()),
+                 (b'label', amp.Unicode(optional=True))]
+    response = [(b'total', amp.Integer())]
+
+
+class Server(codec.CodecAMP):
+    @Sum.responder
+    def sum(self, a, b, label=None):
+        return {'total': a + b}
+
+    @Echo.responder
+    def echo(self, data):
+        return {'response': data}
+
+
+class PlainServer(amp.AMP):
+    @Echo.responder
+    def echo(self, data):
+        return {'response': data}
+
+
+class SumChild(StreamingChild):
+    @Sum.responder
+    def sum(self, a, b, label=None):
+        return {'total': a + b}
+
+
+class TestCompactCodec(unittest.TestCase):
+
+    def _roundTrip(self, boxes, step=None):
+        encoder, decoder = CompactCodec(), CompactCodec()
+        wire = b"".join(encoder.encode(box) for box in boxes)
+        if step is None:
+            return decoder.decode(wire), wire
+        received = []
+        for i in range(0, len(wire), step):
+            received.extend(decoder.decode(wire[i:i + step]))
+        return received, wire
+
+    def test_roundTrip(self):
+        """
+        Test that boxes are decoded as they were encoded, with their
+        command, even when the bytes arrive a few at a time.
+        """
+        boxes = [amp.AmpBox({b'_command': b'Sum', b'_ask': b'%x' % (i,),
+                             b'a': b'%d' % (i,), b'b': b'2'})
+                 for i in range(10)]
+        boxes.append(amp.AmpBox({b'_answer': b'1', b'total': b'3'}))
+        boxes.append(amp.AmpBox({b'_command': b'Sum', b'_ask': b'b',
+                                 b'a': b'1', b'b': b'2', b'label': b'x'}))
+        for step in None, 1, 3:
+            received, wire = self._roundTrip(boxes, step)
+            self.assertEquals(received, boxes)
+
+    def test_shapes(self):
+        """
+        Test that the keys of a shape are sent only the first time.
+        """
+        box = amp.AmpBox({b'_command': b'Sum', b'_ask': b'1',
+                          b'aaaaaaaa': b'1', b'bbbbbbbb': b'2'})
+        encoder = CompactCodec()
+        first = encoder.encode(box)
+        second = encoder.encode(box)
+        self.assertIn(b'aaaaaaaa', first)
+        self.assertNotIn(b'aaaaaaaa', second)
+        self.assertEquals(len(second), 8)
+        self.assertTrue(len(second) < len(box.serialize()) / 4)
+
+    def test_manyShapes(self):
+        """
+        Test that boxes are sent with their keys once there are too many
+        shapes.
+        """
+        self.patch(codec, 'MAX_SHAPES', 2)
+        boxes = [amp.AmpBox({b'k%d' % (i,): b'v', b'_answer': b'1'})
+                 for i in range(5)]
+        received, wire = self._roundTrip(boxes * 2, 2)
+        self.assertEquals(received, boxes * 2)
+
+    def test_bigValues(self):
+        """
+        Test that values aren't bound by the size limit of AMP.
+        """
+        box = amp.AmpBox({b'_answer': b'1', b'data': b'z' * 200000})
+        received, wire = self._roundTrip([box], 4096)
+        self.assertEquals(received, [box])
+
+    def test_garbage(self):
+        """
+        Test that a record that refers to an unknown shape fails.
+        """
+        self.assertRaises(codec.CodecError, CompactCodec().decode,
+                          b"\x02\x05\x00")
+
+
+class TestNegotiation(unittest.TestCase):
+
+    def _connect(self, serverClass=Server):
+        self.client, self.server, self.pump = (
+            iosim.connectedServerAndClient(serverClass, codec.CodecAMP))
+
+    def test_negotiate(self):
+        """
+        Test that both sides switch codec once the server accepts it, and
+        that the calls made meanwhile are sent with the codec.
+        """
+        self._connect()
+        d = codec.negotiate(self.client, CompactCodec)
+        calls = [self.client.callRemote(Sum, a=i, b=1) for i in range(5)]
+        self.assertEquals(len(self.client._held), 5)
+        self.pump.flush()
+        self.assertTrue(self.successResultOf(d))
+        self.assertIsInstance(self.client.codec, CompactCodec)
+        self.assertIsInstance(self.server.codec, CompactCodec)
+        self.assertEquals([self.successResultOf(c)['total'] for c in calls],
+                          [1, 2, 3, 4, 5])
+        d = self.client.callRemote(Echo, data=b"hi")
+        self.pump.flush()
+        self.assertEquals(self.successResultOf(d), {'response': b"hi"})
+
+    def test_unknownCodec(self):
+        """
+        Test that a codec that the other side can't import is refused and
+        both sides keep speaking AMP.
+        """
+        self._connect()
+
+        class Unknown(CompactCodec):
+            pass
+
+        d = codec.negotiate(self.client, Unknown)
+        call = self.client.callRemote(Sum, a=1, b=2)
+        self.pump.flush()
+        self.assertFalse(self.successResultOf(d))
+        self.assertIdentical(self.client.codec, None)
+        self.assertIdentical(self.server.codec, None)
+        self.assertEquals(self.successResultOf(call), {'total': 3})
+
+    def test_oldPeer(self):
+        """
+        Test that a peer that doesn't know about codecs keeps getting AMP.
+        """
+        self._connect(PlainServer)
+        d = codec.negotiate(self.client, CompactCodec)
+        call = self.client.callRemote(Echo, data=b"hi")
+        self.pump.flush()
+        self.assertFalse(self.successResultOf(d))
+        self.assertIdentical(self.client.codec, None)
+        self.assertEquals(self.successResultOf(call), {'response': b"hi"})
+        self.flushLoggedErrors(amp.UnhandledCommand)
+
+
+class TestPoolCodec(unittest.TestCase):
+
+    def test_pool(self):
+        """
+        Test that a pool can talk to its children with a codec, streams
+        included.
+        """
+        starter = main.ProcessStarter(packages=("twisted",),
+                                      codec=CompactCodec)
+        pp = pool.ProcessPool(ampChild=SumChild, min=1, max=1,
+                              starter=starter)
+        self.addCleanup(pp.stop)
+        data = b"q" * (300 * 1024)
+
+        def _checks(_):
+            for child in pp.processes:
+                self.assertIsInstance(child.codec, CompactCodec)
+
+        return pp.start(
+            ).addCallback(lambda _: pp.doWork(Sum, a=40, b=2)
+            ).addCallback(lambda r: self.assertEquals(r['total'], 42)
+            ).addCallback(lambda _: pp.doWork(Upload, data=data)
+            ).addCallback(lambda r: self.assertEquals(r['size'], len(data))
+            ).addCallback(lambda _: pp.doWork(Download, size=200000)
+            ).addCallback(lambda r: r['data'].readAll()
+            ).addCallback(lambda d: self.assertEquals(len(d), 200000)
+            ).addCallback(_checks)
@@ -0,0 +1,94 @@
+from twisted.trial import unittest
+
+from ampoule import metrics
+from ampoule.test.test_scaling import LoadSimulation
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_buckets(self):
+        """
+        Test that samples are counted in the bucket of the first bound
+        they don't exceed, and that the snapshot is cumulative.
+        """
+        h = metrics.Histogram(bounds=(1, 2, 4))
+        for value in 0.5, 1, 1.5, 3, 3, 10:
+            h.observe(value)
+        h.observe(2, n=2)
+        self.assertEquals(h.counts, [2, 3, 2, 1])
+        snapshot = h.snapshot()
+        self.assertEquals(snapshot['buckets'],
+                          [(1, 2), (2, 5), (4, 7), (metrics.INFINITY, 8)])
+        self.assertEquals(snapshot['count'], 8)
+        self.assertEquals(snapshot['sum'], 23)
+        self.assertEquals(snapshot['max'], 10)
+
+    def test_quantile(self):
+        """
+        Test that quantiles are estimated within their bucket, and never
+        above the largest sample.
+        """
+        h = metrics.Histogram(bounds=(0.1, 0.2, 0.4))
+        self.assertEquals(h.quantile(0.5), 0)
+        for i in range(100):
+            h.observe(0.15)
+        self.assertTrue(0.1 <= h.quantile(0.5) <= 0.15)
+        self.assertEquals(h.quantile(1), 0.15)
+        h.observe(7)
+        self.assertEquals(h.quantile(1), 7)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_snapshot(self):
+        """
+        Test that a snapshot reads the gauges and doesn't change with the
+        metrics.
+        """
+        m = metrics.Metrics()
+        value = [3]
+        m.gauge('things', lambda: value[0])
+        m.increment('calls')
+        m.increment('calls', 2)
+        m.observe('execution', 0.01, 'Echo')
+        m.observe('execution', 0.02, 'Ping', n=4)
+        snapshot = m.snapshot()
+        value[0] = 5
+        m.increment('calls')
+        m.observe('execution', 0.01, 'Echo')
+        self.assertEquals(snapshot['counters'], {'calls': 3})
+        self.assertEquals(snapshot['gauges'], {'things': 3})
+        executions = snapshot['histograms']['execution']
+        self.assertEquals(set(executions), set([None, 'Echo', 'Ping']))
+        self.assertEquals(executions[None]['count'], 5)
+        self.assertEquals(executions['Echo']['count'], 1)
+        self.assertEquals(m.snapshot()['gauges'], {'things': 5})
+
+
+class TestPoolMetrics(unittest.TestCase):
+
+    def test_pool(self):
+        """
+        Test that a pool counts its calls, spawns and recycles, and keeps
+        the latencies of its commands.
+        """
+        sim = LoadSimulation(self, spawnLatency=0.5, serviceTime=0.1,
+                             min=2, max=2, scaler=None, recycleAfter=10)
+        self.addCleanup(sim.stop)
+        self.addCleanup(sim.pool.looping.stop)
+        sim.start()
+        sim.run(5, 10)
+        sim.run(1, 0)
+        snapshot = sim.pool.metrics.snapshot()
+        counters = snapshot['counters']
+        self.assertEquals(counters['calls'], 50)
+        self.assertEquals(counters['completed'], 50)
+        self.assertEquals(counters['recycles'], 4)
+        self.assertEquals(counters['spawns'], 6)
+        self.assertEquals(snapshot['gauges']['workers'], 2)
+        self.assertEquals(snapshot['gauges']['queued'], 0)
+        self.assertEquals(snapshot['histograms']['spawn'][None]['count'], 6)
+        execution = sim.pool.metrics.histograms['execution']['Echo']
+        self.assertAlmostEqual(execution.quantile(0.5), 0.1, 1)
+        waits = snapshot['histograms']['queueWait']['Echo']
+        self.assertEquals(waits['count'], 50)
@@ -5,7 +5,7 @@ import os.path
 from io import BytesIO as sio
 import tempfile
 
-from twisted.internet import error, defer, reactor
+from twisted.internet import error, defer, reactor, task
 from twisted.python import failure
 from twisted.trial import unittest
 from twisted.protocols import amp
@@ -119,6 +119,56 @@ class WaitingChild(child.AMPChild):
         self.deferred.callback('')
         return {}
 
+class Gate(amp.Command):
+    arguments = [(b'data', amp.String())]
+    response = [(b'response', amp.String())]
+
+class Release(amp.Command):
+    response = [(b'released', amp.Integer())]
+
+class GatedChild(child.AMPChild):
+    """
+    A child that holds every L{Gate} call until it gets a L{Release}.
+    """
+    def __init__(self):
+        child.AMPChild.__init__(self)
+        self.pending = []
+
+    @Gate.responder
+    def gate(self, data):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d.addCallback(lambda _: {'response': data})
+
+    @Release.responder
+    def release(self):
+        pending, self.pending = self.pending, []
+        for d in pending:
+            d.callback(None)
+        return {'released': len(pending)}
+
+class GatedPidChild(GatedChild, PidChild):
+    pass
+
+class MaybeFail(amp.Command):
+    arguments = [(b'data', amp.String())]
+    response = [(b'response', amp.String())]
+    errors = {ValueError: b'VALUE_ERROR'}
+
+class MaybeFailChild(child.AMPChild):
+    @MaybeFail.responder
+    def maybeFail(self, data):
+        if data == b"bad":
+            raise ValueError(data)
+        if data == b"boom":
+            raise RuntimeError(data)
+        return {'response': data}
+
+class BatchedMaybeFail(MaybeFail):
+    commandName = b'MaybeFail'
+    batchWindow = 0.05
+    batchSize = 10
+
 class HangForever(amp.Command):
     pass
 
@@ -195,6 +245,114 @@ class TempDirChild(child.AMPChild):
         return {'cwd': os.getcwd()}
 
 
+class Hog(amp.Command):
+    arguments = [(b'size', amp.Integer())]
+
+
+class HogChild(PidChild):
+    """
+    A child that keeps the memory it is asked to allocate.
+    """
+    hog = None
+
+    @Hog.responder
+    def allocate(self, size):
+        self.hog = bytearray(size)
+        return {}
+
+
+class SlowStartChild(PidChild):
+    """
+    A child that takes a while to get ready.
+    """
+    def __enter__(self):
+        import time
+        time.sleep(0.5)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class Touch(amp.Command):
+    pass
+
+class Warmth(amp.Command):
+    response = [(b'touched', amp.Integer()),
+                (b'warmed', amp.Boolean()),
+                (b'loaded', amp.ListOf(amp.Unicode()))]
+
+class WarmChild(PidChild):
+    """
+    A child that tells how it was warmed up.
+    """
+    preload = ('xml.dom.minidom',)
+    touched = 0
+    warmed = False
+
+    def warm(self):
+        self.warmed = True
+
+    @Touch.responder
+    def touch(self):
+        self.touched += 1
+        return {}
+
+    @Warmth.responder
+    def warmth(self):
+        import sys
+        return {'touched': self.touched, 'warmed': self.warmed,
+                'loaded': [name for name in ('xml.dom.minidom', 'colorsys')
+                           if name in sys.modules]}
+
+class ColdChild(PidChild):
+    """
+    A child whose warm-up fails once, as long as a file is there.
+    """
+    def __init__(self, marker):
+        PidChild.__init__(self)
+        self.marker = marker
+
+    def warm(self):
+        if os.path.exists(self.marker):
+            os.unlink(self.marker)
+            raise RuntimeError("too cold")
+
+class FrozenChild(PidChild):
+    """
+    A child whose warm-up always fails.
+    """
+    def warm(self):
+        raise RuntimeError("frozen")
+
+class Sleep(amp.Command):
+    arguments = [(b'seconds', amp.Float())]
+    response = [(b'thread', amp.Unicode())]
+
+class BlockingChild(PidChild):
+    """
+    A child that sleeps on its threads, two of them at most.
+    """
+    maxThreads = 2
+
+    @Sleep.responder
+    @child.blocking
+    def sleep(self, seconds):
+        import threading, time
+        time.sleep(seconds)
+        return {'thread': threading.current_thread().name}
+
+
+class StuckChild(PidChild):
+    """
+    A child that sleeps without answering anything else meanwhile.
+    """
+    @Sleep.responder
+    def sleep(self, seconds):
+        import threading, time
+        time.sleep(seconds)
+        return {'thread': threading.current_thread().name}
+
+
 class TestAMPConnector(unittest.TestCase):
     def setUp(self):
         """
@@ -309,6 +467,30 @@ main()
         amp, finished = starter.startPythonProcess(main.AMPConnector(a), "I'll be ignored")
         return finished.addCallback(lambda _: self.assertEquals(s.getvalue(), STRING))
 
+    def test_environmentCache(self):
+        """
+        Test that the environment of the children is computed once and
+        computed again when the settings it comes from change.
+        """
+        import importlib.util
+        calls = []
+        findSpec = importlib.util.find_spec
+        def _findSpec(name):
+            calls.append(name)
+            return findSpec(name)
+        self.patch(importlib.util, 'find_spec', _findSpec)
+
+        starter = main.ProcessStarter(packages=("twisted",),
+                                      env={"FOOBAR": "ciao"})
+        env = starter.environment()
+        self.assertIdentical(starter.environment(), env)
+        self.assertEquals(env["FOOBAR"], "ciao")
+        self.assertEquals(sorted(calls), ["ampoule", "twisted"])
+
+        starter.env["FOOBAR"] = "hello"
+        self.assertEquals(starter.environment()["FOOBAR"], "hello")
+        self.assertEquals(len(calls), 4)
+
     def test_startAMPProcess(self):
         """
         Test that you can start an AMP subprocess and that it correctly
@@ -556,6 +738,532 @@ class TestProcessPool(unittest.TestCase):
             ).addCallback(_checks
             ).addCallback(lambda _: pp.stop())
 
+    def test_concurrentCallsPerChild(self):
+        """
+        Test that a child takes up to maxConcurrentPerChild calls at once
+        before further calls get queued.
+        """
+        pp = pool.ProcessPool(ampChild=GatedChild, min=1, max=1,
+                              maxConcurrentPerChild=3)
+
+        def _checks(_):
+            child = next(iter(pp.processes))
+            l = [pp.doWork(Gate, data=b"%d" % (x,)) for x in range(4)]
+            self.assertEquals(len(pp.processes), 1)
+            self.assertEquals(pp._inflight[child], 3)
+            self.assertEquals(pp.ready, set())
+            self.assertEquals(pp.busy, set([child]))
+            self.assertEquals(len(pp._queue), 1)
+
+            def _released(result):
+                self.assertEquals(result, {'released': 3})
+                return defer.DeferredList(l[:3], fireOnOneErrback=True)
+
+            def _firstBatch(_):
+                # the queued call went to the same child
+                self.assertEquals(len(pp._queue), 0)
+                self.assertEquals(pp._inflight[child], 1)
+                self.assertEquals(pp.ready, set([child]))
+                return child.callRemote(Release)
+
+            def _done(_):
+                return l[3].addCallback(self.assertEquals,
+                                        {'response': b"3"})
+
+            return child.callRemote(Release
+                ).addCallback(_released
+                ).addCallback(_firstBatch
+                ).addCallback(_done)
+
+        return pp.start(
+            ).addCallback(_checks
+            ).addCallback(lambda _: pp.stop())
+
+    def test_shrinkWithCallsInFlight(self):
+        """
+        Test that shrinking a pool whose children all have calls in
+        flight takes the stopped child out of rotation for good, and
+        stops it once its calls are done.
+        """
+        pp = pool.ProcessPool(ampChild=GatedChild, min=2, max=2,
+                              maxConcurrentPerChild=3)
+
+        def _checks(_):
+            children = set(pp.processes)
+            l = [pp.doWork(Gate, data=b"%d" % (x,)) for x in range(4)]
+            self.assertTrue(all(pp._inflight[c] for c in children))
+            stopped = pp.adjustPoolSize(min=1, max=1)
+            [stopping] = pp._retiring
+            self.assertNotIn(stopping, pp.ready)
+
+            def _released(_):
+                return defer.DeferredList(l, fireOnOneErrback=True)
+
+            def _done(_):
+                self.assertEquals(len(pp.processes), 1)
+                self.assertEquals(pp.ready, pp.processes)
+                self.assertNotIn(stopping, pp.processes)
+                [remaining] = pp.processes
+                d = pp.doWork(Gate, data=b"x")
+                remaining.callRemote(Release)
+                return d.addCallback(self.assertEquals, {'response': b"x"})
+
+            return defer.gatherResults(
+                [c.callRemote(Release) for c in children]
+                ).addCallback(_released
+                ).addCallback(lambda _: stopped
+                ).addCallback(_done)
+
+        return pp.start(
+            ).addCallback(_checks
+            ).addCallback(lambda _: pp.stop())
+
+    def test_recyclingWaitsForCallsInFlight(self):
+        """
+        Test that a child that reaches recycleAfter with other calls in
+        flight stops getting calls and is only replaced once they are
+        all done.
+        """
+        pp = pool.ProcessPool(ampChild=GatedChild, min=1, max=1,
+                              recycleAfter=2, maxConcurrentPerChild=5)
+        self.addCleanup(pp.stop)
+
+        def _checks(_):
+            child = next(iter(pp.processes))
+            l = [pp.doWork(Gate, data=b"x") for x in range(3)]
+            self.assertEquals(pp._inflight[child], 2)
+            self.assertIn(child, pp._retiring)
+            self.assertEquals(pp.ready, set())
+            self.assertEquals(len(pp._queue), 1)
+            child.callRemote(Release)
+            # the replacement is started right after the old child is
+            # gone, give it a chance to do so.
+            d = defer.Deferred()
+            pp._finishCallbacks[child].addCallback(
+                lambda _: reactor.callLater(0, d.callback, (child, l)))
+            return d
+
+        def _replaced(result):
+            child, l = result
+            self.assertNotIn(child, pp.processes)
+            self.assertEquals(len(pp.processes), 1)
+            newChild = next(iter(pp.processes))
+            newChild.callRemote(Release)
+            return defer.DeferredList(l, fireOnOneErrback=True)
+
+        return pp.start(
+            ).addCallback(_checks
+            ).addCallback(_replaced)
+
+    def _queueBehindGate(self, pp, calls):
+        """
+        Occupy the only child of C{pp} with a L{Gate} call, queue up
+        C{calls}, a list of (data, priority) tuples, of L{commands.Echo}
+        and release the gate.
+
+        @return: a L{defer.Deferred} firing with the data of the queued
+                 calls in the order they were served.
+        """
+        order = []
+        child = next(iter(pp.processes))
+        l = [pp.doWork(Gate, data=b"gate")]
+        for data, priority in calls:
+            l.append(pp.doWork(commands.Echo, data=data, _priority=priority
+                ).addCallback(lambda result: order.append(result['response'])))
+        child.callRemote(Release)
+        return defer.DeferredList(l, fireOnOneErrback=True
+            ).addCallback(lambda _: order)
+
+    def test_priorityQueue(self):
+        """
+        Test that queued calls with a higher priority are served first and
+        that per-priority counters are kept.
+        """
+        pp = pool.ProcessPool(ampChild=GatedChild, min=1, max=1)
+
+        def _work(_):
+            return self._queueBehindGate(
+                pp, [(b"low", 0), (b"high", 10), (b"mid", 5)])
+
+        def _checks(order):
+            self.assertEquals(order, [b"high", b"mid", b"low"])
+            self.assertEquals(sorted(pp.priorityStats), [0, 5, 10])
+            low = pp.priorityStats[0]
+            self.assertEquals(low.depth, 0)
+            # the gate call is dispatched straight away
+            self.assertEquals(low.queued, 1)
+            self.assertEquals(low.dispatched, 2)
+            self.assertTrue(low.maxWait >= pp.priorityStats[10].maxWait)
+            self.assertEquals(pp.priorityStats[10].queued, 1)
+
+        return pp.start(
+            ).addCallback(_work
+            ).addCallback(_checks
+            ).addCallback(lambda _: pp.stop())
+
+    def test_priorityAging(self):
+        """
+        Test that a low priority call that waited long enough is served
+        before a higher priority call that arrived later.
+        """
+        clock = [1000.0]
+        self.patch(pool, 'now', lambda: clock[0])
+        pp = pool.ProcessPool(ampChild=GatedChild, min=1, max=1,
+                              priorityAging=0.5)
+
+        def _work(_):
+            child = next(iter(pp.processes))
+            order = []
+            gate = pp.doWork(Gate, data=b"gate")
+            old = pp.doWork(commands.Echo, data=b"old")
+            # 2 seconds are worth more than 3 levels at 0.5 seconds each
+            clock[0] += 2
+            young = pp.doWork(commands.Echo, data=b"young", _priority=3)
+            for d in old, young:
+                d.addCallback(lambda result: order.append(result['response']))
+            child.callRemote(Release)
+            return defer.DeferredList([gate, old, young]
+                ).addCallback(lambda _: order)
+
+        return pp.start(
+            ).addCallback(_work
+            ).addCallback(self.assertEquals, [b"old", b"young"]
+            ).addCallback(lambda _: pp.stop())
+
+    def test_maxQueue(self):
+        """
+        Test that calls beyond maxQueue fail straight away with
+        L{pool.PoolOverloaded}.
+        """
+        pp = pool.ProcessPool(ampChild=GatedChild, min=1, max=1, maxQueue=1)
+
+        def _work(_):
+            child = next(iter(pp.processes))
+            gate = pp.doWork(Gate, data=b"gate")
+            queued = pp.doWork(commands.Echo, data=b"queued")
+            refused = pp.doWork(commands.Echo, data=b"refused")
+            self.assertEquals(len(pp._queue), 1)
+            self.assertEquals(pp.priorityStats[0].shed, 1)
+            failure = self.failureResultOf(refused, pool.PoolOverloaded)
+            self.assertTrue(failure.value.retryAfter > 0)
+            child.callRemote(Release)
+            return defer.DeferredList([gate, queued], fireOnOneErrback=True)
+
+        return pp.start(
+            ).addCallback(_work
+            ).addCallback(lambda _: pp.stop())
+
+    def test_maxQueueWait(self):
+        """
+        Test that a call waiting in the queue for longer than maxQueueWait
+        fails with L{pool.PoolOverloaded} and never reaches a child.
+        """
+        pp = pool.ProcessPool(ampChild=GatedChild, min=1, max=1,
+                              maxQueueWait=0.1)
+
+        def _work(_):
+            child = next(iter(pp.processes))
+            gate = pp.doWork(Gate, data=b"gate")
+            queued = pp.doWork(commands.Echo, data=b"queued")
+            self.assertFailure(queued, pool.PoolOverloaded)
+
+            def _shed(_):
+                self.assertEquals(pp.priorityStats[0].shed, 1)
+                self.assertEquals(pp.priorityStats[0].depth, 0)
+                self.assertEquals(pp._calls[child], 1)
+                return child.callRemote(Release)
+
+            return queued.addCallback(_shed
+                ).addCallback(lambda _: gate)
+
+        return pp.start(
+            ).addCallback(_work
+            ).addCallback(lambda _: pp.stop())
+
+    def test_poolOverloadedRoundTrip(self):
+        """
+        Test that L{pool.PoolOverloaded} can be rebuilt from its
+        description, as AMP does on the client side.
+        """
+        e = pool.PoolOverloaded(2.5)
+        self.assertEquals(pool.PoolOverloaded(str(e)).retryAfter, 2.5)
+
+    def test_earliestDeadlineFirst(self):
+        """
+        Test that queued calls with a deadline are served earliest
+        deadline first and before calls without one, however far their
+        deadlines are.
+        """
+        pp = pool.ProcessPool(ampChild=GatedChild, min=1, max=1)
+
+        def _work(_):
+            child = next(iter(pp.processes))
+            order = []
+            n = reactor.seconds()
+            l = [pp.doWork(Gate, data=b"gate")]
+            for data, deadline in [(b"none", None), (b"late", n + 60),
+                                   (b"early", n + 30)]:
+                l.append(pp.doWork(commands.Echo, data=data, _deadline=deadline
+                    ).addCallback(lambda r: order.append(r['response'])))
+            child.callRemote(Release)
+            return defer.DeferredList(l, fireOnOneErrback=True
+                ).addCallback(lambda _: order)
+
+        return pp.start(
+            ).addCallback(_work
+            ).addCallback(self.assertEquals, [b"early", b"late", b"none"]
+            ).addCallback(lambda _: pp.stop())
+
+    def test_deadlineNoStarvation(self):
+        """
+        Test that a call with a deadline doesn't get ahead of a call of the
+        same priority that waited for longer than priorityAging.
+        """
+        clock = [1000.0]
+        self.patch(pool, 'now', lambda: clock[0])
+        pp = pool.ProcessPool(ampChild=GatedChild, min=1, max=1,
+                              priorityAging=10)
+
+        def _work(_):
+            child = next(iter(pp.processes))
+            order = []
+            gate = pp.doWork(Gate, data=b"gate")
+            old = pp.doWork(commands.Echo, data=b"old")
+            clock[0] += 20
+            urgent = pp.doWork(commands.Echo, data=b"urgent",
+                               _deadline=reactor.seconds() + 5)
+            for d in old, urgent:
+                d.addCallback(lambda result: order.append(result['response']))
+            child.callRemote(Release)
+            return defer.DeferredList([gate, old, urgent],
+                                      fireOnOneErrback=True
+                ).addCallback(lambda _: order)
+
+        return pp.start(
+            ).addCallback(_work
+            ).addCallback(self.assertEquals, [b"old", b"urgent"]
+            ).addCallback(lambda _: pp.stop())
+
+    def test_queuedDeadlineExpires(self):
+        """
+        Test that a call that misses its deadline while queued fails with
+        L{pool.DeadlineExpired} without being sent to a child.
+        """
+        pp = pool.ProcessPool(ampChild=GatedChild, min=1, max=1)
+
+        def _work(_):
+            child = next(iter(pp.processes))
+            gate = pp.doWork(Gate, data=b"gate")
+            queued = pp.doWork(commands.Echo, data=b"late",
+                               _deadline=reactor.seconds() + 0.1)
+            self.assertFailure(queued, pool.DeadlineExpired)
+
+            def _expired(_):
+                self.assertEquals(pp.expired, 1)
+                self.assertEquals(pp.priorityStats[0].expired, 1)
+                self.assertEquals(pp._calls[child], 1)
+                self.assertIn(child, pp.processes)
+                return child.callRemote(Release)
+
+            return queued.addCallback(_expired
+                ).addCallback(lambda _: gate)
+
+        return pp.start(
+            ).addCallback(_work
+            ).addCallback(lambda _: pp.stop())
+
+    def test_readyHandshake(self):
+        """
+        Test that with the ready handshake a new child gets calls only
+        once it is up, and that the time it took is recorded.
+        """
+        pp = pool.ProcessPool(ampChild=SlowStartChild, min=1, max=1,
+                              readyHandshake=True)
+
+        def _checks(_):
+            child = next(iter(pp.processes))
+            self.assertEquals(pp.ready, set())
+            self.assertEquals(pp.starting, set([child]))
+            d = pp.doWork(Pid)
+            self.assertEquals(len(pp._queue), 1)
+            self.assertEquals(pp._calls[child], 0)
+
+            def _done(result):
+                self.assertNotEquals(result['pid'], 0)
+                self.assertEquals(pp.starting, set())
+                self.assertTrue(pp.readyTimes[child] >= 0.5)
+            return d.addCallback(_done)
+
+        return pp.start(
+            ).addCallback(_checks
+            ).addCallback(lambda _: pp.stop())
+
+    def test_startWaitReady(self):
+        """
+        Test that start can wait until min workers are up.
+        """
+        pp = pool.ProcessPool(ampChild=SlowStartChild, min=3, max=3,
+                              readyHandshake=True)
+
+        def _checks(_):
+            self.assertEquals(pp.starting, set())
+            self.assertEquals(len(pp.ready), 3)
+            self.assertEquals(len(pp.readyTimes), 3)
+            for elapsed in pp.readyTimes.values():
+                self.assertTrue(elapsed >= 0.5)
+
+        return pp.start(waitReady=True
+            ).addCallback(_checks
+            ).addCallback(lambda _: pp.stop())
+
+    def test_startupTimes(self):
+        """
+        Test that the children report how long the steps of their startup
+        took.
+        """
+        pp = pool.ProcessPool(ampChild=SlowStartChild, min=2, max=2,
+                              readyHandshake=True)
+
+        def _checks(_):
+            self.assertEquals(len(pp.startupTimes), 2)
+            for child, times in pp.startupTimes.items():
+                self.assertEquals(
+                    sorted(times),
+                    ['enter', 'exec', 'imports', 'reactor', 'resolve'])
+                for elapsed in times.values():
+                    self.assertTrue(elapsed >= 0)
+                self.assertTrue(times['enter'] >= 0.5)
+                self.assertTrue(sum(times.values())
+                                <= pp.readyTimes[child] + 0.01)
+
+        return pp.start(waitReady=True
+            ).addCallback(_checks
+            ).addCallback(lambda _: pp.stop())
+
+    def test_warmup(self):
+        """
+        Test that the children import their modules and make the warm-up
+        calls before they get any other call.
+        """
+        pp = pool.ProcessPool(ampChild=WarmChild, min=2, max=2,
+                              preload=['colorsys'], warmup=[(Touch, {})] * 3)
+        self.assertTrue(pp.readyHandshake)
+
+        def _checks(results):
+            for result in results:
+                self.assertEquals(result['touched'], 3)
+                self.assertTrue(result['warmed'])
+                self.assertEquals(result['loaded'],
+                                  ['xml.dom.minidom', 'colorsys'])
+
+        return pp.start(
+            ).addCallback(lambda _: defer.gatherResults(
+                [pp.doWork(Warmth) for i in range(4)])
+            ).addCallback(_checks
+            ).addCallback(lambda _: pp.stop())
+
+    def test_blocking(self):
+        """
+        Test that blocking responders run on the threads of the child, no
+        more of them at once than it has, while it answers other calls.
+        """
+        import time
+        pp = pool.ProcessPool(ampChild=BlockingChild, min=1, max=1,
+                              maxConcurrentPerChild=5, readyHandshake=True)
+        self.addCleanup(pp.stop)
+        answered = {}
+
+        def _call(_):
+            started = time.time()
+
+            def _answered(result, name):
+                answered[name] = time.time() - started
+                return result
+            sleeps = [pp.doWork(Sleep, seconds=0.5
+                          ).addCallback(_answered, i) for i in range(4)]
+            pid = pp.doWork(Pid).addCallback(_answered, 'pid')
+            return defer.gatherResults(sleeps + [pid])
+
+        def _checks(results):
+            self.assertTrue(answered['pid'] < 0.4)
+            for i in range(4):
+                self.assertTrue(0.5 <= answered[i] < 1.9)
+            self.assertTrue(max(answered[i] for i in range(4)) >= 1.0)
+            threads = set(result['thread'] for result in results[:4])
+            self.assertEquals(len(threads), 2)
+            for name in threads:
+                self.assertIn('ampoule-child-', name)
+
+        return pp.start(waitReady=True).addCallback(_call
+            ).addCallback(_checks)
+
+    def test_warmupFails(self):
+        """
+        Test that a child whose warm-up fails never gets calls and is
+        replaced.
+        """
+        fd, marker = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(lambda: os.path.exists(marker) and os.unlink(marker))
+        pp = pool.ProcessPool(ampChild=ColdChild, min=1, max=1,
+                              ampChildArgs=(marker,), warmup=[(Pid, {})])
+        first = []
+
+        def _started(_):
+            first.extend(pp.processes)
+            return pp.doWork(Pid)
+
+        def _checks(result):
+            self.assertFalse(os.path.exists(marker))
+            self.assertEquals(len(pp.processes), 1)
+            self.assertNotIn(first[0], pp.processes)
+            self.assertEquals(
+                result['pid'], list(pp.processes)[0].transport.transport.pid)
+
+        return pp.start(
+            ).addCallback(_started
+            ).addCallback(_checks
+            ).addCallback(lambda _: pp.stop())
+
+    def test_warmupKeepsFailing(self):
+        """
+        Test that children whose warm-up keeps failing don't count as up,
+        and that the workers waited for fail after C{maxWarmupFailures}
+        of them.
+        """
+        self.patch(pool, 'WARMUP_BACKOFF', 0.05)
+        pp = pool.ProcessPool(ampChild=FrozenChild, min=1, max=1,
+                              readyHandshake=True, maxWarmupFailures=2)
+        self.addCleanup(pp.stop)
+
+        def _checks(_):
+            self.assertEquals(pp._warmupFailures, 2)
+            self.assertEquals(pp.ready, set())
+            counters = pp.metrics.snapshot()['counters']
+            self.assertEquals(counters['warmupFailures'], 2)
+            self.assertEquals(counters['spawns'], 2)
+
+        d = pp.start(waitReady=True)
+        return self.assertFailure(d, pool.WarmupFailed).addCallback(_checks)
+
+    def test_readyHandshakeNoExtraWorkers(self):
+        """
+        Test that calls made while a worker is starting don't start more
+        workers than needed to take them.
+        """
+        pp = pool.ProcessPool(ampChild=SlowStartChild, min=0, max=5,
+                              readyHandshake=True, maxConcurrentPerChild=2)
+
+        def _checks(_):
+            l = [pp.doWork(Pid) for x in range(3)]
+            # 2 calls for the first worker, 1 for the second one
+            self.assertEquals(len(pp.processes), 2)
+            return defer.DeferredList(l, fireOnOneErrback=True)
+
+        return pp.start(
+            ).addCallback(_checks
+            ).addCallback(lambda _: pp.stop())
+
     def test_growingToMax(self):
         """
         Test that the pool grows over time until it reaches max processes.
@@ -666,6 +1374,472 @@ class TestProcessPool(unittest.TestCase):
         d.addCallback(_checks2)
         return d
 
+    def test_recycleJitter(self):
+        """
+        Test that the recycling threshold of each child is moved by up to
+        recycleJitter.
+        """
+        pp = pool.ProcessPool(min=5, max=5, recycleAfter=1000,
+                              recycleJitter=0.2)
+
+        def _checks(_):
+            thresholds = [pp._recycleThreshold(c) for c in pp.processes]
+            for t in thresholds:
+                self.assertTrue(800 <= t <= 1200)
+            self.assertTrue(len(set(thresholds)) > 1)
+
+        return pp.start(
+            ).addCallback(_checks
+            ).addCallback(lambda _: pp.stop())
+
+    def test_makeBeforeBreak(self):
+        """
+        Test that with makeBeforeBreak the replacement of a child is
+        started as soon as the child reaches its threshold, and that the
+        child keeps serving calls until the replacement is up.
+        """
+        pp = pool.ProcessPool(ampChild=PidChild, min=1, max=1,
+                              recycleAfter=2, makeBeforeBreak=True,
+                              maxConcurrentPerChild=2)
+        self.addCleanup(pp.stop)
+        pids = []
+
+        def _checks(_):
+            old = next(iter(pp.processes))
+            l = [pp.doWork(Pid), pp.doWork(Pid)]
+            # the replacement is on its way and the old one is still
+            # taking calls
+            self.assertEquals(len(pp.processes), 2)
+            self.assertIn(old, pp._recycling)
+            self.assertNotIn(old, pp._retiring)
+            replacement = next(iter(pp.processes - set([old])))
+            finished = pp._finishCallbacks[old]
+
+            def _gone(_):
+                self.assertEquals(pp.processes, set([replacement]))
+                self.assertIn(replacement, pp.readyTimes)
+                return pp.doWork(Pid)
+
+            for d in l:
+                d.addCallback(lambda result: pids.append(result['pid']))
+            return defer.gatherResults(l
+                ).addCallback(lambda _: finished
+                ).addCallback(_gone)
+
+        return pp.start(
+            ).addCallback(_checks
+            ).addCallback(lambda result: self.assertNotIn(result['pid'], pids))
+
+    def test_makeBeforeBreakReplacementFails(self):
+        """
+        Test that a replacement that fails its warm-up isn't respawned,
+        and that the child it was replacing starts another one with its
+        next call, so the pool never goes over max.
+        """
+        self.patch(pool, 'WARMUP_BACKOFF', 0.05)
+        fd, marker = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(marker)
+        self.addCleanup(lambda: os.path.exists(marker) and os.unlink(marker))
+        pp = pool.ProcessPool(ampChild=ColdChild, min=1, max=1,
+                              ampChildArgs=(marker,), recycleAfter=1,
+                              makeBeforeBreak=True)
+        self.addCleanup(pp.stop)
+
+        def _recycle(_):
+            old = next(iter(pp.processes))
+            open(marker, 'w').close()
+            d = pp.doWork(Pid)
+            replacement = next(iter(pp.processes - set([old])))
+            return d.addCallback(lambda _: pp._finishCallbacks[replacement]
+                ).addCallback(lambda _: task.deferLater(reactor, 0.2,
+                                                         lambda: old))
+
+        def _retry(old):
+            self.assertFalse(os.path.exists(marker))
+            self.assertEquals(pp.processes, set([old]))
+            self.assertNotIn(old, pp._recycling)
+            self.assertEquals(pp._respawns, set())
+            return pp.doWork(Pid).addCallback(lambda _: old)
+
+        def _checks(old):
+            self.assertEquals(len(pp.processes), 2)
+            self.assertIn(old, pp._recycling)
+
+        return pp.start(waitReady=True
+            ).addCallback(_recycle
+            ).addCallback(_retry
+            ).addCallback(_checks)
+
+    def test_maxConcurrentRecycles(self):
+        """
+        Test that no more than maxConcurrentRecycles children are recycled
+        at the same time.
+        """
+        pp = pool.ProcessPool(ampChild=GatedChild, min=2, max=2,
+                              recycleAfter=1, maxConcurrentRecycles=1)
+        self.addCleanup(pp.stop)
+
+        def _checks(_):
+            a = pp.doWork(Gate, data=b"a")
+            b = pp.doWork(Gate, data=b"b")
+            self.assertEquals(len(pp._recycling), 1)
+            self.assertEquals(len(pp._retiring), 1)
+            # the other child is over the threshold but it has to wait
+            # for its turn.
+            waiting = next(iter(pp.busy - pp._recycling))
+            self.assertEquals(pp._calls[waiting], 1)
+            for child in list(pp.processes):
+                child.callRemote(Release)
+            return defer.DeferredList([a, b], fireOnOneErrback=True)
+
+        return pp.start(
+            ).addCallback(_checks)
+
+    def test_memoryRecycling(self):
+        """
+        Test that a child that goes over maxChildMemory is recycled.
+        """
+        MB = 2 ** 20
+        pp = pool.ProcessPool(ampChild=HogChild, min=1, max=1,
+                              maxChildMemory=2 ** 40,
+                              memoryCheckInterval=0.1)
+        self.addCleanup(pp.stop)
+        pids = []
+
+        def _checks(_):
+            child = next(iter(pp.processes))
+            gone = defer.Deferred()
+            # the replacement is started right after the old child is
+            # gone, give it a chance to do so.
+            pp._finishCallbacks[child].addCallback(
+                lambda _: reactor.callLater(0, gone.callback, None))
+
+            def _hog(_):
+                usage = pp.childUsage[child]
+                self.assertTrue(usage['rss'] > 0)
+                self.assertTrue(usage['maxrss'] > 0)
+                pp.maxChildMemory = usage['rss'] + 50 * MB
+                return pp.doWork(Hog, size=100 * MB)
+
+            return pp._checkMemory(
+                ).addCallback(_hog
+                ).addCallback(lambda _: pp.doWork(Pid)
+                ).addCallback(lambda result: pids.append(result['pid'])
+                ).addCallback(lambda _: gone
+                ).addCallback(lambda _: pp.doWork(Pid))
+
+        return pp.start(waitReady=True
+            ).addCallback(_checks
+            ).addCallback(lambda result: self.assertNotIn(result['pid'], pids))
+
+    def test_memoryRecyclingCapped(self):
+        """
+        Test that children over maxChildMemory are recycled no more than
+        maxConcurrentRecycles at a time.
+        """
+        pp = pool.ProcessPool(ampChild=PidChild, min=2, max=2,
+                              maxChildMemory=1, memoryCheckInterval=3600,
+                              maxConcurrentRecycles=1)
+        self.addCleanup(pp.stop)
+
+        def _checks(_):
+            self.assertEquals(len(pp._recycling), 1)
+            self.assertEquals(pp.metrics.snapshot()['counters']['recycles'],
+                              1)
+
+        return pp.start(waitReady=True
+            ).addCallback(lambda _: pp._checkMemory()
+            ).addCallback(_checks)
+
+    def test_memoryCheckStuckChild(self):
+        """
+        Test that the memory check doesn't wait for a child stuck in a
+        long call, and doesn't ask it again until it answered.
+        """
+        pp = pool.ProcessPool(ampChild=StuckChild, min=1, max=1,
+                              maxChildMemory=2 ** 40,
+                              memoryCheckInterval=0.2)
+        self.addCleanup(pp.stop)
+        asked = []
+
+        def _checks(_):
+            child = next(iter(pp.processes))
+            callRemote = child.callRemote
+
+            def _counting(command, **kwargs):
+                if command is commands.ResourceUsage:
+                    asked.append(child)
+                return callRemote(command, **kwargs)
+            self.patch(child, 'callRemote', _counting)
+            stuck = pp.doWork(Sleep, seconds=2.0)
+
+            def _checked(_):
+                self.assertFalse(stuck.called)
+                self.assertEquals(asked, [child])
+                self.assertIn(child, pp._usageChecks)
+                return stuck
+
+            return pp._checkMemory(
+                ).addCallback(lambda _: pp._checkMemory()
+                ).addCallback(_checked)
+
+        return pp.start(waitReady=True).addCallback(_checks)
+
+    def test_affinity(self):
+        """
+        Test that calls with the same affinity key go to the same child.
+        """
+        pp = pool.ProcessPool(ampChild=PidChild, min=3, max=3)
+        self.addCleanup(pp.stop)
+        keys = [b"a", b"b", b"c", b"d", b"e", b"f"]
+        pids = {}
+
+        def _call(_, key):
+            return pp.doWork(Pid, _affinity=key).addCallback(
+                lambda result: pids.setdefault(key, set()).add(result['pid']))
+
+        def _checks(_):
+            for key in keys:
+                self.assertEquals(len(pids[key]), 1)
+            self.assertEquals(pp.affinityHits, 12)
+            self.assertEquals(pp.affinityMisses, 0)
+            self.assertEquals(pp.affinityHitRate(), 1.0)
+
+        d = pp.start(waitReady=True)
+        for key in keys * 2:
+            d.addCallback(_call, key)
+        return d.addCallback(_checks)
+
+    def test_affinityFallback(self):
+        """
+        Test that a call waits at most affinityWait seconds for its
+        preferred child before going to another one.
+        """
+        pp = pool.ProcessPool(ampChild=GatedPidChild, min=2, max=2,
+                              affinityWait=0.1)
+        self.addCleanup(pp.stop)
+
+        def _checks(_):
+            gate = pp.doWork(Gate, data=b"gate", _affinity=b"k")
+            preferred = [child for child in pp.processes
+                         if pp._slots[child] == pp._slotFor(b"k")][0]
+            self.assertNotIn(preferred, pp.ready)
+            d = pp.doWork(Pid, _affinity=b"k")
+            self.assertEquals(pp._queueDepth, 1)
+            self.assertEquals(pp.affinityHits, 1)
+
+            def _served(_):
+                # the gate is still closed, someone else served the call
+                self.assertFalse(gate.called)
+                self.assertEquals(pp.affinityMisses, 1)
+                self.assertEquals(pp.affinityHitRate(), 0.5)
+                preferred.callRemote(Release)
+                return gate
+            return d.addCallback(_served)
+
+        return pp.start(waitReady=True).addCallback(_checks)
+
+    def test_affinityAcrossRecycles(self):
+        """
+        Test that the replacement of a child takes its place for the
+        affinity keys of the child.
+        """
+        pp = pool.ProcessPool(ampChild=PidChild, min=2, max=2,
+                              recycleAfter=1, affinityWait=30)
+        self.addCleanup(pp.stop)
+        pids = []
+
+        def _call(_):
+            self.assertEquals(sorted(pp._slots.values()), [0, 1])
+            self.assertEquals(pp._slotFor(b"k"), slot[0])
+            return pp.doWork(Pid, _affinity=b"k").addCallback(
+                lambda result: pids.append(result['pid']))
+
+        def _checks(_):
+            # every call recycled the child that served it
+            self.assertEquals(len(set(pids)), 3)
+            self.assertEquals(pp.affinityHits, 3)
+            self.assertEquals(pp.affinityMisses, 0)
+
+        slot = []
+        d = pp.start(waitReady=True)
+        d.addCallback(lambda _: slot.append(pp._slotFor(b"k")))
+        for i in range(3):
+            d.addCallback(_call)
+        return d.addCallback(_checks)
+
+    def test_affinityAcrossResizes(self):
+        """
+        Test that adding a child to the pool moves only the affinity keys
+        that the new child takes, and removing it moves only those back.
+        """
+        pp = pool.ProcessPool()
+        self.addCleanup(pp.stop)
+        pp._slots = dict((object(), i) for i in range(4))
+        keys = range(1000)
+        before = [pp._slotFor(key) for key in keys]
+        new = object()
+        pp._slots[new] = 4
+        after = [pp._slotFor(key) for key in keys]
+        moved = [a for b, a in zip(before, after) if a != b]
+        self.assertTrue(moved)
+        self.assertEquals(set(moved), set([4]))
+        del pp._slots[new]
+        self.assertEquals([pp._slotFor(key) for key in keys], before)
+
+    def test_map(self):
+        """
+        Test that map runs a command for every item and returns the
+        responses in order.
+        """
+        pp = pool.ProcessPool(min=2, max=2)
+        self.addCleanup(pp.stop)
+        items = [{'data': str(i).encode()} for i in range(250)]
+
+        def _checks(results):
+            self.assertEquals([result['response'] for result in results],
+                              [item['data'] for item in items])
+            self.assertEquals(pp.arrivals, 250)
+            self.assertEquals(sum(pp._calls.values()), 250)
+            # 25 chunks made it through the queue
+            self.assertEquals(pp._statsFor(0).dispatched, 25)
+
+        return pp.start(
+            ).addCallback(lambda _: pp.map(commands.Echo, items, chunkSize=10)
+            ).addCallback(_checks)
+
+    def test_mapUnordered(self):
+        """
+        Test that in unordered mode map returns all the responses.
+        """
+        pp = pool.ProcessPool(min=2, max=2)
+        self.addCleanup(pp.stop)
+        items = [{'data': str(i).encode()} for i in range(100)]
+
+        def _checks(results):
+            self.assertEquals(
+                sorted(result['response'] for result in results),
+                sorted(item['data'] for item in items))
+
+        return pp.start(
+            ).addCallback(lambda _: pp.map(commands.Echo, items, chunkSize=7,
+                                           ordered=False)
+            ).addCallback(_checks)
+
+    def test_imapLazy(self):
+        """
+        Test that imap takes items from the iterable only when there's
+        room for them in flight.
+        """
+        pp = pool.ProcessPool(min=2, max=2)
+        self.addCleanup(pp.stop)
+        taken = []
+        delivered = []
+
+        def _items():
+            for i in range(200):
+                taken.append(i)
+                yield {'data': str(i).encode()}
+
+        def _callback(result):
+            self.assertTrue(len(taken) - len(delivered) <= 3 * 5)
+            delivered.append(int(result['response']))
+
+        def _checks(count):
+            self.assertEquals(count, 200)
+            self.assertEquals(delivered, list(range(200)))
+
+        return pp.start(
+            ).addCallback(lambda _: pp.imap(commands.Echo, _items(),
+                                            _callback, chunkSize=5,
+                                            maxChunks=3)
+            ).addCallback(_checks)
+
+    def test_mapError(self):
+        """
+        Test that map fails with the first error of a call and doesn't
+        send more chunks after it.
+        """
+        pp = pool.ProcessPool(ampChild=MaybeFailChild, min=1, max=1)
+        self.addCleanup(pp.stop)
+        items = [{'data': b"good"}] * 10 + [{'data': b"bad"}]
+        items += [{'data': b"good"}] * 100
+
+        def _checks(_):
+            self.assertTrue(pp.arrivals < len(items))
+            self.assertEquals(pp.metrics.snapshot()['counters']['failed'], 1)
+
+        return self.assertFailure(
+            pp.start().addCallback(
+                lambda _: pp.map(MaybeFail, iter(items), chunkSize=5,
+                                 maxChunks=1)),
+            ValueError
+            ).addCallback(_checks)
+
+    def test_batching(self):
+        """
+        Test that calls of a command with a batch window are sent to the
+        child together and that the error of a call doesn't affect the
+        others.
+        """
+        pp = pool.ProcessPool(ampChild=MaybeFailChild, min=1, max=1)
+        self.addCleanup(pp.stop)
+
+        def _checks(results):
+            self.assertEquals(
+                [(success, result) for success, result in results
+                 if success],
+                [(True, {'response': b"good"})] * 3)
+            results[3][1].trap(ValueError)
+            results[4][1].trap(amp.UnknownRemoteError)
+            # a single entry went through the queue, for 5 calls
+            self.assertEquals(pp._statsFor(0).dispatched, 1)
+            self.assertEquals(pp.arrivals, 5)
+            self.assertEquals(sum(pp._calls.values()), 5)
+            counters = pp.metrics.snapshot()['counters']
+            self.assertEquals((counters['completed'], counters['failed']),
+                              (3, 2))
+            # the errors didn't take the child down
+            return pp.doWork(BatchedMaybeFail, data=b"still there")
+
+        def _work(_):
+            return defer.DeferredList(
+                [pp.doWork(BatchedMaybeFail, data=data) for data in
+                 [b"good", b"good", b"good", b"bad", b"boom"]],
+                consumeErrors=True)
+
+        return pp.start(
+            ).addCallback(_work
+            ).addCallback(_checks
+            ).addCallback(lambda result: self.assertEquals(
+                result, {'response': b"still there"}))
+
+    def test_batchSize(self):
+        """
+        Test that a batch is sent as soon as it has batchSize calls.
+        """
+        pp = pool.ProcessPool(ampChild=MaybeFailChild, min=1, max=1,
+                              maxConcurrentPerChild=3)
+        self.addCleanup(pp.stop)
+
+        def _work(_):
+            l = [pp.doWork(BatchedMaybeFail, data=str(i).encode())
+                 for i in range(25)]
+            # two full batches left already, the rest waits for the window
+            self.assertEquals(pp._statsFor(0).dispatched, 2)
+            self.assertEquals(len(pp._batches[BatchedMaybeFail]), 5)
+            return defer.gatherResults(l)
+
+        def _checks(results):
+            self.assertEquals([result['response'] for result in results],
+                              [str(i).encode() for i in range(25)])
+            self.assertEquals(pp._statsFor(0).dispatched, 3)
+
+        return pp.start(
+            ).addCallback(_work
+            ).addCallback(_checks)
+
     def test_recyclingProcessFails(self):
         """
         A process exiting with a non-zero exit code when recycled does not get
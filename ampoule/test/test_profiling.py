@@ -0,0 +1,184 @@
+import threading
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from ampoule import pool, profiling
+from ampoule.test.test_process import Pid, PidChild
+
+
+def _work():
+    return sum(range(100))
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_seconds(self):
+        """
+        Test that a profile ends once its time passed, with the stats of
+        what ran in the meantime.
+        """
+        clock = task.Clock()
+        profiler = profiling.Profiler(seconds=5, clock=clock)
+        d = profiler.start()
+        _work()
+        clock.advance(4)
+        self.assertNoResult(d)
+        clock.advance(1)
+        stats = profiling.statsFromBytes(self.successResultOf(d))
+        self.assertIn('_work', [func[2] for func in stats.stats])
+        self.assertEquals(clock.getDelayedCalls(), [])
+
+    def test_calls(self):
+        """
+        Test that a profile ends once enough calls were answered, even if
+        its time didn't pass, and that later calls don't matter.
+        """
+        clock = task.Clock()
+        profiler = profiling.Profiler(seconds=5, calls=2, clock=clock)
+        d = profiler.start()
+        self.assertEquals(profiler.called('result'), 'result')
+        self.assertNoResult(d)
+        profiler.called()
+        self.successResultOf(d)
+        profiler.called()
+        self.assertEquals(clock.getDelayedCalls(), [])
+
+    def test_default(self):
+        """
+        Test that a profile lasts for L{profiling.DEFAULT_SECONDS} when
+        neither its time nor its calls are given.
+        """
+        clock = task.Clock()
+        d = profiling.Profiler(clock=clock).start()
+        clock.advance(profiling.DEFAULT_SECONDS)
+        self.successResultOf(d)
+
+    def test_callsTimeLimit(self):
+        """
+        Test that a profile waiting for calls without a time given ends
+        after L{profiling.MAX_SECONDS} anyway.
+        """
+        clock = task.Clock()
+        d = profiling.Profiler(calls=2, clock=clock).start()
+        clock.advance(profiling.MAX_SECONDS - 1)
+        self.assertNoResult(d)
+        clock.advance(1)
+        self.successResultOf(d)
+
+    def test_merge(self):
+        """
+        Test that merged stats add up the calls of each profile.
+        """
+        datas = []
+        for calls in 1, 2:
+            clock = task.Clock()
+            profiler = profiling.Profiler(seconds=1, clock=clock)
+            profiler.start().addCallback(datas.append)
+            for i in range(calls):
+                _work()
+            clock.advance(1)
+        stats = profiling.merge(datas)
+        [work] = [func for func in stats.stats if func[2] == '_work']
+        self.assertEquals(stats.stats[work][1], 3)
+        self.assertIdentical(profiling.merge([]), None)
+
+    def test_dumpStacks(self):
+        """
+        Test that the stack of every thread is dumped with its name.
+        """
+        ready = threading.Event()
+        done = threading.Event()
+
+        def _wait():
+            ready.set()
+            done.wait()
+        thread = threading.Thread(target=_wait, name='waiter')
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(done.set)
+        ready.wait()
+        text = profiling.dumpStacks()
+        self.assertIn('Thread waiter (%d):' % (thread.ident,), text)
+        self.assertIn('in _wait', text)
+        self.assertIn('in test_dumpStacks', text)
+
+
+class TestPoolProfiling(unittest.TestCase):
+
+    def _pool(self, **kwargs):
+        pp = pool.ProcessPool(ampChild=PidChild, readyHandshake=True,
+                              **kwargs)
+        self.addCleanup(pp.stop)
+        return pp.start(waitReady=True).addCallback(lambda _: pp)
+
+    def test_profile(self):
+        """
+        Test that the pool profiles all of its children and merges their
+        stats.
+        """
+        def _profile(pp):
+            d = pp.profile(seconds=1.0)
+            calls = defer.gatherResults([pp.doWork(Pid) for i in range(10)])
+            return defer.gatherResults([d, calls])
+
+        def _check(results):
+            stats, pids = results
+            self.assertEquals(len(set(r['pid'] for r in pids)), 2)
+            [pid] = [func for func in stats.stats if func[2] == 'pid']
+            self.assertEquals(stats.stats[pid][1], 10)
+        return self._pool(min=2, max=2).addCallback(_profile
+            ).addCallback(_check)
+
+    def test_profileCalls(self):
+        """
+        Test that a profile of a number of calls ends with them and shows
+        their responder.
+        """
+        def _profile(pp):
+            d = pp.profile(calls=3, seconds=60)
+            calls = defer.gatherResults([pp.doWork(Pid) for i in range(3)])
+            return defer.gatherResults([d, calls])
+
+        def _check(results):
+            stats = results[0]
+            [pid] = [func for func in stats.stats if func[2] == 'pid']
+            self.assertEquals(stats.stats[pid][1], 3)
+        return self._pool(min=1, max=1).addCallback(_profile
+            ).addCallback(_check)
+
+    def test_busy(self):
+        """
+        Test that a child being profiled refuses to start another
+        profile.
+        """
+        def _profile(pp):
+            [child] = list(pp.processes)
+            first = pp.profile(seconds=0.2, child=child)
+            second = self.assertFailure(pp.profile(seconds=0.2, child=child),
+                                        profiling.ProfilerBusy)
+            return defer.gatherResults([first, second])
+
+        def _check(results):
+            self.assertNotIdentical(results[0], None)
+            self.assertEquals(len(self.flushLoggedErrors(
+                profiling.ProfilerBusy)), 1)
+        return self._pool(min=1, max=1).addCallback(_profile
+            ).addCallback(_check)
+
+    def test_dumpStacks(self):
+        """
+        Test that the pool gets the stacks of all of its children by their
+        process id.
+        """
+        def _dump(pp):
+            return pp.dumpStacks().addCallback(lambda stacks: (pp, stacks))
+
+        def _check(result):
+            pp, stacks = result
+            self.assertEquals(sorted(stacks), sorted(pp._pids.values()))
+            for text in stacks.values():
+                self.assertIn('Thread MainThread', text)
+                self.assertIn('in stackDump', text)
+        return self._pool(min=2, max=2).addCallback(_dump
+            ).addCallback(_check)
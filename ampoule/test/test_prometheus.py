@@ -0,0 +1,139 @@
+from twisted.application import internet
+from twisted.internet import task
+from twisted.plugins.ampoule_plugin import AMPoulePlugin
+from twisted.python import usage
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from ampoule import metrics, prometheus, service
+from ampoule.child import AMPChild
+
+
+class FakePool(object):
+    name = "web"
+
+    def __init__(self):
+        self.metrics = metrics.Metrics()
+        for name, value in [('workers', 3), ('ready', 1), ('busy', 2),
+                            ('starting', 0), ('retiring', 0), ('queued', 4),
+                            ('inflight', 2), ('serviceTime', 0.25),
+                            ('spawnLatency', None)]:
+            self.metrics.gauge(name, lambda value=value: value)
+
+
+class TestExposition(unittest.TestCase):
+
+    def test_exposition(self):
+        """
+        Test that gauges, counters and histograms are formatted in the
+        text exposition format, with the name of the pool and of the
+        commands as labels.
+        """
+        pool = FakePool()
+        pool.metrics.increment('calls', 7)
+        pool.metrics.increment('warmupFailures')
+        pool.metrics.observe('execution', 0.002, 'Echo')
+        pool.metrics.observe('execution', 3, 'Say "hi"')
+        pool.metrics.observe('spawn', 0.3)
+        text = prometheus.exposition(pool.metrics.snapshot(), pool.name)
+        lines = text.splitlines()
+        for line in [
+                '# TYPE ampoule_workers gauge',
+                'ampoule_workers{pool="web"} 3',
+                'ampoule_queued_calls{pool="web"} 4',
+                'ampoule_service_time_seconds{pool="web"} 0.25',
+                'ampoule_workers_by_state{pool="web",state="busy"} 2',
+                '# TYPE ampoule_calls_total counter',
+                'ampoule_calls_total{pool="web"} 7',
+                'ampoule_warmup_failures_total{pool="web"} 1',
+                '# TYPE ampoule_execution_seconds histogram',
+                'ampoule_execution_seconds_bucket'
+                '{pool="web",command="Echo",le="0.001"} 0',
+                'ampoule_execution_seconds_bucket'
+                '{pool="web",command="Echo",le="0.0025"} 1',
+                'ampoule_execution_seconds_bucket'
+                '{pool="web",command="Echo",le="+Inf"} 1',
+                'ampoule_execution_seconds_count{pool="web",command="Echo"} 1',
+                'ampoule_execution_seconds_sum'
+                '{pool="web",command="Say \\"hi\\""} 3.0',
+                'ampoule_spawn_seconds_count{pool="web"} 1']:
+            self.assertIn(line, lines)
+        self.assertNotIn('spawn_latency', text)
+        self.assertTrue(text.endswith('\n'))
+
+    def test_noName(self):
+        """
+        Test that a pool without a name gets no pool label.
+        """
+        pool = FakePool()
+        text = prometheus.exposition(pool.metrics.snapshot())
+        self.assertIn('ampoule_workers 3', text.splitlines())
+
+
+class TestMetricsResource(unittest.TestCase):
+
+    def test_render(self):
+        """
+        Test that the metrics are formatted again only once the interval
+        passed.
+        """
+        pool = FakePool()
+        clock = task.Clock()
+        metricsResource = prometheus.MetricsResource(pool, interval=5,
+                                                     clock=clock)
+
+        def _get():
+            request = DummyRequest([b''])
+            body = metricsResource.render_GET(request)
+            self.assertEquals(
+                request.responseHeaders.getRawHeaders(b'content-type'),
+                [prometheus.CONTENT_TYPE])
+            return body
+
+        pool.metrics.increment('calls')
+        self.assertIn(b'ampoule_calls_total{pool="web"} 1', _get())
+        pool.metrics.increment('calls')
+        clock.advance(1)
+        self.assertIn(b'ampoule_calls_total{pool="web"} 1', _get())
+        clock.advance(4)
+        self.assertIn(b'ampoule_calls_total{pool="web"} 2', _get())
+
+    def test_service(self):
+        """
+        Test that the service serves the metrics only when asked to.
+        """
+        options = {'name': None, 'ampport': 8901, 'ampinterface': '127.0.0.1',
+                   'child': AMPChild, 'parent': None, 'min': 1, 'max': 1,
+                   'max_idle': 20, 'recycle': 0, 'reactor': 'select',
+                   'timeout': None, 'metrics_port': None,
+                   'metrics_interface': None}
+
+        def _make():
+            services = list(service.makeService(options))
+            self.addCleanup(services[0].pool.looping.stop)
+            return services
+
+        self.assertEquals(len(_make()), 1)
+
+        options['metrics_port'] = 9090
+        services = _make()
+        self.assertEquals(len(services), 2)
+        server = services[1]
+        self.assertIsInstance(server, internet.TCPServer)
+        port, site = server.args
+        self.assertEquals(port, 9090)
+        self.assertEquals(server.kwargs, {'interface': '127.0.0.1'})
+        self.assertIsInstance(site, prometheus.MetricsSite)
+        self.assertIsInstance(site.resource, prometheus.MetricsResource)
+        self.assertIdentical(site.resource.pool, services[0].pool)
+
+    def test_metricsPortOption(self):
+        """
+        Test that the metrics port given to the plugin must be a number.
+        """
+        options = AMPoulePlugin.options()
+        options.parseOptions(['--metrics_port', '9090'])
+        self.assertEquals(options['metrics_port'], 9090)
+        self.assertRaises(usage.UsageError,
+                          AMPoulePlugin.options().parseOptions,
+                          ['-m', 'http'])
@@ -3,7 +3,7 @@ from twisted.internet.protocol import ClientFactory
 from twisted.trial import unittest
 from twisted.protocols import amp
 
-from ampoule import service, child, pool
+from ampoule import service, child, pool, rpool
 from ampoule.commands import Echo
 
 class ClientAMP(amp.AMP):
@@ -47,3 +47,25 @@ class TestAMPProxy(unittest.TestCase):
         return self.client.callRemote(Echo, data=DATA).addCallback(
             self.assertEquals, {'response': DATA}
         )
+
+class OverloadableEcho(Echo):
+    errors = {pool.PoolOverloaded: pool.POOL_OVERLOADED}
+
+
+class TestOverloadedProxy(unittest.TestCase):
+    def test_overloadedError(self):
+        """
+        Test that a L{pool.PoolOverloaded} failure of the pool is sent to
+        the client as an AMP error that it can map back to the exception.
+        """
+        def overloaded(command, **kw):
+            return defer.fail(pool.PoolOverloaded(3))
+
+        proxy = rpool.AMPProxy(wrapped=overloaded, child=child.AMPChild)
+        responder = proxy.locateResponder(b"Echo")
+        d = responder(amp.Box({b"data": b"hello"}))
+        failure = self.failureResultOf(d, amp.RemoteAmpError)
+        self.assertEquals(failure.value.errorCode, pool.POOL_OVERLOADED)
+
+        errorType = OverloadableEcho.reverseErrors[failure.value.errorCode]
+        self.assertEquals(errorType(failure.value.description).retryAfter, 3)
@@ -0,0 +1,138 @@
+import mmap
+import zlib
+
+from twisted.protocols import amp
+from twisted.trial import unittest
+
+from ampoule import child, pool, regions
+from ampoule.regions import FileRegion, MappedRegion
+
+
+class RegionChecksum(amp.Command):
+    arguments = [(b'region', MappedRegion())]
+    response = [(b'crc', amp.Integer()),
+                (b'lines', amp.Integer())]
+
+
+class RegionChild(child.AMPChild):
+    @RegionChecksum.responder
+    def regionChecksum(self, region):
+        return {'crc': zlib.crc32(region),
+                'lines': region.tobytes().count(b'\n')}
+
+
+class TestSplitLines(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.content = b"".join(b"line %d %s\n" % (i, b"x" * (i % 50))
+                                for i in range(5000))
+        with open(self.path, 'wb') as f:
+            f.write(self.content)
+
+    def _check(self, found):
+        self.assertEquals(b"".join(self.content[r.offset:r.offset + r.length]
+                                   for r in found), self.content)
+        for region in found:
+            self.assertTrue(region.length)
+            self.assertEquals(
+                self.content[region.offset + region.length - 1:
+                             region.offset + region.length], b"\n")
+
+    def test_parts(self):
+        """
+        Test that a file is split in the number of parts asked for, at line
+        boundaries.
+        """
+        found = regions.splitLines(self.path, parts=7)
+        self.assertEquals(len(found), 7)
+        self._check(found)
+
+    def test_size(self):
+        """
+        Test that a file is split in regions of about the size asked for.
+        """
+        found = regions.splitLines(self.path, size=10000)
+        self._check(found)
+        for region in found[:-1]:
+            self.assertTrue(10000 <= region.length < 10100)
+        self.assertTrue(found[-1].length < 10100)
+
+    def test_longLines(self):
+        """
+        Test that regions are never split in the middle of a line, even
+        when the lines are longer than the regions.
+        """
+        self.content = b"a" * 1000 + b"\n" + b"b" * 1000
+        with open(self.path, 'wb') as f:
+            f.write(self.content)
+        found = regions.splitLines(self.path, size=10)
+        self.assertEquals([(r.offset, r.length) for r in found],
+                          [(0, 1001), (1001, 1000)])
+
+    def test_empty(self):
+        """
+        Test that an empty file has no regions.
+        """
+        with open(self.path, 'wb'):
+            pass
+        self.assertEquals(regions.splitLines(self.path, parts=4), [])
+
+    def test_arguments(self):
+        """
+        Test that exactly one of parts and size must be given.
+        """
+        self.assertRaises(ValueError, regions.splitLines, self.path)
+        self.assertRaises(ValueError, regions.splitLines, self.path, 2, 10)
+
+
+class TestMappedRegion(unittest.TestCase):
+
+    def test_roundTrip(self):
+        """
+        Test that a region is received as a view of its bytes, wherever it
+        starts.
+        """
+        path = self.mktemp()
+        content = bytes(bytearray(range(256))) * 1000
+        with open(path, 'wb') as f:
+            f.write(content)
+        argument = MappedRegion()
+        for offset in [0, 1, mmap.ALLOCATIONGRANULARITY,
+                       mmap.ALLOCATIONGRANULARITY + 3]:
+            view = argument.fromString(argument.toString(
+                FileRegion(path, offset, 5000)))
+            self.assertIsInstance(view, memoryview)
+            self.assertTrue(view.readonly)
+            self.assertEquals(view.tobytes(), content[offset:offset + 5000])
+        empty = argument.fromString(argument.toString(
+            FileRegion(path, 10, 0)))
+        self.assertEquals(empty.tobytes(), b"")
+
+
+class TestPoolRegions(unittest.TestCase):
+
+    def test_map(self):
+        """
+        Test that the regions of a file can be worked on by the children of
+        a pool.
+        """
+        path = self.mktemp()
+        content = b"".join(b"%d\n" % (i,) for i in range(200000))
+        with open(path, 'wb') as f:
+            f.write(content)
+        found = regions.splitLines(path, parts=6)
+        pp = pool.ProcessPool(ampChild=RegionChild, min=3, max=3)
+        self.addCleanup(pp.stop)
+
+        def _checks(results):
+            self.assertEquals(sum(r['lines'] for r in results), 200000)
+            self.assertEquals(
+                [r['crc'] for r in results],
+                [zlib.crc32(content[r.offset:r.offset + r.length])
+                 for r in found])
+
+        return pp.start(
+            ).addCallback(lambda _: pp.map(
+                RegionChecksum, [{'region': r} for r in found], chunkSize=1)
+            ).addCallback(_checks)
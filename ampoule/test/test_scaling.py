@@ -0,0 +1,227 @@
+from zope.interface import implementer
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from ampoule import commands, iampoule, pool, scaling
+
+
+class FakeTransport(object):
+    def signalProcess(self, signal):
+        pass
+
+
+class FakeChild(object):
+    """
+    A worker living in the parent process that answers every command
+    after C{serviceTime} seconds, once it is up C{spawnLatency} seconds
+    after its creation.
+    """
+    def __init__(self, clock, spawnLatency, serviceTime):
+        self.clock = clock
+        self.serviceTime = serviceTime
+        self.up = clock.seconds() + spawnLatency
+        self.finished = defer.Deferred()
+        self.transport = FakeTransport()
+        self.calls = 0
+
+    def callRemote(self, command, **kwargs):
+        n = self.clock.seconds()
+        if command is commands.Shutdown:
+            self.clock.callLater(0, self.finished.callback, '')
+            return defer.succeed({})
+        d = defer.Deferred()
+        delay = max(self.up - n, 0)
+        if command not in (commands.Probe, commands.Warmup):
+            self.calls += 1
+            delay += self.serviceTime
+        self.clock.callLater(delay, d.callback, {'response': b"pong"})
+        return d
+
+
+@implementer(iampoule.IStarter)
+class FakeStarter(object):
+    """
+    A process starter that creates L{FakeChild} workers.
+    """
+    def __init__(self, clock, spawnLatency=0.5, serviceTime=0.1):
+        self.clock = clock
+        self.spawnLatency = spawnLatency
+        self.serviceTime = serviceTime
+        self.started = []
+
+    def startAMPProcess(self, ampChild, ampParent=None, ampChildArgs=()):
+        child = FakeChild(self.clock, self.spawnLatency, self.serviceTime)
+        self.started.append(child)
+        return child, child.finished
+
+    def startPythonProcess(self, prot, *args):
+        raise NotImplementedError()
+
+
+class LoadSimulation(object):
+    """
+    Drive a pool of L{FakeChild} workers with a given load on a
+    L{task.Clock} and keep track of what happens.
+
+    @ivar latencies: The latency of every call that completed.
+
+    @ivar sizes: The size of the pool after every step.
+    """
+    def __init__(self, testCase, spawnLatency=0.5, serviceTime=0.1,
+                 step=0.01, **poolKwargs):
+        self.clock = task.Clock()
+        testCase.patch(pool, 'now', self.clock.seconds)
+        self.starter = FakeStarter(self.clock, spawnLatency, serviceTime)
+        poolKwargs.setdefault('recycleAfter', 0)
+        self.scaler = poolKwargs.setdefault(
+            'scaler', scaling.ScalingController(clock=self.clock))
+        self.pool = pool.ProcessPool(starter=self.starter, **poolKwargs)
+        self.step = step
+        self.latencies = []
+        self.sizes = []
+
+    def start(self):
+        self.pool.start()
+
+    def stop(self):
+        d = self.pool.stop()
+        self.clock.advance(0)
+        return d
+
+    def run(self, duration, rate):
+        """
+        Send C{rate} calls per second for C{duration} seconds.
+        """
+        end = self.clock.seconds() + duration
+        credit = 0.0
+        while self.clock.seconds() < end:
+            credit += rate * self.step
+            while credit >= 1:
+                credit -= 1
+                self._call()
+            self.clock.advance(self.step)
+            self.sizes.append(len(self.pool.processes))
+
+    def _call(self):
+        started = self.clock.seconds()
+        def _done(_):
+            self.latencies.append(self.clock.seconds() - started)
+        self.pool.doWork(commands.Echo, data=b"x").addCallback(_done)
+
+
+class TestQueueTheoryPolicy(unittest.TestCase):
+
+    def sample(self, processes, rate, serviceTime=0.1, queueDepth=0,
+               inflight=0):
+        return scaling.LoadSample(
+            processes=processes, starting=0, inflight=inflight, queueDepth=queueDepth,
+            arrivalRate=rate, serviceTime=serviceTime, spawnLatency=0.5,
+            perChild=1, interval=1.0)
+
+    def test_grow(self):
+        """
+        Test that the policy asks for enough workers to run the offered
+        load below the high utilization.
+        """
+        policy = scaling.QueueTheoryPolicy(highUtilization=0.8)
+        # 40 calls per second of 0.1 seconds are 4 busy workers
+        self.assertEquals(policy.targetSize(self.sample(2, 40)), 5)
+
+    def test_backlog(self):
+        """
+        Test that the policy asks for more workers to drain the queue.
+        """
+        policy = scaling.QueueTheoryPolicy()
+        quiet = policy.targetSize(self.sample(1, 8))
+        queued = policy.targetSize(self.sample(1, 8, queueDepth=20))
+        self.assertTrue(queued > quiet)
+
+    def test_hysteresis(self):
+        """
+        Test that the policy doesn't change the size of the pool while the
+        utilization is between the low and the high mark.
+        """
+        policy = scaling.QueueTheoryPolicy(highUtilization=0.8,
+                                           lowUtilization=0.5)
+        # 3 busy workers out of 5 is a 0.6 utilization
+        self.assertEquals(policy.targetSize(self.sample(5, 30)), 5)
+        # 2 busy workers out of 5 is a 0.4 utilization
+        self.assertEquals(policy.targetSize(self.sample(5, 20)), 4)
+
+    def test_unknownServiceTime(self):
+        """
+        Test that without a service time the policy makes room for the
+        calls in flight and in the queue, doubling the pool at most.
+        """
+        policy = scaling.QueueTheoryPolicy()
+        sample = self.sample(3, 0, serviceTime=None, queueDepth=2, inflight=2)
+        self.assertEquals(policy.targetSize(sample), 5)
+        sample = self.sample(1, 0, serviceTime=None, queueDepth=3, inflight=1)
+        self.assertEquals(policy.targetSize(sample), 2)
+
+
+class TestScalingController(unittest.TestCase):
+
+    def test_followsLoad(self):
+        """
+        Test that the pool grows to the size needed by a steady load and
+        goes back to its minimum once the load is gone.
+        """
+        sim = LoadSimulation(self, min=1, max=20, serviceTime=0.1)
+        sim.scaler.downCooldown = 5
+        sim.start()
+        sim.run(10, rate=40)
+        # 4 busy workers need at least 5 workers to stay under the 0.8
+        # utilization, and no more than 8 to stay over 0.5.
+        self.assertTrue(5 <= len(sim.pool.processes) <= 8)
+        self.assertEquals(sim.pool._queueDepth, 0)
+        # once settled the pool doesn't oscillate
+        self.assertEquals(len(set(sim.sizes[-500:])), 1)
+        sim.run(30, rate=0)
+        self.assertEquals(len(sim.pool.processes), 1)
+        return sim.stop()
+
+    def test_noGrowthOnRequestPath(self):
+        """
+        Test that with a scaler doWork doesn't start workers by itself
+        once the pool has some.
+        """
+        sim = LoadSimulation(self, min=1, max=20)
+        sim.scaler.upCooldown = 100
+        sim.scaler.lastChange = sim.clock.seconds()
+        sim.start()
+        for i in range(5):
+            sim._call()
+        self.assertEquals(len(sim.pool.processes), 1)
+        self.assertEquals(sim.pool._queueDepth, 4)
+        sim.run(1, rate=0)
+        self.assertEquals(len(sim.latencies), 5)
+        return sim.stop()
+
+    def test_downCooldown(self):
+        """
+        Test that the pool doesn't shrink before the down cooldown is
+        over.
+        """
+        sim = LoadSimulation(self, min=1, max=20, serviceTime=0.1)
+        sim.scaler.downCooldown = 20
+        sim.start()
+        sim.run(5, rate=40)
+        grown = len(sim.pool.processes)
+        self.assertTrue(grown > 1)
+        sim.run(10, rate=0)
+        self.assertEquals(len(sim.pool.processes), grown)
+        sim.run(20, rate=0)
+        self.assertEquals(len(sim.pool.processes), 1)
+        return sim.stop()
+
+    def test_spawnLatency(self):
+        """
+        Test that the pool measures how long it takes to start a worker.
+        """
+        sim = LoadSimulation(self, min=2, max=2, spawnLatency=0.5)
+        sim.start()
+        sim.run(1, rate=0)
+        self.assertAlmostEqual(sim.pool.spawnLatency, 0.5, 1)
+        return sim.stop()
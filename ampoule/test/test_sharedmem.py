@@ -0,0 +1,181 @@
+import hashlib
+import os
+
+from twisted.protocols import amp
+from twisted.test import iosim
+from twisted.trial import unittest
+
+from ampoule import cache, child, pool, sharedmem
+from ampoule.sharedmem import SharedBytes
+
+
+class Digest(amp.Command):
+    arguments = [(b'data', SharedBytes())]
+    response = [(b'digest', amp.String()),
+                (b'kind', amp.String())]
+
+
+class Produce(amp.Command):
+    arguments = [(b'size', amp.Integer())]
+    response = [(b'data', SharedBytes())]
+
+
+class SharedChild(child.AMPChild):
+    @Digest.responder
+    def digest(self, data):
+        return {'digest': hashlib.md5(data).hexdigest().encode(),
+                'kind': type(data).__name__.encode()}
+
+    @Produce.responder
+    def produce(self, size):
+        return {'data': b"p" * size}
+
+
+class Put(amp.Command):
+    arguments = [(b'data', SharedBytes(threshold=1024))]
+
+
+class Receiver(amp.AMP):
+    def __init__(self):
+        amp.AMP.__init__(self)
+        self.received = []
+
+    @Put.responder
+    def put(self, data):
+        self.received.append(data)
+        return {}
+
+
+def _ours():
+    """
+    The shared files written by this process.
+    """
+    directory = sharedmem.segmentDirectory()
+    return [name for name in sharedmem._segments(directory)
+            if name.split('-')[3] == str(os.getpid())]
+
+
+class TestSharedBytes(unittest.TestCase):
+
+    def setUp(self):
+        self.client, self.server, self.pump = (
+            iosim.connectedServerAndClient(Receiver, amp.AMP))
+
+    def test_shared(self):
+        """
+        Test that a value over the threshold goes through a shared file
+        that is removed once the value is received.
+        """
+        value = os.urandom(1024 * 1024)
+        self.client.callRemote(Put, data=value)
+        self.assertEquals(len(_ours()), 1)
+        self.pump.flush()
+        received = self.server.received[0]
+        self.assertIsInstance(received, memoryview)
+        self.assertEquals(received, value)
+        self.assertEquals(_ours(), [])
+
+    def test_inline(self):
+        """
+        Test that a value below the threshold is sent inline.
+        """
+        self.client.callRemote(Put, data=bytearray(b"small"))
+        self.assertEquals(_ours(), [])
+        self.pump.flush()
+        self.assertEquals(self.server.received[0], b"small")
+
+    def test_noConnection(self):
+        """
+        Test that a value serialized without a connection is inline, so
+        the cache keys of calls with shared values leave no files behind
+        and hit.
+        """
+        resultCache = cache.ResultCache()
+        value = b"x" * 2048
+        key = resultCache.keyFor(Put, {'data': value})
+        self.assertEquals(_ours(), [])
+        self.assertEquals(key, resultCache.keyFor(Put, {'data': value}))
+        self.assertNotEquals(
+            key, resultCache.keyFor(Put, {'data': b"y" * 2048}))
+
+    def test_notShared(self):
+        """
+        Test that only the names of shared files are accepted from the
+        other side, and that other files are neither read nor removed.
+        """
+        path = self.mktemp()
+        with open(path, 'wb') as f:
+            f.write(b"private")
+        name = os.path.basename(path)
+        argument = SharedBytes()
+        for inString in [b"s7:" + os.path.abspath(path).encode(),
+                         b"s7:" + name.encode(),
+                         b"s7:" + sharedmem.PREFIX.encode() + b"/../x",
+                         b"s7:../" + sharedmem.PREFIX.encode()]:
+            self.assertRaises(ValueError, argument.fromStringProto,
+                              inString, None)
+        with open(path, 'rb') as f:
+            self.assertEquals(f.read(), b"private")
+
+    def test_sweep(self):
+        """
+        Test that sweep removes the files of a child.
+        """
+        path = sharedmem._write(b"lost", 1234567)
+        other = sharedmem._write(b"kept", 12345678)
+        sharedmem.sweep(1234567)
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(other))
+        os.unlink(other)
+
+
+class TestPoolSharedMemory(unittest.TestCase):
+
+    def test_argument(self):
+        """
+        Test that a child gets a big argument as a memoryview.
+        """
+        pp = pool.ProcessPool(ampChild=SharedChild, min=1, max=1)
+        self.addCleanup(pp.stop)
+        data = os.urandom(4 * 1024 * 1024)
+
+        def _checks(result):
+            self.assertEquals(result['digest'],
+                              hashlib.md5(data).hexdigest().encode())
+            self.assertEquals(result['kind'], b"memoryview")
+            self.assertEquals(_ours(), [])
+
+        return pp.start(
+            ).addCallback(lambda _: pp.doWork(Digest, data=data)
+            ).addCallback(_checks)
+
+    def test_response(self):
+        """
+        Test that the pool gets a big response from a child.
+        """
+        pp = pool.ProcessPool(ampChild=SharedChild, min=1, max=1)
+        self.addCleanup(pp.stop)
+        size = 3 * 1024 * 1024 + 5
+
+        def _checks(result):
+            self.assertEquals(result['data'], b"p" * size)
+
+        return pp.start(
+            ).addCallback(lambda _: pp.doWork(Produce, size=size)
+            ).addCallback(_checks)
+
+    def test_childGone(self):
+        """
+        Test that the files of a child are removed when it goes away.
+        """
+        pp = pool.ProcessPool(ampChild=SharedChild, min=1, max=1)
+
+        def _stop(_):
+            child = next(iter(pp.processes))
+            pid = sharedmem.childPid(child)
+            self.assertNotEquals(pid, None)
+            path = sharedmem._write(b"never read", pid)
+            return pp.stop().addCallback(
+                lambda _: self.assertFalse(os.path.exists(path)))
+
+        return pp.start().addCallback(_stop)
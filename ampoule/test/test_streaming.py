@@ -0,0 +1,197 @@
+import hashlib
+
+from twisted.internet import defer
+from twisted.protocols import amp
+from twisted.python import failure
+from twisted.test import iosim
+from twisted.trial import unittest
+
+from ampoule import child, pool, streaming
+from ampoule.streaming import Stream
+
+
+class Upload(amp.Command):
+    arguments = [(b'data', Stream())]
+    response = [(b'size', amp.Integer()),
+                (b'digest', amp.String())]
+
+
+class Download(amp.Command):
+    arguments = [(b'size', amp.Integer())]
+    response = [(b'data', Stream())]
+
+
+class StreamingChild(child.AMPChild):
+    @Upload.responder
+    def upload(self, data):
+        h = hashlib.md5()
+        size = [0]
+
+        def _read(chunk):
+            if not chunk:
+                return {'size': size[0], 'digest': h.hexdigest().encode()}
+            size[0] += len(chunk)
+            h.update(chunk)
+            return data.read().addCallback(_read)
+
+        return data.read().addCallback(_read)
+
+    @Download.responder
+    def download(self, size):
+        def _produce():
+            left = size
+            while left:
+                chunk = min(left, 100000)
+                left -= chunk
+                yield b"x" * chunk
+        return {'data': _produce()}
+
+
+class Send(amp.Command):
+    arguments = [(b'data', Stream())]
+
+
+class Receiver(streaming.StreamingAMP):
+    def __init__(self):
+        streaming.StreamingAMP.__init__(self)
+        self.received = []
+
+    @Send.responder
+    def send(self, data):
+        self.received.append(data)
+        return {}
+
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        self.client, self.server, self.pump = (
+            iosim.connectedServerAndClient(Receiver, streaming.StreamingAMP))
+        self.received = self.server.received
+
+    def test_bytes(self):
+        """
+        Test that a value bigger than an AMP value goes through.
+        """
+        value = b"".join(b"%d," % (i,) for i in range(100000))
+        self.client.callRemote(Send, data=value)
+        self.pump.flush()
+        d = self.received[0].readAll()
+        self.pump.flush()
+        self.assertEquals(self.successResultOf(d), value)
+
+    def test_flowControl(self):
+        """
+        Test that the sender doesn't get ahead of the reader by more than
+        WINDOW chunks.
+        """
+        produced = []
+
+        def _produce():
+            for i in range(100):
+                produced.append(i)
+                yield b"y" * streaming.CHUNK_SIZE
+
+        self.client.callRemote(Send, data=_produce())
+        self.pump.flush()
+        self.assertEquals(len(produced), streaming.WINDOW)
+        reader = self.received[0]
+        self.assertEquals(len(reader._chunks), streaming.WINDOW)
+        d = reader.readAll()
+        self.pump.flush()
+        self.assertEquals(len(self.successResultOf(d)),
+                          100 * streaming.CHUNK_SIZE)
+
+    def test_deferredPieces(self):
+        """
+        Test that a stream can be produced asynchronously.
+        """
+        later = defer.Deferred()
+        self.client.callRemote(Send, data=iter([b"a", later, b"c"]))
+        self.pump.flush()
+        reader = self.received[0]
+        d = reader.readAll()
+        self.pump.flush()
+        self.assertNoResult(d)
+        later.callback(b"b")
+        self.pump.flush()
+        self.assertEquals(self.successResultOf(d), b"abc")
+
+    def test_error(self):
+        """
+        Test that the reader fails if the sender can't produce the stream.
+        """
+        def _produce():
+            yield b"a"
+            raise ValueError("no more")
+
+        self.client.callRemote(Send, data=_produce())
+        self.pump.flush()
+        d = self.received[0].readAll()
+        self.pump.flush()
+        failure = self.failureResultOf(d, streaming.StreamError)
+        self.assertIn("no more", failure.getErrorMessage())
+
+    def test_connectionLost(self):
+        """
+        Test that a stream fails if its connection is lost before its end.
+        """
+        def _produce():
+            yield b"a"
+            yield defer.Deferred()
+
+        self.client.callRemote(Send, data=_produce())
+        self.pump.flush()
+        d = self.received[0].readAll()
+        self.pump.flush()
+        self.server.connectionLost(failure.Failure(Exception("gone")))
+        self.failureResultOf(d)
+        self.assertEquals(self.server._ampouleStreams.readers, {})
+
+
+class TestPoolStreaming(unittest.TestCase):
+
+    def test_upload(self):
+        """
+        Test that a child can read a stream sent by the pool.
+        """
+        pp = pool.ProcessPool(ampChild=StreamingChild, min=1, max=1)
+        self.addCleanup(pp.stop)
+        data = b"z" * (1024 * 1024 + 17)
+
+        def _checks(result):
+            self.assertEquals(result['size'], len(data))
+            self.assertEquals(result['digest'],
+                              hashlib.md5(data).hexdigest().encode())
+
+        return pp.start(
+            ).addCallback(lambda _: pp.doWork(Upload, data=data)
+            ).addCallback(_checks)
+
+    def test_download(self):
+        """
+        Test that a child can stream a response to the pool.
+        """
+        pp = pool.ProcessPool(ampChild=StreamingChild, min=1, max=1)
+        self.addCleanup(pp.stop)
+        size = 3 * 1024 * 1024
+
+        return pp.start(
+            ).addCallback(lambda _: pp.doWork(Download, size=size)
+            ).addCallback(lambda result: result['data'].readAll()
+            ).addCallback(lambda data: self.assertEquals(data, b"x" * size))
+
+    def test_downloadRecycled(self):
+        """
+        Test that a child recycled right after it answered with a stream
+        sends the whole stream before it exits.
+        """
+        pp = pool.ProcessPool(ampChild=StreamingChild, min=1, max=1,
+                              recycleAfter=1)
+        self.addCleanup(pp.stop)
+        size = 3 * 1024 * 1024
+
+        return pp.start(
+            ).addCallback(lambda _: pp.doWork(Download, size=size)
+            ).addCallback(lambda result: result['data'].readAll()
+            ).addCallback(lambda data: self.assertEquals(data, b"x" * size))
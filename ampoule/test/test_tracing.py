@@ -0,0 +1,160 @@
+import json
+
+from twisted.internet import defer, task
+from twisted.protocols import amp
+from twisted.test import iosim
+from twisted.trial import unittest
+
+from ampoule import pool, tracing
+from ampoule.test.test_process import Pid, PidChild
+
+
+class Add(amp.Command):
+    arguments = [(b'a', amp.Integer()), (b'b', amp.Integer())]
+    response = [(b'total', amp.Integer())]
+    errors = {ValueError: b'NEGATIVE'}
+
+
+class Server(tracing.TracingAMP):
+    clock = None
+    boxes = None
+
+    @Add.responder
+    def add(self, a, b):
+        if b < 0:
+            raise ValueError(b)
+        if self.clock is None:
+            return {'total': a + b}
+        return task.deferLater(self.clock, 1, lambda: {'total': a + b})
+
+    def ampBoxReceived(self, box):
+        if self.boxes is not None:
+            self.boxes.append(box)
+        return tracing.TracingAMP.ampBoxReceived(self, box)
+
+
+class PlainServer(amp.AMP):
+    @Add.responder
+    def add(self, a, b):
+        return {'total': a + b}
+
+
+class TestTracingAMP(unittest.TestCase):
+
+    def _connect(self, serverClass=Server):
+        self.client, self.server, self.pump = (
+            iosim.connectedServerAndClient(serverClass, tracing.TracingAMP))
+
+    def test_stamps(self):
+        """
+        Test that the other side stamps a traced call in order, and that
+        the answer is unaffected.
+        """
+        self._connect()
+        d, stamps = self.client.callRemoteTraced(Add, a=1, b=2)
+        self.pump.flush()
+        self.assertEquals(self.successResultOf(d), {'total': 3})
+        self.assertEquals(len(stamps), 5)
+        self.assertEquals(stamps, sorted(stamps))
+        self.assertEquals(self.client._traces, {})
+        self.assertEquals(self.server._stamps, {})
+
+    def test_deferredResponder(self):
+        """
+        Test that the end of a responder is stamped when its result
+        fires.
+        """
+        self._connect()
+        self.server.clock = task.Clock()
+        d, stamps = self.client.callRemoteTraced(Add, a=1, b=2)
+        self.pump.flush()
+        self.assertEquals(stamps, [])
+        self.server.clock.advance(1)
+        self.pump.flush()
+        self.assertEquals(self.successResultOf(d), {'total': 3})
+        received, started, finished, sent, returned = stamps
+        self.assertTrue(started <= finished <= sent)
+
+    def test_errors(self):
+        """
+        Test that failed calls are stamped too.
+        """
+        self._connect()
+        d, stamps = self.client.callRemoteTraced(Add, a=1, b=-2)
+        d = self.assertFailure(d, ValueError)
+        self.pump.flush()
+        self.successResultOf(d)
+        self.assertEquals(len(stamps), 5)
+        self.assertEquals(stamps, sorted(stamps))
+
+    def test_untraced(self):
+        """
+        Test that calls made with callRemote aren't stamped.
+        """
+        self._connect()
+        self.server.boxes = []
+        d = self.client.callRemote(Add, a=1, b=2)
+        self.pump.flush()
+        self.assertEquals(self.successResultOf(d), {'total': 3})
+        self.assertNotIn(tracing.TRACE, self.server.boxes[0])
+        self.assertIdentical(self.server._stamps, None)
+
+    def test_oldPeer(self):
+        """
+        Test that a peer that doesn't stamp calls answers them anyway.
+        """
+        self._connect(PlainServer)
+        d, stamps = self.client.callRemoteTraced(Add, a=1, b=2)
+        self.pump.flush()
+        self.assertEquals(self.successResultOf(d), {'total': 3})
+        self.assertEquals(stamps[:4], [None] * 4)
+        self.assertNotIdentical(stamps[4], None)
+
+
+class TestPoolTracing(unittest.TestCase):
+
+    def test_pool(self):
+        """
+        Test that the tracer of a pool gets the timeline of every call,
+        and knows which ones waited for their child to start.
+        """
+        traces = []
+        pp = pool.ProcessPool(ampChild=PidChild, min=1, max=1,
+                              readyHandshake=True, tracer=traces.append)
+        self.addCleanup(pp.stop)
+        pp.start()
+
+        def _checks(results):
+            self.assertEquals(len(traces), 3)
+            for trace in traces:
+                self.assertEquals(trace.command, 'Pid')
+                self.assertEquals(trace.pid, results[0]['pid'])
+                self.assertFalse(trace.failed)
+                times = list(trace[2:9])
+                self.assertEquals(times, sorted(times))
+            self.assertEquals([trace.cold for trace in traces],
+                              [True, True, False])
+
+        calls = [pp.doWork(Pid), pp.doWork(Pid)]
+        return defer.gatherResults(calls
+            ).addCallback(lambda results: pp.doWork(Pid).addCallback(
+                lambda result: results + [result])
+            ).addCallback(_checks)
+
+    def test_jsonLines(self):
+        """
+        Test that the sink writes a JSON object per line.
+        """
+        path = self.mktemp()
+        sink = tracing.JSONLinesSink(path)
+        for i in range(2):
+            sink(tracing.CallTrace('Pid', 10 + i, 1.0, 2.0, None, None,
+                                   None, None, 3.0, False, i == 1))
+        sink.close()
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEquals(len(records), 2)
+        self.assertEquals(records[1]['pid'], 11)
+        self.assertEquals(records[1]['failed'], True)
+        self.assertEquals(records[0]['received'], None)
+        self.assertEquals(records[0]['returned'], 3.0)
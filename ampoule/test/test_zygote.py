@@ -0,0 +1,168 @@
+import os
+
+from twisted.internet import defer, error
+from twisted.protocols import amp
+from twisted.trial import unittest
+
+from ampoule import child, commands, main, pool
+from ampoule.test.test_process import BadChild, Die, Pid, PidChild
+
+if not main.IS_WINDOWS:
+    from ampoule import zygote
+
+
+class ParentPid(amp.Command):
+    response = [(b'pid', amp.Integer())]
+
+
+class ForkedChild(PidChild):
+    @ParentPid.responder
+    def parentPid(self):
+        return {'pid': os.getppid()}
+
+
+class TestZygoteProcessStarter(unittest.TestCase):
+
+    if main.IS_WINDOWS:
+        skip = "There is no fork on Windows"
+
+    def setUp(self):
+        self.starter = zygote.ZygoteProcessStarter(packages=("twisted",))
+        self.addCleanup(self.starter.stop)
+
+    def test_startAMPProcess(self):
+        """
+        Test that a forked child answers commands and exits cleanly.
+        """
+        c, finished = self.starter.startAMPProcess(child.AMPChild)
+        return c.callRemote(commands.Echo, data=b"ciao"
+            ).addCallback(lambda response:
+                self.assertEquals(response['response'], b"ciao")
+            ).addCallback(lambda _: c.callRemote(commands.Shutdown)
+            ).addCallback(lambda _: finished)
+
+    def test_forkedFromZygote(self):
+        """
+        Test that the children are forked by a single zygote.
+        """
+        children = [self.starter.startAMPProcess(ForkedChild)
+                    for i in range(3)]
+
+        def _checks(results):
+            pids = set(r['pid'] for r in results[:3])
+            parents = set(r['pid'] for r in results[3:])
+            self.assertEquals(len(pids), 3)
+            self.assertEquals(parents,
+                              set([self.starter._zygote.transport.pid]))
+            self.assertEquals(
+                sorted(self.starter._children), sorted(pids))
+
+        calls = ([c.callRemote(Pid) for c, _ in children] +
+                 [c.callRemote(ParentPid) for c, _ in children])
+        return defer.gatherResults(calls).addCallback(_checks
+            ).addCallback(lambda _: defer.gatherResults(
+                [c.callRemote(commands.Shutdown) for c, _ in children])
+            ).addCallback(lambda _: defer.gatherResults(
+                [finished for _, finished in children]))
+
+    def test_exitStatus(self):
+        """
+        Test that the exit status of a child is reported.
+        """
+        c, finished = self.starter.startAMPProcess(BadChild)
+        c.callRemote(Die).addErrback(lambda _: None)
+        return self.assertFailure(finished, error.ProcessTerminated)
+
+    def test_arguments(self):
+        """
+        Test that the arguments of the child class get to it.
+        """
+        c, finished = self.starter.startAMPProcess(
+            ArgumentChild, ampChildArgs=(b"ciao",))
+        return c.callRemote(commands.Ping
+            ).addCallback(lambda response:
+                self.assertEquals(response['response'], b"ciao")
+            ).addCallback(lambda _: c.callRemote(commands.Shutdown)
+            ).addCallback(lambda _: finished)
+
+    def test_zygoteGone(self):
+        """
+        Test that the next child starts a new zygote when the previous one
+        is gone.
+        """
+        c, finished = self.starter.startAMPProcess(child.AMPChild)
+        first = self.starter._zygote.transport.pid
+
+        def _restart(_):
+            self.assertIdentical(self.starter._zygote, None)
+            c, finished = self.starter.startAMPProcess(child.AMPChild)
+            self.assertNotEquals(self.starter._zygote.transport.pid, first)
+            return c.callRemote(commands.Shutdown
+                ).addCallback(lambda _: finished)
+
+        return c.callRemote(commands.Shutdown
+            ).addCallback(lambda _: finished
+            ).addCallback(lambda _: self.starter.stop()
+            ).addCallback(_restart)
+
+    def test_start(self):
+        """
+        Test that the zygote starts ahead of the children without blocking,
+        and that children asked for before it's up are forked once it is.
+        """
+        started = self.starter.start()
+        self.assertFalse(started.called)
+        c, finished = self.starter.startAMPProcess(child.AMPChild)
+        self.assertEquals(len(self.starter._pending), 1)
+        self.assertIdentical(self.starter._pending[0].pid, None)
+
+        def _check(_):
+            self.assertTrue(self.starter.start().called)
+            return c.callRemote(commands.Echo, data=b"ciao")
+
+        return started.addCallback(_check
+            ).addCallback(lambda response:
+                self.assertEquals(response['response'], b"ciao")
+            ).addCallback(lambda _: self.assertEquals(
+                len(self.starter._pending), 0)
+            ).addCallback(lambda _: c.callRemote(commands.Shutdown)
+            ).addCallback(lambda _: finished)
+
+    def test_forkTimeout(self):
+        """
+        Test that a zygote that doesn't fork a child in time is killed, and
+        that the child fails to start.
+        """
+        self.patch(zygote, 'FORK_TIMEOUT', 0)
+        c, finished = self.starter.startAMPProcess(child.AMPChild)
+        started = self.assertFailure(self.starter.start(), RuntimeError)
+        return self.assertFailure(finished, error.ProcessTerminated
+            ).addCallback(lambda _: started
+            ).addCallback(lambda _: self.assertIdentical(
+                self.starter._zygote, None))
+
+    def test_pool(self):
+        """
+        Test that a pool can run on forked children, recycled ones
+        included.
+        """
+        pp = pool.ProcessPool(ampChild=ForkedChild, min=2, max=2,
+                              recycleAfter=2, starter=self.starter)
+        self.addCleanup(pp.stop)
+
+        def _run(_):
+            return defer.gatherResults([pp.doWork(Pid) for i in range(10)])
+
+        return pp.start().addCallback(_run).addCallback(
+            lambda results: self.assertTrue(len(set(
+                r['pid'] for r in results)) > 2))
+
+
+class ArgumentChild(child.AMPChild):
+    def __init__(self, greeting):
+        child.AMPChild.__init__(self)
+        self.greeting = greeting
+
+    def ping(self):
+        return {'response': self.greeting.encode('ascii')}
+    commands.Ping.responder(ping)
@@ -0,0 +1,174 @@
+"""
+Follow a call of a L{ampoule.pool.ProcessPool} from the moment it's
+queued to the moment its answer is back, to tell where the time went.
+
+Register an observer on the pool and it gets a L{CallTrace} for every
+call that completes::
+
+    pool = ProcessPool(MyChild, tracer=tracing.JSONLinesSink("calls.jsonl"))
+
+The pool asks the child to stamp the call by adding a L{TRACE} key to its
+box, and the child puts its stamps in the same key of its answer. Calls
+of pools without an observer don't carry the key, and cost nothing more
+than a check.
+"""
+import collections
+import json
+import time
+
+from twisted.internet import defer
+from twisted.protocols import amp
+
+
+# the key of the boxes that carries the stamps
+TRACE = b'_trace'
+
+
+CallTrace = collections.namedtuple('CallTrace', [
+    'command', 'pid', 'enqueued', 'dispatched', 'received', 'started',
+    'finished', 'sent', 'returned', 'cold', 'failed'])
+CallTrace.__doc__ = """
+The timeline of a call of a L{ampoule.pool.ProcessPool}.
+
+Times are in seconds since the epoch, the ones of the child are
+L{None} when it didn't stamp the call.
+
+@ivar command: The name of the command.
+@ivar pid: The process id of the child that ran it.
+@ivar enqueued: When the pool got the call.
+@ivar dispatched: When the pool sent it to the child.
+@ivar received: When the child got it.
+@ivar started: When the responder was called.
+@ivar finished: When the responder returned, or its result fired.
+@ivar sent: When the child sent the answer.
+@ivar returned: When the pool got the answer.
+@ivar cold: Whether the call waited for its child to start.
+@ivar failed: Whether the call failed.
+"""
+
+
+
+def _encode(stamps):
+    return b" ".join(b"-" if stamp is None else b"%.6f" % (stamp,)
+                     for stamp in stamps)
+
+
+def _decode(value):
+    stamps = [None if stamp == b"-" else float(stamp)
+              for stamp in value.split()]
+    return (stamps + [None] * 4)[:4]
+
+
+
+class TracingAMP(amp.AMP):
+    """
+    An L{amp.AMP} protocol that stamps the calls it gets with a L{TRACE}
+    key, and can ask the other side to stamp the calls it makes.
+    """
+
+    # stamps of the calls received, by their tag, until answered
+    _stamps = None
+    # the stamps of the call being dispatched right now
+    _stamping = None
+    # stamps of the calls made with callRemoteTraced, by their tag
+    _traces = None
+    # the list that the next call will fill with its stamps
+    _nextTrace = None
+
+    def callRemoteTraced(self, command, **kwargs):
+        """
+        Like L{callRemote}, but have the other side stamp the call.
+
+        @return: a tuple with the L{defer.Deferred} of the call and a
+                 list that holds, when it fires, the times the other side
+                 received the call, started and finished running it and
+                 sent its answer, then the time the answer got here.
+        """
+        trace = []
+        self._nextTrace = trace
+        try:
+            d = self.callRemote(command, **kwargs)
+        finally:
+            self._nextTrace = None
+        return d, trace
+
+    def _sendBoxCommand(self, command, box, requiresAnswer=True):
+        trace = self._nextTrace
+        if trace is None or not requiresAnswer:
+            return amp.AMP._sendBoxCommand(self, command, box, requiresAnswer)
+        self._nextTrace = None
+        box[TRACE] = b"1"
+        d = amp.AMP._sendBoxCommand(self, command, box, requiresAnswer)
+        if amp.ASK in box:
+            if self._traces is None:
+                self._traces = {}
+            self._traces[box[amp.ASK]] = trace
+        return d
+
+    def ampBoxReceived(self, box):
+        if self._traces:
+            tag = box.get(amp.ANSWER, box.get(amp.ERROR))
+            trace = self._traces.pop(tag, None)
+            if trace is not None:
+                trace.extend(_decode(box.get(TRACE, b"")))
+                trace.append(time.time())
+        if TRACE in box and amp.ASK in box and amp.COMMAND in box:
+            if self._stamps is None:
+                self._stamps = {}
+            stamps = self._stamps[box[amp.ASK]] = [time.time(), None, None,
+                                                   None]
+            self._stamping = stamps
+            try:
+                return amp.AMP.ampBoxReceived(self, box)
+            finally:
+                self._stamping = None
+        return amp.AMP.ampBoxReceived(self, box)
+
+    def _wrapWithSerialization(self, aCallable, command):
+        stamps = self._stamping
+        if stamps is not None:
+            # only the responder of the command that was received, not
+            # the ones that it might look up in turn
+            self._stamping = None
+            aCallable = _stamped(aCallable, stamps)
+        return amp.AMP._wrapWithSerialization(self, aCallable, command)
+
+    def sendBox(self, box):
+        if self._stamps:
+            tag = box.get(amp.ANSWER, box.get(amp.ERROR))
+            stamps = self._stamps.pop(tag, None)
+            if stamps is not None:
+                stamps[3] = time.time()
+                box[TRACE] = _encode(stamps)
+        return super(TracingAMP, self).sendBox(box)
+
+
+def _stamped(aCallable, stamps):
+    """
+    Wrap a responder to stamp when it starts and when it's done.
+    """
+    def _done(result):
+        stamps[2] = time.time()
+        return result
+
+    def stamped(**kw):
+        stamps[1] = time.time()
+        return defer.maybeDeferred(aCallable, **kw).addBoth(_done)
+    return stamped
+
+
+
+class JSONLinesSink(object):
+    """
+    An observer of L{CallTrace}s that writes each of them to a file as a
+    JSON object on its own line.
+    """
+
+    def __init__(self, path, mode='a'):
+        self.file = open(path, mode)
+
+    def __call__(self, trace):
+        self.file.write(json.dumps(trace._asdict()) + "\n")
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,618 @@
+"""
+Start the children by forking them from a template process.
+
+A child started by L{main.ProcessStarter} runs a new Python interpreter
+that imports Twisted and its child class before it can answer, and every
+recycled child pays for it again. L{ZygoteProcessStarter} starts a
+single template process instead, the zygote, that imports the modules
+in C{preload} once and then forks a child whenever one is needed. The
+child only has to install its reactor and import what wasn't preloaded,
+and the pages of the preloaded modules are shared with the zygote until
+they are written to::
+
+    starter = ZygoteProcessStarter(packages=("twisted", "myproject"),
+                                   preload=PRELOAD + ("myproject.work",))
+    pp = ProcessPool(Child, starter=starter)
+    ...
+    pp.stop().addCallback(lambda _: starter.stop())
+
+The preloaded modules must not install a reactor, that is import
+C{twisted.internet.reactor} at import time: the children install their
+own after the fork. The zygote refuses to start if one did.
+
+The zygote starts when the pool starts, or with the first child, and
+takes as long as a child started by L{main.ProcessStarter} to import
+its C{preload}. Children asked for in the meantime are forked once it's
+done: L{ZygoteProcessStarter.startAMPProcess} returns right away and the
+calls sent to a child wait in its pipe until it's forked. A zygote that
+doesn't fork a child in L{FORK_TIMEOUT} seconds is killed, and the
+children waiting for it fail to start. The children are children of the
+zygote, which reports their exit status to us. This needs C{fork}, so
+it's not available on Windows.
+"""
+import array
+import collections
+import errno
+import json
+import os
+import signal
+import socket
+import sys
+
+from zope.interface import implementer
+
+from twisted import logger
+from twisted.internet import defer, error, interfaces, process, protocol
+from twisted.python import failure
+
+from ampoule import iampoule, main
+
+
+
+log = logger.Logger()
+
+# imported by the zygote before it forks any child
+PRELOAD = ("twisted.application.reactors",
+           "twisted.internet.posixbase",
+           "twisted.internet.selectreactor",
+           "twisted.internet.stdio",
+           "twisted.logger",
+           "twisted.protocols.amp",
+           "ampoule.child")
+
+# seconds to wait for the zygote to fork a child, it may still be
+# importing the preloaded modules
+FORK_TIMEOUT = 30
+
+# sent by the zygote on its control socket once it preloaded its modules
+READY = b"ready"
+
+# the fds of a child that we keep the other end of, and whether we write
+# to them
+_PIPES = {2: False, main.TO_CHILD: True, main.FROM_CHILD: False}
+
+
+ZYGOTE = """\
+import sys, json
+from ampoule import zygote
+zygote.serve(**json.loads(sys.argv[1]))
+"""
+
+
+class _ForkedProcess(object):
+    """
+    The transport of a child forked by the zygote, a process that isn't
+    ours.
+    """
+
+    # the call failing the fork if the zygote takes too long
+    timeout = None
+
+    def __init__(self, proto, pid, fds):
+        """
+        @param pid: The process id of the child, L{None} until it's
+                    forked, see L{forked}.
+
+        @param fds: Our end of the pipes, by the fd of the child they go
+                    to.
+        """
+        from twisted.internet import reactor
+        self.proto = proto
+        self.pid = pid
+        self.status = None
+        self.lostProcess = False
+        # signals sent before the child was forked
+        self.signals = []
+        self.pipes = {}
+        for childFD, fd in fds.items():
+            if _PIPES[childFD]:
+                self.pipes[childFD] = process.ProcessWriter(
+                    reactor, self, childFD, fd)
+            else:
+                self.pipes[childFD] = process.ProcessReader(
+                    reactor, self, childFD, fd)
+        proto.makeConnection(self)
+
+    def __repr__(self):
+        return "<%s pid=%s status=%s>" % (self.__class__.__name__,
+                                          self.pid, self.status)
+
+    def writeToChild(self, childFD, data):
+        self.pipes[childFD].write(data)
+
+    def closeChildFD(self, childFD):
+        if childFD in self.pipes:
+            self.pipes[childFD].loseConnection()
+
+    def loseConnection(self):
+        for childFD in list(self.pipes):
+            self.closeChildFD(childFD)
+
+    def forked(self, pid):
+        """
+        The zygote forked the child.
+        """
+        self.pid = pid
+        signals, self.signals = self.signals, []
+        for signalID in signals:
+            try:
+                self.signalProcess(signalID)
+            except error.ProcessExitedAlready:
+                pass
+
+    def signalProcess(self, signalID):
+        if signalID in ("HUP", "STOP", "INT", "KILL", "TERM"):
+            signalID = getattr(signal, "SIG%s" % (signalID,))
+        if self.lostProcess:
+            raise error.ProcessExitedAlready()
+        if self.pid is None:
+            self.signals.append(signalID)
+            return
+        try:
+            os.kill(self.pid, signalID)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                raise error.ProcessExitedAlready()
+            raise
+
+    def childDataReceived(self, childFD, data):
+        self.proto.childDataReceived(childFD, data)
+
+    def childConnectionLost(self, childFD, reason):
+        os.close(self.pipes.pop(childFD).fileno())
+        self.proto.childConnectionLost(childFD)
+        self._maybeEnded()
+
+    def processEnded(self, status):
+        """
+        The zygote told us that the child is gone, with its wait status
+        or L{None} if the zygote went away first.
+        """
+        if self.timeout is not None and self.timeout.active():
+            self.timeout.cancel()
+        self.status = status
+        self.lostProcess = True
+        self.pid = None
+        self.proto.processExited(failure.Failure(self._reason()))
+        self._maybeEnded()
+
+    def _reason(self):
+        if self.status is None:
+            return error.ProcessTerminated()
+        exitCode = sig = None
+        if os.WIFEXITED(self.status):
+            exitCode = os.WEXITSTATUS(self.status)
+        else:
+            sig = os.WTERMSIG(self.status)
+        if exitCode or sig:
+            return error.ProcessTerminated(exitCode, sig, self.status)
+        return error.ProcessDone(self.status)
+
+    def _maybeEnded(self):
+        # like twisted's, wait for the output to be all read too
+        if self.pipes or not self.lostProcess or self.proto is None:
+            return
+        proto, self.proto = self.proto, None
+        proto.processEnded(failure.Failure(self._reason()))
+
+
+class _ZygoteProtocol(protocol.ProcessProtocol):
+    """
+    Our end of the zygote. It writes a line with the pid and the wait
+    status of each child that exits on its stdout.
+    """
+
+    def __init__(self, starter):
+        self.starter = starter
+        self.buffer = b""
+        self.ended = defer.Deferred()
+
+    def outReceived(self, data):
+        lines = (self.buffer + data).split(b"\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            pid, status = line.split()
+            self.starter._childEnded(int(pid), int(status))
+
+    def errReceived(self, data):
+        for line in data.strip().splitlines():
+            log.error(u'FROM zygote: {l}', l=line)
+
+    def processEnded(self, reason):
+        log.info(u'Zygote ended')
+        self.starter._zygoteEnded(self)
+        self.ended.callback(None)
+
+
+@implementer(interfaces.IReadWriteDescriptor)
+class _Control(object):
+    """
+    Our end of the control socket of the zygote, read and written through
+    the reactor: the zygote may not take requests until it preloaded its
+    modules.
+    """
+
+    def __init__(self, starter, sock):
+        self.starter = starter
+        self.socket = sock
+        self.socket.setblocking(False)
+        # (request, fds sent with it) not sent yet
+        self.outgoing = collections.deque()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def logPrefix(self):
+        return 'ampoule.zygote'
+
+    def send(self, data, fds):
+        """
+        Send a request to the zygote, and close the fds once they're sent.
+        """
+        self.outgoing.append((data, fds))
+        if len(self.outgoing) == 1:
+            self.doWrite()
+
+    def doWrite(self):
+        from twisted.internet import reactor
+        while self.outgoing:
+            data, fds = self.outgoing[0]
+            try:
+                self.socket.sendmsg(
+                    [data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                              array.array('i', fds))])
+            except BlockingIOError:
+                reactor.addWriter(self)
+                return
+            except OSError as e:
+                # the zygote is gone, we'll hear about it from its process
+                log.error(u'Failed to write to the zygote: {e}', e=e)
+                self._drop()
+                return
+            self.outgoing.popleft()
+            for fd in fds:
+                os.close(fd)
+        reactor.removeWriter(self)
+
+    def doRead(self):
+        while self.socket.fileno() != -1:
+            try:
+                data = self.socket.recv(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            self.starter._replyReceived(data)
+
+    def connectionLost(self, reason):
+        pass
+
+    def _drop(self):
+        outgoing, self.outgoing = self.outgoing, collections.deque()
+        for data, fds in outgoing:
+            for fd in fds:
+                os.close(fd)
+
+    def close(self):
+        from twisted.internet import reactor
+        reactor.removeReader(self)
+        reactor.removeWriter(self)
+        self._drop()
+        self.socket.close()
+
+
+@implementer(iampoule.IStarter)
+class ZygoteProcessStarter(main.ProcessStarter):
+    """
+    A starter that forks the children from a zygote, see the module
+    documentation.
+
+    It takes the same arguments as L{main.ProcessStarter}, but for
+    C{usePTY}, and these:
+
+    @ivar preload: The names of the modules that the zygote imports.
+    @type preload: C{tuple} of C{str}
+    """
+
+    def __init__(self, bootstrap=main.BOOTSTRAP, args=(), env={},
+                 path=None, uid=None, gid=None, packages=(),
+                 childReactor="select", codec=None, preload=PRELOAD):
+        if main.IS_WINDOWS:
+            raise RuntimeError("ZygoteProcessStarter needs fork")
+        main.ProcessStarter.__init__(self, bootstrap, args, env, path, uid,
+                                     gid, 0, packages, childReactor, codec)
+        self.preload = tuple(preload)
+        self._zygote = None
+        self._control = None
+        # whether the zygote preloaded its modules, and the deferreds of
+        # start waiting for it
+        self._up = False
+        self._startWaiters = []
+        # pid -> _ForkedProcess
+        self._children = {}
+        # the _ForkedProcess not forked yet, in the order asked for
+        self._pending = collections.deque()
+        # pid -> wait status of the children that exited before we heard
+        # of their fork
+        self._endedEarly = {}
+
+    def _startZygote(self):
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        proto = _ZygoteProtocol(self)
+        config = {'control': 3, 'bootstrap': self.bootstrap,
+                  'preload': list(self.preload)}
+        try:
+            main._spawn(proto, ZYGOTE, (json.dumps(config),),
+                        self.environment(), self.path, self.uid, self.gid,
+                        0, childFDs={0: "w", 1: "r", 2: "r",
+                                     3: theirs.fileno()})
+        except:
+            ours.close()
+            raise
+        finally:
+            theirs.close()
+        from twisted.internet import reactor
+        self._zygote = proto
+        self._up = False
+        self._control = _Control(self, ours)
+        reactor.addReader(self._control)
+
+    def start(self):
+        """
+        Start the zygote, if it isn't already.
+
+        @return: a L{defer.Deferred} firing once the zygote preloaded its
+                 modules, or failing if it went away before.
+        """
+        if self._zygote is None:
+            self._startZygote()
+        if self._up:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._startWaiters.append(d)
+        return d
+
+    def startPythonProcess(self, prot, *args):
+        """
+        Fork a child from the zygote, starting the zygote if needed. The
+        child is forked once the zygote is up, what is written to it in
+        the meantime waits in its pipes.
+
+        @param prot: a L{protocol.ProcessProtocol} subclass
+        @type prot: L{protocol.ProcessProtocol}
+
+        @param args: a tuple of arguments that will be added after the
+                     ones in L{self.args} in the C{sys.argv} of the child.
+
+        @return: a tuple of the child process and the deferred finished.
+                 finished triggers when the subprocess dies for any reason.
+        """
+        if self._zygote is None:
+            self._startZygote()
+        args = [os.fsdecode(arg) for arg in self.args + args]
+        # (our end, their end) by the fd of the child
+        pipes = {}
+        for childFD, weWrite in _PIPES.items():
+            r, w = os.pipe()
+            pipes[childFD] = (w, r) if weWrite else (r, w)
+        theirs = [pipes[childFD][1] for childFD in sorted(pipes)]
+        from twisted.internet import reactor
+        child = _ForkedProcess(prot, None, dict(
+            (childFD, ends[0]) for childFD, ends in pipes.items()))
+        child.timeout = reactor.callLater(FORK_TIMEOUT, self._forkTimedOut)
+        self._pending.append(child)
+        self._control.send(json.dumps({'args': args}).encode('utf-8'),
+                           theirs)
+        return prot.amp, prot.finished
+
+    def _replyReceived(self, reply):
+        """
+        The zygote is up, or answered the oldest request to fork a child
+        with the pid of the child or an error.
+        """
+        if reply == READY:
+            self._up = True
+            waiters, self._startWaiters = self._startWaiters, []
+            for d in waiters:
+                d.callback(None)
+            return
+        if not self._pending:
+            log.error(u'Unexpected reply from the zygote: {r}', r=reply)
+            return
+        child = self._pending.popleft()
+        if child.timeout.active():
+            child.timeout.cancel()
+        if not reply.isdigit():
+            log.error(u'Zygote failed to fork: {r}',
+                      r=reply.decode('utf-8', 'replace'))
+            # it closed its ends of the pipes, so ours get closed too
+            child.processEnded(None)
+            return
+        pid = int(reply)
+        child.forked(pid)
+        if pid in self._endedEarly:
+            child.processEnded(self._endedEarly.pop(pid))
+        else:
+            self._children[pid] = child
+
+    def _forkTimedOut(self):
+        """
+        The zygote didn't fork a child in time: kill it, the children
+        waiting for it fail to start.
+        """
+        log.error(u'Zygote did not fork a child in {t}s, killing it.',
+                  t=FORK_TIMEOUT)
+        try:
+            self._zygote.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+
+    def _childEnded(self, pid, status):
+        child = self._children.pop(pid, None)
+        if child is not None:
+            child.processEnded(status)
+        else:
+            # the reply with its pid is yet to be read
+            self._endedEarly[pid] = status
+
+    def _zygoteEnded(self, proto):
+        if proto is not self._zygote:
+            return
+        self._zygote = None
+        self._up = False
+        self._control.close()
+        self._control = None
+        self._endedEarly.clear()
+        waiters, self._startWaiters = self._startWaiters, []
+        for d in waiters:
+            d.errback(RuntimeError("the zygote ended before it was up"))
+        # their exit status is lost with the zygote, and the ones not
+        # forked yet never will be
+        children, self._children = self._children, {}
+        pending, self._pending = self._pending, collections.deque()
+        for child in list(children.values()) + list(pending):
+            child.processEnded(None)
+
+    def stop(self):
+        """
+        Stop the zygote. The children already started keep running and the
+        next one starts a new zygote.
+
+        @return: a L{defer.Deferred} firing once the zygote is gone.
+        """
+        if self._zygote is None:
+            return defer.succeed(None)
+        ended = self._zygote.ended
+        # it exits when its stdin is closed
+        self._zygote.transport.closeStdin()
+        return ended
+
+
+def serve(control, bootstrap, preload):
+    """
+    Run the zygote: import the C{preload} modules, then fork a child to
+    run C{bootstrap} for every request received on the C{control}
+    socket, until our stdin is closed.
+    """
+    import gc
+    import importlib
+    import select
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for name in preload:
+        importlib.import_module(name)
+    # the children look their reactor up among the plugins
+    from twisted.application import reactors
+    list(reactors.getReactorTypes())
+    if 'twisted.internet.reactor' in sys.modules:
+        sys.stderr.write("a preloaded module installed a reactor\n")
+        sys.exit(1)
+    code = compile(bootstrap, '<string>', 'exec')
+
+    sock = socket.socket(fileno=control)
+    wakeup, wakeupW = os.pipe()
+    for fd in wakeup, wakeupW:
+        os.set_blocking(fd, False)
+    signal.set_wakeup_fd(wakeupW)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    # keep the preloaded objects out of the collections of the children,
+    # which would write to their pages
+    gc.freeze()
+    sock.send(READY)
+
+    while True:
+        try:
+            readable = select.select([0, sock, wakeup], [], [])[0]
+        except InterruptedError:
+            continue
+        if wakeup in readable:
+            while True:
+                try:
+                    if not os.read(wakeup, 512):
+                        break
+                except BlockingIOError:
+                    break
+            _reap()
+        if 0 in readable and not os.read(0, 512):
+            return
+        if sock in readable:
+            data, ancdata, flags, addr = sock.recvmsg(
+                65536, socket.CMSG_SPACE(len(_PIPES) * 4))
+            fds = array.array('i')
+            for level, kind, cdata in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds.frombytes(cdata[:len(cdata) - len(cdata) % 4])
+            fds = list(fds)
+            try:
+                pid = os.fork()
+            except OSError as e:
+                sock.send(str(e).encode('utf-8'))
+            else:
+                if not pid:
+                    sock.detach()
+                    _child(code, json.loads(data)['args'], fds,
+                           [control, wakeup, wakeupW])
+                sock.send(b"%d" % (pid,))
+            for fd in fds:
+                os.close(fd)
+
+
+def _reap():
+    """
+    Reap the children that exited and report them on stdout.
+    """
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if not pid:
+            return
+        os.write(1, b"%d %d\n" % (pid, status))
+
+
+def _child(code, args, fds, zygoteFDs):
+    """
+    Become a child: put the pipes received in place of our stdio and of
+    the AMP fds, and run the bootstrap code. Never returns.
+    """
+    import atexit
+    import fcntl
+    import traceback
+
+    status = 1
+    try:
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        fds = [os.open(os.devnull, os.O_RDWR)] + fds
+        # out of the way of the fds that we are going to replace
+        null, err, toChild, fromChild = [fcntl.fcntl(fd, fcntl.F_DUPFD, 10)
+                                         for fd in fds]
+        for fd in fds + zygoteFDs:
+            os.close(fd)
+        for fd, childFD in [(null, 0), (err, 1), (err, 2),
+                            (toChild, main.TO_CHILD),
+                            (fromChild, main.FROM_CHILD)]:
+            os.dup2(fd, childFD)
+        for fd in null, err, toChild, fromChild:
+            os.close(fd)
+        sys.argv = ['-c'] + args
+        try:
+            exec(code, {'__name__': '__main__'})
+            status = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                sys.stderr.write("%s\n" % (e.code,))
+        atexit._run_exitfuncs()
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        for f in sys.stdout, sys.stderr:
+            try:
+                f.flush()
+            except Exception:
+                pass
+        os._exit(status)
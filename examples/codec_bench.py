@@ -0,0 +1,130 @@
+"""
+Compare the AMP boxes with the compact codec: the cost of encoding and
+decoding a box, the bytes written for it, and the calls per second
+through a pool.
+
+Run it from this directory: python codec_bench.py [boxes] [calls]
+"""
+import time
+
+from twisted.protocols import amp
+
+from ampoule import child, codec, util
+
+
+class Small(amp.Command):
+    arguments = [(b'data', amp.String())]
+    response = [(b'response', amp.String())]
+
+class Numeric(amp.Command):
+    arguments = [(b'value%d' % (i,), amp.Integer()) for i in range(20)]
+    response = [(b'total', amp.Integer())]
+
+class BenchChild(child.AMPChild):
+    @Small.responder
+    def small(self, data):
+        return {'response': data}
+
+    @Numeric.responder
+    def numeric(self, **values):
+        return {'total': sum(values.values())}
+
+
+CASES = [
+    ("small", Small, {'data': b"hello"}),
+    ("numeric", Numeric,
+     dict(('value%d' % (i,), i * 1000) for i in range(20))),
+]
+
+
+class _Receiver(object):
+    """
+    Collects the boxes parsed by an AMP box parser.
+    """
+    def __init__(self):
+        self.boxes = []
+
+    def startReceivingBoxes(self, sender):
+        pass
+
+    def ampBoxReceived(self, box):
+        self.boxes.append(box)
+
+
+def _boxes(command, kwargs, count):
+    boxes = []
+    for i in range(count):
+        box = command.makeArguments(kwargs, None)
+        box[amp.COMMAND] = command.commandName
+        box[amp.ASK] = b"%x" % (i,)
+        boxes.append(box)
+    return boxes
+
+
+def _amp(boxes):
+    t = time.time()
+    wire = b"".join(box.serialize() for box in boxes)
+    encoded = time.time() - t
+    receiver = _Receiver()
+    parser = amp.BinaryBoxProtocol(receiver)
+    parser.makeConnection(receiver)
+    t = time.time()
+    parser.dataReceived(wire)
+    decoded = time.time() - t
+    assert len(receiver.boxes) == len(boxes)
+    return encoded, decoded, len(wire)
+
+
+def _compact(boxes):
+    encoder, decoder = codec.CompactCodec(), codec.CompactCodec()
+    t = time.time()
+    wire = b"".join(encoder.encode(box) for box in boxes)
+    encoded = time.time() - t
+    t = time.time()
+    received = decoder.decode(wire)
+    decoded = time.time() - t
+    assert len(received) == len(boxes)
+    return encoded, decoded, len(wire)
+
+
+def codecs(count):
+    print("%10s %8s %14s %14s %12s" % (
+        "command", "codec", "encode us/box", "decode us/box", "bytes/box"))
+    for name, command, kwargs in CASES:
+        boxes = _boxes(command, kwargs, count)
+        for codecName, run in [("amp", _amp), ("compact", _compact)]:
+            encoded, decoded, size = run(boxes)
+            print("%10s %8s %14.2f %14.2f %12.1f" % (
+                name, codecName, encoded / count * 1e6,
+                decoded / count * 1e6, size / float(count)))
+
+
+@util.mainpoint
+def main(args):
+    from twisted.internet import reactor, defer
+    from ampoule import main as ampouleMain, pool
+
+    count = int(args[1]) if len(args) > 1 else 100000
+    calls = int(args[2]) if len(args) > 2 else 20000
+    codecs(count)
+
+    @defer.inlineCallbacks
+    def _run():
+        print("\n%10s %8s %12s" % ("command", "codec", "calls/s"))
+        for name, command, kwargs in CASES:
+            for codecName, factory in [("amp", None),
+                                       ("compact", codec.CompactCodec)]:
+                starter = ampouleMain.ProcessStarter(packages=("twisted",),
+                                                     codec=factory)
+                pp = pool.ProcessPool(BenchChild, min=1, max=1,
+                                      recycleAfter=0, starter=starter)
+                yield pp.start()
+                t = time.time()
+                yield pp.map(command, [kwargs] * calls)
+                elapsed = time.time() - t
+                print("%10s %8s %12.1f" % (name, codecName, calls / elapsed))
+                yield pp.stop()
+        reactor.stop()
+
+    reactor.callLater(0, _run)
+    reactor.run()
@@ -0,0 +1,65 @@
+"""
+Compare sending big values to the children through the pipes, with a
+streaming argument, and through shared memory.
+
+Run it from this directory: python sharedmem_bench.py [repeats]
+"""
+import zlib
+
+from twisted.protocols import amp
+
+from ampoule import child, util
+from ampoule.sharedmem import SharedBytes
+from ampoule.streaming import Stream
+
+SIZES = [64 * 1024, 1024 * 1024, 8 * 1024 * 1024, 32 * 1024 * 1024]
+
+class PipeChecksum(amp.Command):
+    arguments = [(b"data", Stream())]
+    response = [(b"crc", amp.Integer())]
+
+class SharedChecksum(amp.Command):
+    arguments = [(b"data", SharedBytes())]
+    response = [(b"crc", amp.Integer())]
+
+class BenchChild(child.AMPChild):
+    @PipeChecksum.responder
+    def pipeChecksum(self, data):
+        return data.readAll().addCallback(
+            lambda value: {"crc": zlib.crc32(value)})
+
+    @SharedChecksum.responder
+    def sharedChecksum(self, data):
+        return {"crc": zlib.crc32(data)}
+
+@util.mainpoint
+def main(args):
+    import time
+    from twisted.internet import reactor, defer
+    from ampoule import pool
+
+    repeats = int(args[1]) if len(args) > 1 else 20
+
+    @defer.inlineCallbacks
+    def _run():
+        pp = pool.ProcessPool(BenchChild, min=1, max=1, recycleAfter=0)
+        yield pp.start()
+        print("%10s %8s %12s %12s" % ("size", "path", "calls/s", "MB/s"))
+        for size in SIZES:
+            data = b"a" * size
+            crc = zlib.crc32(data)
+            for name, command in [("pipe", PipeChecksum),
+                                  ("shm", SharedChecksum)]:
+                t = time.time()
+                for i in range(repeats):
+                    result = yield pp.doWork(command, data=data)
+                    assert result["crc"] == crc
+                elapsed = time.time() - t
+                print("%10d %8s %12.1f %12.1f" % (
+                    size, name, repeats / elapsed,
+                    repeats * size / elapsed / 2 ** 20))
+        yield pp.stop()
+        reactor.stop()
+
+    reactor.callLater(0, _run)
+    reactor.run()
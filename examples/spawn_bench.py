@@ -0,0 +1,70 @@
+"""
+Compare starting children with a new interpreter each and forking them
+from a zygote: the time until a child answers and the memory used by
+all of them, as proportional set size where /proc has it.
+
+Run it from this directory: python spawn_bench.py [children]
+"""
+import time
+
+from ampoule import child, commands, main, util, zygote
+
+
+def _pss(pid):
+    """
+    The proportional set size of a process in KiB, shared pages count
+    for a part only, or 0 if we can't tell.
+    """
+    try:
+        with open('/proc/%d/smaps_rollup' % (pid,)) as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return 0
+
+
+@util.mainpoint
+def main_(args):
+    from twisted.internet import reactor, defer
+
+    count = int(args[1]) if len(args) > 1 else 10
+
+    @defer.inlineCallbacks
+    def _run():
+        print("%10s %14s %14s %12s" % (
+            "starter", "first ms", "median ms", "PSS MiB"))
+        for name, starter in [
+                ("exec", main.ProcessStarter(packages=("twisted",))),
+                ("zygote", zygote.ZygoteProcessStarter(
+                    packages=("twisted",)))]:
+            if name == "zygote":
+                # the zygote itself starts with the first child
+                c, finished = starter.startAMPProcess(child.AMPChild)
+                yield c.callRemote(commands.Ping)
+                yield c.callRemote(commands.Shutdown)
+                yield finished
+            times = []
+            children = []
+            for i in range(count):
+                t = time.time()
+                c, finished = starter.startAMPProcess(child.AMPChild)
+                yield c.callRemote(commands.Ping)
+                times.append((time.time() - t) * 1000)
+                children.append((c, finished))
+            pss = sum(_pss(c.transport.transport.pid) for c, _ in children)
+            if name == "zygote":
+                pss += _pss(starter._zygote.transport.pid)
+            for c, finished in children:
+                yield c.callRemote(commands.Shutdown)
+                yield finished
+            if name == "zygote":
+                yield starter.stop()
+            print("%10s %14.1f %14.1f %12.1f" % (
+                name, times[0], sorted(times)[len(times) // 2],
+                pss / 1024.0))
+        reactor.stop()
+
+    reactor.callLater(0, _run)
+    reactor.run()
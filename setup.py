@@ -46,7 +46,7 @@ setup(
         'Programming Language :: Python :: 3.13',
         'Topic :: System',
     ],
-    packages=["ampoule", "ampoule.test"],
+    packages=["ampoule", "ampoule.bench", "ampoule.test"],
     package_data={'twisted': ['plugins/ampoule_plugin.py']},
     use_incremental=True,
     setup_requires=['incremental'],
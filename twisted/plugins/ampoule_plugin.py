@@ -32,7 +32,11 @@ class AMPoulePlugin(object):
             ["max_idle", "d", 20, "Maximum number of idle seconds before killing a child", int],
             ["recycle", "r", 500, "Maximum number of calls before recycling a child", int],
             ["reactor", "R", "select", "Select the reactor for child processes"],
-            ["timeout", "t", None, "Specify a timeout value for ProcessPool calls", int]
+            ["timeout", "t", None, "Specify a timeout value for ProcessPool calls", int],
+            ["max_queue", "q", None, "Maximum number of calls waiting for a child", int],
+            ["max_queue_wait", "w", None, "Maximum number of seconds a call can wait for a child", float],
+            ["metrics_port", "m", None, "Port serving the pool metrics to Prometheus over HTTP", int],
+            ["metrics_interface", None, None, "Listening interface for the metrics, the AMP one by default"]
         ]
 
         def postOptions(self):